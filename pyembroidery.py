@@ -3,6 +3,9 @@
 # wxPython program for viewing (and eventually editing and digitizing)
 # embroidery designs for use on home sewing machines.
 #
+# This module holds the design model and file formats and imports
+# without wxPython; the GUI lives in pyembroiderygui.py.
+#
 # Created by Jackson Yee (jackson.yee@gmail.com)
 # Project located at http://pyembroidery.googlecode.com/
 #
@@ -15,51 +18,789 @@
 
 import sys
 import os
-import wx
-import re
+import glob
+import argparse
+import multiprocessing
 import random
-import StringIO
 import array
 import math
+import time
+import bisect
+import itertools
+import mmap
+import struct
+import zlib
+import hashlib
+import cPickle
+import threading
+import sqlite3
+import tempfile
 
 APP_NAME	=	'PyEmbroidery (by Jackson Yee)' 
 
-# IDs
-(	NEW_TAB,
-	CLOSE_TAB,
-	ROTATE_CLOCKWISE,
-	ROTATE_COUNTERCLOCKWISE,
-	OPEN_IMAGE,
-	CLOSE_IMAGE,
-	MOVE_LEFT,
-	MOVE_RIGHT,
-	MOVE_UP,
-	MOVE_DOWN,
-)	=	range( wx.ID_HIGHEST, wx.ID_HIGHEST + 10)
-
 # *********************************************************************
-class Sketch(object):
+class StitchStats(object):
+	# Running statistics over a StitchList. Records appended to the list
+	# are folded in by Update() without rescanning the ones already seen,
+	# moves and quarter turns adjust the totals directly, and anything
+	# else calls Invalidate() so the next Update() starts over.
 	
 	# -------------------------------------------------------------------
 	def __init__(self):
+		self.Invalidate()
+	
+	# -------------------------------------------------------------------
+	def Invalidate(self):
+		self.Count						=	0
+		self.MinX							=	None
+		self.MaxX							=	None
+		self.MinY							=	None
+		self.MaxY							=	None
+		self.StitchCount			=	0
+		self.JumpCount				=	0
+		self.ColorChangeCount	=	0
+		self.ThreadLength			=	0.0
+		self.LongestStitch		=	0.0
+		self.LastX						=	0
+		self.LastY						=	0
+		self.TrimCount				=	0
+		self.JumpRun					=	0
+		
+		# Number of stitches of each length, rounded to 0.1 mm
+		self.Lengths					=	{}
+	
+	# -------------------------------------------------------------------
+	def Update(self, stitches):
+		n = len(stitches.Flags)
+		
+		if self.Count >= n:
+			return self
+		
+		X			=	stitches.X
+		Y			=	stitches.Y
+		Flags	=	stitches.Flags
+		COLOR	=	Design.COLOR
+		JUMP	=	Design.JUMP
+		hypot	=	math.hypot
+		
+		minx		=	self.MinX
+		maxx		=	self.MaxX
+		miny		=	self.MinY
+		maxy		=	self.MaxY
+		lastx		=	self.LastX
+		lasty		=	self.LastY
+		length	=	self.ThreadLength
+		longest	=	self.LongestStitch
+		lengths	=	self.Lengths
+		run			=	self.JumpRun
+		trim		=	TAJIMA_TRIM_JUMPS
+		
+		for i in xrange(self.Count, n):
+			flags = Flags[i]
+			
+			if flags == COLOR:
+				# Changing thread cuts it anyway
+				self.ColorChangeCount += 1
+				run = 0
+				continue
+			
+			x = X[i]
+			y = Y[i]
+			
+			if minx is None:
+				# The first stitch only sets the starting point
+				minx = maxx = lastx = x
+				miny = maxy = lasty = y
+			else:
+				if x < minx:
+					minx = x
+				if x > maxx:
+					maxx = x
+				if y < miny:
+					miny = y
+				if y > maxy:
+					maxy = y
+			
+			if flags == JUMP:
+				self.JumpCount += 1
+				run += 1
+			else:
+				if run >= trim:
+					self.TrimCount += 1
+				run = 0
+				
+				self.StitchCount += 1
+				d = hypot(x - lastx, y - lasty)
+				length += d
+				if d > longest:
+					longest = d
+				
+				b = int(d + 0.5)
+				lengths[b] = lengths.get(b, 0) + 1
+			
+			lastx = x
+			lasty = y
+		
+		self.MinX						=	minx
+		self.MaxX						=	maxx
+		self.MinY						=	miny
+		self.MaxY						=	maxy
+		self.LastX					=	lastx
+		self.LastY					=	lasty
+		self.ThreadLength		=	length
+		self.LongestStitch	=	longest
+		self.JumpRun				=	run
+		self.Count					=	n
+		
+		return self
+	
+	# -------------------------------------------------------------------
+	def Transformed(self, t):
+		# Statistics of the stitches after t. Rotations by quarter turns
+		# and mirrors with whole number offsets keep every length and map
+		# the box corners onto the new box; anything else needs a rescan.
+		stats = StitchStats()
+		
+		if not t.IsGridIsometry():
+			return stats
+		
+		stats.__dict__.update( self.__dict__ )
+		stats.Lengths = dict( self.Lengths )
+		
+		if self.MinX is not None:
+			minx, miny, maxx, maxy = t.Bounds( self.MinX, self.MinY, self.MaxX, self.MaxY )
+			stats.MinX = int(round(minx))
+			stats.MinY = int(round(miny))
+			stats.MaxX = int(round(maxx))
+			stats.MaxY = int(round(maxy))
+		
+		x, y = t.Apply( self.LastX, self.LastY )
+		stats.LastX = int(round(x))
+		stats.LastY = int(round(y))
+		
+		return stats
+	
+# *********************************************************************
+class DetailPyramid(object):
+	# Simplified copies of every color block for drawing zoomed out.
+	# Level k keeps a point only when it leaves the 2**k unit grid cell of
+	# the point kept before it, so drawing at a scale where one cell is
+	# about one pixel draws about one segment per pixel the thread
+	# crosses. Level 0 is the stitches themselves. Each level is built
+	# from the one below it, and levels that drop too few points to be
+	# worth keeping are stored as None and drawn from the level below.
+	
+	# -------------------------------------------------------------------
+	def __init__(self, stitches, maxlevels = 16):
+		self.Stitches	=	stitches
+		self.Count		=	len(stitches.Flags)
+		self.Levels		=	[ None ]
+		
+		blocks = [ (color, stitches.BlockPoints(start, end)) 
+								for color, start, end in stitches.ColorBlocks() ]
+		
+		stored = sum([ len(points) for color, points in blocks ])
+		
+		for k in range(1, maxlevels + 1):
+			blocks = [ (color, self.Simplify(points, 1 << k)) for color, points in blocks ]
+			count = sum([ len(points) for color, points in blocks ])
+			
+			if count * 4 > stored * 3:
+				self.Levels.append( None )
+			else:
+				self.Levels.append( [ (color, array.array('i', [ c for p in points for c in p ])) 
+															for color, points in blocks ] )
+				stored = count
+			
+			# Stop once every block is down to its two end points
+			if count <= 2 * len(blocks):
+				break
+	
+	# -------------------------------------------------------------------
+	def Simplify(self, points, grid):
+		if len(points) <= 2:
+			return points
+		
+		kept = [ points[0] ]
+		cx = points[0][0] // grid
+		cy = points[0][1] // grid
+		
+		for p in points[1:-1]:
+			x = p[0] // grid
+			y = p[1] // grid
+			
+			if x != cx or y != cy:
+				kept.append( p )
+				cx = x
+				cy = y
+		
+		# Always finish where the block finishes
+		kept.append( points[-1] )
+		return kept
+	
+	# -------------------------------------------------------------------
+	def LevelFor(self, scale):
+		# Coarsest level whose grid is no bigger than one pixel at scale
+		# pixels per design unit
+		if scale >= 0.5:
+			return 0
+		
+		k = int(math.floor( math.log(1.0 / scale, 2) ))
+		return max(0, min(k, len(self.Levels) - 1))
+	
+	# -------------------------------------------------------------------
+	def Blocks(self, scale):
+		# (color, points) for every color block at the given scale
+		k = self.LevelFor(scale)
+		
+		while k > 0 and self.Levels[k] is None:
+			k -= 1
+		
+		if k == 0:
+			stitches = self.Stitches
+			return [ (color, stitches.BlockPoints(start, end)) 
+								for color, start, end in stitches.ColorBlocks() ]
+		
+		return [ (color, zip( xy[0::2], xy[1::2] )) for color, xy in self.Levels[k] ]
+	
+# *********************************************************************
+class StitchIndex(object):
+	# Uniform grid over the segments of a StitchList, where segment i runs
+	# from the needle position before record i to record i. Each grid
+	# cell lists the segments whose bounding box touches it; the rare
+	# segments that span more than LONG_CELLS cells are kept in a
+	# separate list instead of being copied into every cell.
+	LONG_CELLS	=	64
+	
+	# -------------------------------------------------------------------
+	def __init__(self, stitches, cellsize = None):
+		n = len(stitches.Flags)
+		stats = stitches.GetStats()
+		
+		if cellsize is None:
+			# Aim for a couple of segments per cell
+			if stats.MinX is None:
+				cellsize = 1
+			else:
+				area = (stats.MaxX - stats.MinX + 1) * (stats.MaxY - stats.MinY + 1)
+				cellsize = max(1, int(math.sqrt( area / float(max(n, 1)) ) * 2))
+		
+		self.Stitches	=	stitches
+		self.Count		=	n
+		self.CellSize	=	cellsize
+		self.Long			=	[]
+		
+		X			=	stitches.X
+		Y			=	stitches.Y
+		Flags	=	stitches.Flags
+		COLOR	=	Design.COLOR
+		
+		cells	=	{}
+		lastx	=	0
+		lasty	=	0
+		
+		for i in xrange(n):
+			x = X[i]
+			y = Y[i]
+			
+			if Flags[i] != COLOR:
+				cx0 = min(lastx, x) // cellsize
+				cx1 = max(lastx, x) // cellsize
+				cy0 = min(lasty, y) // cellsize
+				cy1 = max(lasty, y) // cellsize
+				
+				if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > self.LONG_CELLS:
+					self.Long.append( i )
+				else:
+					for cx in range(cx0, cx1 + 1):
+						for cy in range(cy0, cy1 + 1):
+							key = (cx, cy)
+							if key in cells:
+								cells[key].append( i )
+							else:
+								cells[key] = [ i ]
+			
+			lastx = x
+			lasty = y
+		
+		self.Cells = dict( [ (key, array.array('i', v)) for key, v in cells.iteritems() ] )
+		
+		if cells:
+			xs = [ key[0] for key in cells ]
+			ys = [ key[1] for key in cells ]
+			self.CellBounds = (min(xs), min(ys), max(xs), max(ys))
+		else:
+			self.CellBounds = None
+	
+	# -------------------------------------------------------------------
+	def Segment(self, i):
+		x0, y0 = self.Stitches.Position(i)
+		return x0, y0, self.Stitches.X[i], self.Stitches.Y[i]
+	
+	# -------------------------------------------------------------------
+	def Query(self, minx, miny, maxx, maxy):
+		# Sorted indices of the segments whose bounding box overlaps the
+		# given box
+		cs = self.CellSize
+		cx0 = int(math.floor(minx)) // cs
+		cx1 = int(math.floor(maxx)) // cs
+		cy0 = int(math.floor(miny)) // cs
+		cy1 = int(math.floor(maxy)) // cs
+		
+		found = set()
+		cells = self.Cells
+		
+		if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(cells):
+			# The box covers more cells than exist, so walk the cells instead
+			for (cx, cy), v in cells.iteritems():
+				if cx0 <= cx <= cx1 and cy0 <= cy <= cy1:
+					found.update( v )
+		else:
+			for cx in range(cx0, cx1 + 1):
+				for cy in range(cy0, cy1 + 1):
+					v = cells.get( (cx, cy) )
+					if v:
+						found.update( v )
+		
+		found.update( self.Long )
+		
+		# Cells are coarser than the box, so check each candidate
+		result = []
+		
+		for i in sorted( found ):
+			x0, y0, x1, y1 = self.Segment(i)
+			if (min(x0, x1) <= maxx and max(x0, x1) >= minx 
+					and min(y0, y1) <= maxy and max(y0, y1) >= miny):
+				result.append( i )
+		
+		return result
+	
+	# -------------------------------------------------------------------
+	def Nearest(self, x, y, maxdistance = None):
+		# (index, distance) of the segment nearest to (x, y), or None.
+		# Searches rings of cells outwards until no closer segment can be
+		# found.
+		cs = self.CellSize
+		px = int(math.floor(x)) // cs
+		py = int(math.floor(y)) // cs
+		
+		best = None
+		bestd = None
+		
+		for i in self.Long:
+			d = SegmentDistance( x, y, *self.Segment(i) )
+			if bestd is None or d < bestd:
+				best, bestd = i, d
+		
+		if self.CellBounds:
+			minx, miny, maxx, maxy = self.CellBounds
+			rings = max( abs(px - minx), abs(px - maxx), abs(py - miny), abs(py - maxy) )
+		else:
+			rings = -1
+		
+		r = 0
+		
+		while r <= rings:
+			# Anything in ring r or beyond is at least (r - 1) cells away
+			if bestd is not None and bestd <= (r - 1) * cs:
+				break
+			
+			if maxdistance is not None and (r - 1) * cs > maxdistance:
+				break
+			
+			for cx in range(px - r, px + r + 1):
+				for cy in range(py - r, py + r + 1):
+					if max(abs(cx - px), abs(cy - py)) != r:
+						continue
+					
+					for i in self.Cells.get( (cx, cy), () ):
+						d = SegmentDistance( x, y, *self.Segment(i) )
+						if bestd is None or d < bestd:
+							best, bestd = i, d
+			
+			r += 1
+		
+		if best is None or (maxdistance is not None and bestd > maxdistance):
+			return None
+		
+		return best, bestd
+	
+# *********************************************************************
+class Transform(object):
+	# Affine transform of design coordinates, stored as the matrix
+	#
+	#   | A C E |
+	#   | B D F |
+	#
+	# so that x' = A x + C y + E and y' = B x + D y + F. The builder
+	# methods return a new Transform that applies their step after this
+	# one, so a whole chain collapses into a single matrix.
+	
+	# -------------------------------------------------------------------
+	def __init__(self, a = 1, b = 0, c = 0, d = 1, e = 0, f = 0):
+		self.A	=	a
+		self.B	=	b
+		self.C	=	c
+		self.D	=	d
+		self.E	=	e
+		self.F	=	f
+	
+	# -------------------------------------------------------------------
+	def Then(self, t):
+		return Transform(	t.A * self.A + t.C * self.B,
+											t.B * self.A + t.D * self.B,
+											t.A * self.C + t.C * self.D,
+											t.B * self.C + t.D * self.D,
+											t.A * self.E + t.C * self.F + t.E,
+											t.B * self.E + t.D * self.F + t.F )
+	
+	# -------------------------------------------------------------------
+	def Around(self, t, cx, cy):
+		# Applies t with (cx, cy) as its origin
+		return self.Translate( -cx, -cy ).Then( t ).Translate( cx, cy )
+	
+	# -------------------------------------------------------------------
+	def Translate(self, dx, dy):
+		return self.Then( Transform( 1, 0, 0, 1, dx, dy ) )
+	
+	# -------------------------------------------------------------------
+	def Rotate(self, angle, cx = 0, cy = 0):
+		# Quarter turns use exact sines so whole numbers stay whole
+		quarter = angle % 360
+		
+		if quarter == 0:
+			sa, ca = 0, 1
+		elif quarter == 90:
+			sa, ca = 1, 0
+		elif quarter == 180:
+			sa, ca = 0, -1
+		elif quarter == 270:
+			sa, ca = -1, 0
+		else:
+			sa = math.sin( math.radians(angle) )
+			ca = math.cos( math.radians(angle) )
+		
+		return self.Around( Transform( ca, sa, -sa, ca ), cx, cy )
+	
+	# -------------------------------------------------------------------
+	def Scale(self, sx, sy = None, cx = 0, cy = 0):
+		if sy is None:
+			sy = sx
+		
+		return self.Around( Transform( sx, 0, 0, sy ), cx, cy )
+	
+	# -------------------------------------------------------------------
+	def Mirror(self, horizontal = True, cx = 0, cy = 0):
+		# A horizontal mirror flips left and right
+		if horizontal:
+			return self.Scale( -1, 1, cx, cy )
+		
+		return self.Scale( 1, -1, cx, cy )
+	
+	# -------------------------------------------------------------------
+	def Shear(self, kx, ky = 0, cx = 0, cy = 0):
+		return self.Around( Transform( 1, ky, kx, 1 ), cx, cy )
+	
+	# -------------------------------------------------------------------
+	def Inverse(self):
+		det = float(self.A * self.D - self.B * self.C)
+		
+		if not det:
+			raise ValueError('This transform squashes the design flat and cannot be undone')
+		
+		a = self.D / det
+		b = -self.B / det
+		c = -self.C / det
+		d = self.A / det
+		
+		return Transform( a, b, c, d, 
+											-(a * self.E + c * self.F), 
+											-(b * self.E + d * self.F) )
+	
+	# -------------------------------------------------------------------
+	def Apply(self, x, y):
+		return (self.A * x + self.C * y + self.E, 
+						self.B * x + self.D * y + self.F)
+	
+	# -------------------------------------------------------------------
+	def Bounds(self, minx, miny, maxx, maxy):
+		# Bounding box of a transformed box
+		corners = [ self.Apply( x, y ) for x in (minx, maxx) for y in (miny, maxy) ]
+		xs = [ c[0] for c in corners ]
+		ys = [ c[1] for c in corners ]
+		
+		return min(xs), min(ys), max(xs), max(ys)
+	
+	# -------------------------------------------------------------------
+	def IsIdentity(self):
+		return self.IsTranslation() and self.E == 0 and self.F == 0
+	
+	# -------------------------------------------------------------------
+	def IsTranslation(self):
+		return self.A == 1 and self.B == 0 and self.C == 0 and self.D == 1
+	
+	# -------------------------------------------------------------------
+	def IsGridIsometry(self):
+		# True for quarter turns and mirrors by whole 0.1 mm steps, which
+		# map grid points onto grid points without changing any length
+		m = (self.A, self.B, self.C, self.D)
+		
+		for v in m:
+			if v not in (-1, 0, 1):
+				return False
+		
+		if abs(self.A) + abs(self.B) != 1 or abs(self.C) + abs(self.D) != 1:
+			return False
+		
+		return self.E == int(self.E) and self.F == int(self.F)
+	
+	# -------------------------------------------------------------------
+	def __eq__(self, other):
+		return (isinstance(other, Transform) 
+						and (self.A, self.B, self.C, self.D, self.E, self.F) 
+							== (other.A, other.B, other.C, other.D, other.E, other.F))
+	
+	# -------------------------------------------------------------------
+	def __ne__(self, other):
+		return not self.__eq__( other )
+	
+	# -------------------------------------------------------------------
+	def __repr__(self):
+		return 'Transform(%r, %r, %r, %r, %r, %r)' % (self.A, self.B, self.C, self.D, self.E, self.F)
+	
+# *********************************************************************
+class StitchList(object):
+	# Columnar stitch storage: parallel x/y coordinate arrays and a flags
+	# array, with the color index of every color change kept in a
+	# separate index. A color change record holds the current needle
+	# position so that every coordinate can be transformed the same way.
+	#
+	# Indexing and iteration still hand out the old list forms, [x, y],
+	# [x, y, Design.JUMP] and [color, 0, Design.COLOR], for code that has
+	# not moved over to the arrays yet.
+	
+	# -------------------------------------------------------------------
+	def __init__(self, stitches = None):
 		self.Clear()
+		
+		if stitches:
+			for s in stitches:
+				self.append( s )
 	
 	# -------------------------------------------------------------------
 	def Clear(self):
-		if hasattr(self, 'Image'):
-			if self.Image:
-				self.Image.Destroy()
+		self.X							=	array.array('i')
+		self.Y							=	array.array('i')
+		self.Flags					=	array.array('B')
+		self.ColorChanges		=	array.array('i')
+		self.ColorIndices		=	array.array('H')
+		self.Stats					=	StitchStats()
+		self.Pyramid				=	None
+		self.Index					=	None
+		self.Version				=	0
+	
+	# -------------------------------------------------------------------
+	def GetStats(self):
+		return self.Stats.Update( self )
+	
+	# -------------------------------------------------------------------
+	def GetPyramid(self):
+		# Level of detail pyramid, built the first time it is asked for
+		if self.Pyramid is None or self.Pyramid.Count != len(self.Flags):
+			self.Pyramid = DetailPyramid( self )
+		
+		return self.Pyramid
+	
+	# -------------------------------------------------------------------
+	def GetIndex(self):
+		# Spatial index of the segments, built the first time it is asked for
+		if self.Index is None or self.Index.Count != len(self.Flags):
+			self.Index = StitchIndex( self )
+		
+		return self.Index
+	
+	# -------------------------------------------------------------------
+	def Transformed(self, t):
+		# Copy with t applied to every coordinate in a single pass,
+		# rounded once to the 0.1 mm grid
+		X = self.X
+		Y = self.Y
+		
+		out = StitchList()
+		
+		if t.IsTranslation() and t.E == int(t.E) and t.F == int(t.F):
+			e = int(t.E)
+			f = int(t.F)
+			out.X = array.array('i', [ x + e for x in X ])
+			out.Y = array.array('i', [ y + f for y in Y ])
+		else:
+			a, b, c, d, e, f = t.A, t.B, t.C, t.D, t.E, t.F
+			out.X = array.array('i', [ int(round(a * x + c * y + e)) for x, y in itertools.izip(X, Y) ])
+			out.Y = array.array('i', [ int(round(b * x + d * y + f)) for x, y in itertools.izip(X, Y) ])
+		
+		out.Flags					=	array.array('B', self.Flags)
+		out.ColorChanges	=	array.array('i', self.ColorChanges)
+		out.ColorIndices	=	array.array('H', self.ColorIndices)
+		out.Stats					=	self.GetStats().Transformed( t )
+		
+		return out
+	
+	# -------------------------------------------------------------------
+	def Add(self, x, y, flags = 0, color = 0):
+		if flags == Design.COLOR:
+			self.ColorChanges.append( len(self.Flags) )
+			self.ColorIndices.append( color )
+		
+		self.X.append( x )
+		self.Y.append( y )
+		self.Flags.append( flags )
+	
+	# -------------------------------------------------------------------
+	def append(self, s):
+		if len(s) == 3:
+			if s[2] == Design.COLOR:
+				x, y = self.Position( len(self.Flags) )
+				self.Add( x, y, Design.COLOR, s[0] )
+				return
 			
-		self.Image	=	None
-		self.Design	=	Design()
-		self.UndoList	=	[]
+			self.Add( int(round(s[0])), int(round(s[1])), s[2] )
+			return
+		
+		self.Add( int(round(s[0])), int(round(s[1])) )
 	
 	# -------------------------------------------------------------------
-	def LoadImage(self, filename):
-		self.Image.LoadFile(filename, wx.BITMAP_TYPE_ANY)
-
+	def Slice(self, start, end):
+		# Copy of records start to end, end exclusive
+		out = StitchList()
+		out.X			=	self.X[start:end]
+		out.Y			=	self.Y[start:end]
+		out.Flags	=	self.Flags[start:end]
+		
+		k0 = bisect.bisect_left( self.ColorChanges, start )
+		k1 = bisect.bisect_left( self.ColorChanges, end )
+		
+		out.ColorChanges	=	array.array('i', [ i - start for i in self.ColorChanges[k0:k1] ])
+		out.ColorIndices	=	self.ColorIndices[k0:k1]
+		
+		return out
+	
+	# -------------------------------------------------------------------
+	def Replace(self, start, end, stitches):
+		# Replaces records start to end with a copy of another StitchList
+		# and returns the records that were removed
+		removed = self.Slice( start, end )
+		delta = len(stitches) - (end - start)
+		
+		self.X[start:end]			=	stitches.X
+		self.Y[start:end]			=	stitches.Y
+		self.Flags[start:end]	=	stitches.Flags
+		
+		k0 = bisect.bisect_left( self.ColorChanges, start )
+		k1 = bisect.bisect_left( self.ColorChanges, end )
+		
+		self.ColorChanges	=	(self.ColorChanges[:k0] 
+												+ array.array('i', [ start + i for i in stitches.ColorChanges ])
+												+ array.array('i', [ i + delta for i in self.ColorChanges[k1:] ]))
+		self.ColorIndices	=	self.ColorIndices[:k0] + stitches.ColorIndices + self.ColorIndices[k1:]
+		
+		# Everything derived from the records has to be worked out again
+		self.Stats.Invalidate()
+		self.Pyramid	=	None
+		self.Index		=	None
+		self.Version	+=	1
+		
+		return removed
+	
+	# -------------------------------------------------------------------
+	def Position(self, i):
+		# Needle position before record i
+		if i <= 0:
+			return 0, 0
+		
+		return self.X[i - 1], self.Y[i - 1]
+	
+	# -------------------------------------------------------------------
+	def ColorBlocks(self):
+		# Splits the records between color changes into (color, start,
+		# end) ranges, end exclusive
+		starts	=	[0] + [ i + 1 for i in self.ColorChanges ]
+		ends		=	list(self.ColorChanges) + [len(self.Flags)]
+		colors	=	[0] + list(self.ColorIndices)
+		
+		return zip( colors, starts, ends )
+	
+	# -------------------------------------------------------------------
+	def BlockPoints(self, start, end):
+		# Needle positions from records start to end, beginning with the
+		# position the needle is at before them
+		return [ self.Position(start) ] + zip( self.X[start:end], self.Y[start:end] )
+	
+	# -------------------------------------------------------------------
+	def Color(self, i):
+		# Color index in effect at record i
+		k = bisect.bisect_right( self.ColorChanges, i ) - 1
+		
+		if k < 0:
+			return 0
+		
+		return self.ColorIndices[k]
+	
+	# -------------------------------------------------------------------
+	def __len__(self):
+		return len(self.Flags)
+	
+	# -------------------------------------------------------------------
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [ self[k] for k in xrange( *i.indices( len(self) ) ) ]
+		
+		if i < 0:
+			i += len(self)
+		
+		flags = self.Flags[i]
+		
+		if flags == Design.COLOR:
+			return [self.Color(i), 0, Design.COLOR]
+		
+		if flags:
+			return [self.X[i], self.Y[i], flags]
+		
+		return [self.X[i], self.Y[i]]
+	
+	# -------------------------------------------------------------------
+	def __iter__(self):
+		colors = iter( self.ColorIndices )
+		
+		for x, y, flags in itertools.izip( self.X, self.Y, self.Flags ):
+			if flags == Design.COLOR:
+				yield [colors.next(), 0, Design.COLOR]
+			elif flags:
+				yield [x, y, flags]
+			else:
+				yield [x, y]
+	
+	# -------------------------------------------------------------------
+	def __eq__(self, other):
+		if not isinstance(other, StitchList):
+			other = StitchList( other )
+		
+		return (self.X == other.X 
+						and self.Y == other.Y 
+						and self.Flags == other.Flags
+						and self.ColorIndices == other.ColorIndices)
+	
+	# -------------------------------------------------------------------
+	def __ne__(self, other):
+		return not self.__eq__( other )
+	
 # *********************************************************************
 class Design(object):
+	# Transforms are not applied to the stitches straight away. They are
+	# composed into Matrix, which is applied to the untouched
+	# BaseStitches the first time concrete coordinates are needed, by
+	# reading Stitches when saving or drawing for example. Repeated
+	# rotations never round more than once, and UndoLog only has to
+	# restore the previous matrix.
 	JUMP	=	0x01
 	COLOR	=	0x02
 	
@@ -70,11 +811,13 @@ class Design(object):
 	# -------------------------------------------------------------------
 	def Clear(self):
 		self.Name						=	'Untitled'
+		self.Header						=	TajimaHeader()
 		self.ColorsRead				=	0
 		self.Colors						=	[]
-		self.Stitches					=	[]
+		self.Stitches					=	StitchList()
 		self.CurrentStitch		=	0
 		self.StitchCount			=	0
+		self.JumpStitchCount	=	0
 		self.JumpStitches			=	[]
 		self.ColorChanges			=	[]
 		self.Begin						=	(0, 0)
@@ -87,6 +830,30 @@ class Design(object):
 		self.MinX							=	0
 		self.MinY							=	0
 	
+	# -------------------------------------------------------------------
+	def GetStitches(self):
+		if self.Matrix.IsIdentity():
+			return self.BaseStitches
+		
+		if self.Concrete is None:
+			self.Concrete = self.BaseStitches.Transformed( self.Matrix )
+		
+		return self.Concrete
+	
+	# -------------------------------------------------------------------
+	def SetStitches(self, stitches):
+		self.BaseStitches		=	stitches
+		self.Matrix					=	Transform()
+		self.Concrete				=	None
+	
+	Stitches = property( GetStitches, SetStitches )
+	
+	# -------------------------------------------------------------------
+	def CommitTransform(self):
+		# Bakes the pending transform into the stitches before editing them
+		if not self.Matrix.IsIdentity():
+			self.SetStitches( self.GetStitches() )
+	
 	# -------------------------------------------------------------------
 	def RandomColor(self):
 		return (	random.randint(0x00, 0xc0),
@@ -100,133 +867,164 @@ class Design(object):
 		
 	# -------------------------------------------------------------------
 	def CalcStitchExtent(self):
-		maxx = 0
-		maxy = 0
-		minx = 0
-		miny = 0
+		if self.Matrix.IsGridIsometry():
+			# Quarter turns, mirrors and moves don't need the stitches
+			stats = self.BaseStitches.GetStats().Transformed( self.Matrix )
+		else:
+			stats = self.Stitches.GetStats()
 		
-		for s in self.Stitches:
-			if len(s) == 3:
-				if s[2] == self.COLOR:
-					continue
-				
-			if s[0] > maxx:
-				maxx = s[0]
-			elif s[0] < minx:
-				minx = s[0]
-				
-			if s[1] > maxy:
-				maxy = s[1]
-			elif s[1] < miny:
-				miny = s[1]
+		if stats.MinX is None:
+			self.MaxX = 0
+			self.MaxY = 0
+			self.MinX = 0
+			self.MinY = 0
+		else:
+			self.MaxX = stats.MaxX
+			self.MaxY = stats.MaxY
+			self.MinX = stats.MinX
+			self.MinY = stats.MinY
+			
+		self.Width	=	self.MaxX - self.MinX
+		self.Height	=	self.MaxY - self.MinY
 		
-		self.MaxX = maxx
-		self.MaxY = maxy
-		self.MinX = minx
-		self.MinY = miny
-		self.Width	=	maxx - minx
-		self.Height	=	maxy - miny
+		return stats
 		
-		NumColors = 1
+	# -------------------------------------------------------------------
+	def EstimateSewTime(self, profile = None):
+		# How long the design takes to sew, as a SewTimeEstimate
+		return EstimateSewTime( self.CalcStitchExtent(), profile )
+	
+	# -------------------------------------------------------------------
+	def Summary(self):
+		stats = self.CalcStitchExtent()
 		
-		for s in self.Stitches:
-			if len(s) == 3:
-				if s[2] == self.COLOR:
-					NumColors += 1
+		return '\n'.join( [
+			'%s colors in design, found %s colors in file' % ( len( self.Colors ), stats.ColorChangeCount + 1 ),
+			'%s stitches, %s jump stitches, %s color changes' % ( stats.StitchCount, stats.JumpCount, stats.ColorChangeCount ),
+			'Design has extents of width %.1f mm from (%.1f mm, %.1f mm) and height %.1f mm from (%.1f mm, %.1f mm)' % (self.Width / 10.0, self.MinX / 10.0, self.MaxX / 10.0, self.Height / 10.0, self.MinY / 10.0, self.MaxY / 10.0),
+			'Thread length %.1f mm, longest stitch %.1f mm' % ( stats.ThreadLength / 10.0, stats.LongestStitch / 10.0 ),
+		] )
 		
-		print '%s colors in design, found %s colors in file' % ( len( self.Colors ), NumColors )
-		print '%s stitches, %s jump stitches, %s color changes' % ( len(self.Stitches) - len(self.JumpStitches) - len(self.ColorChanges), len(self.JumpStitches), len(self.ColorChanges) )
-		print 'Design has extents of width %.1f mm from (%.1f mm, %.1f mm) and height %.1f mm from (%.1f mm, %.1f mm)' % (self.Width / 10.0, self.MinX / 10.0, self.MaxX / 10.0, self.Height / 10.0, self.MinY / 10.0, self.MaxY / 10.0)
+	# -------------------------------------------------------------------
+	def Load(self, filename, mapped = False):
+		for chunk in self.LoadChunks(filename, mapped):
+			self.AddStitches( chunk )
 		
+		self.CalcStitchExtent()
+	
 	# -------------------------------------------------------------------
-	def Load(self, filename):
+	def LoadChunks(self, filename, mapped = False, chunksize = None):
+		# Clears the design, reads its colors and returns an iterator over
+		# the decoded stitch chunks of filename. The chunks are not added;
+		# pass each one to AddStitches, which lets the decoding run on
+		# another thread while this design is drawn. The format is found
+		# by FindCodec().
 		self.Clear()
-		if len(filename) > 4:
-			if filename[-4:] == '.dst':
-				self.LoadTajima(filename)
-				self.CalcStitchExtent()
-				return
-		
-		raise ValueError("""I can't figure out what type of embroidery design is in this file. Please make sure that the file has the proper extension.""")
+		return FindCodec( filename ).Load( self, filename, mapped, chunksize )
 	
 	# -------------------------------------------------------------------
 	def Save(self, filename):
+		# Saves in the format that goes with the extension of filename
 		self.LastX	=	0
 		self.LastY	=	0
 		
-		if len(filename) > 4:
-			if filename[-4:] == '.dst':
-				return self.SaveTajima(filename)
+		return FindSaveCodec( filename ).Save( self, filename )
+	
+	# -------------------------------------------------------------------
+	def LoadTajima(self, filename, mapped = False):
+		self.ReadHeader( filename )
+		self.ReadColors( filename )
 		
-		raise ValueError("""I can't figure out what type of embroidery design is in this file. Please make sure that the file has the proper extension.""")
+		for chunk in StreamTajima( filename, mapped ):
+			self.AddStitches( chunk )
+	
+	# -------------------------------------------------------------------
+	def ReadHeader(self, filename):
+		# Keeps the DST header so saving writes its other fields back, and
+		# names the design after its label or else its file
+		self.Header = ReadTajimaHeader( filename ) or TajimaHeader()
+		self.Name = self.Header.Label or os.path.splitext( os.path.basename( filename ) )[0]
 	
 	# -------------------------------------------------------------------
-	def LoadTajima(self, filename):
+	def ReadColors(self, filename):
+		# Reads the thread colors from the .colors file kept next to a
+		# design, falling back to a random first color
 		self.Colors = []
 		
 		try:
-			f = file(filename + '.colors', 'r')		
-			
-			for l in f:
-				if len(l) >= 7:
-					r = int(l[1:3], 16)
-					g = int(l[3:5], 16)
-					b = int(l[5:7], 16)
-					self.Colors.append( (r, g, b) )
-			
-			f.close()
+			self.Colors = ReadThreadColors( filename + '.colors' )
 		except Exception, e:
 			print 'Could not read colors file: %s' % e
 		
-		f = file(filename, 'rb')
-		
-		header = f.read(512)
+		if not len(self.Colors):
+			self.Colors.append( self.RandomColor() )
 		
-		lines = header.split('\n')
+		# The first color is used before any color change is read
+		self.ColorsRead = 1
+	
+	# -------------------------------------------------------------------
+	def DecodeTajima(self, data):
+		# Decodes a whole stitch body in one call, continuing from the
+		# position left by the previous call
+		chunk, self.LastX, self.LastY, done = DecodeTajimaBlock( data, self.LastX, self.LastY )
+		self.AddStitches( chunk )
+	
+	# -------------------------------------------------------------------
+	def AddStitches(self, chunk):
+		# Appends a decoded StitchList, assigning colors to its color
+		# changes and keeping the jump and color change lists up to date
+		self.CommitTransform()
 		
-		values = {}
+		stitches	=	self.Stitches
+		base			=	len(stitches)
 		
-		for l in lines:
-			length = len(l)
+		for i in chunk.ColorChanges:
+			self.ColorsRead += 1
+			if self.ColorsRead > len(self.Colors):
+				self.Colors.append( self.RandomColor() )
 			
-			if length > 3:
-				if l[2] == ':':
-					values[ l[0:2] ] = l[3:]
+			self.ColorChanges.append( base + i )
+			stitches.ColorChanges.append( base + i )
+			stitches.ColorIndices.append( self.ColorsRead - 1 )
 		
-		f.seek(512)
+		jumps = [ base + i for i, flags in enumerate( chunk.Flags ) if flags == self.JUMP ]
 		
-		stitches = []
+		self.JumpStitches.extend( jumps )
+		self.JumpStitchCount	+=	len(jumps)
+		self.StitchCount			+=	len(chunk) - len(jumps) - len(chunk.ColorChanges)
 		
-		if not len(self.Colors):
-			self.Colors.append( self.RandomColor() )
-			self.ColorsRead += 1
+		stitches.X.extend( chunk.X )
+		stitches.Y.extend( chunk.Y )
+		stitches.Flags.extend( chunk.Flags )
 		
-		while True:
-			rec = f.read(3)
-			
-			# Bad record or end of file
-			if len(rec) < 3:
-				break
-			
-			b1 = ord(rec[0])
-			b2 = ord(rec[1])
-			b3 = ord(rec[2])
+		self.CurrentStitch = len(stitches)
+	
+	# -------------------------------------------------------------------
+	def DecodeTajimaRecords(self, data):
+		# Original record-at-a-time decoder, kept for BenchmarkTajima()
+		stitches = []
+		
+		for i in xrange(0, len(data) - 2, 3):
+			b1 = ord(data[i])
+			b2 = ord(data[i + 1])
+			b3 = ord(data[i + 2])
 			
 			# End of file
 			if b3 == 0xF3:
 				break
 			
-			self.Stitches.append( self.DecodeTajimaStitch(b1, b2, b3) )
+			stitches.append( self.DecodeTajimaStitch(b1, b2, b3) )
 			self.CurrentStitch += 1
 		
-		f.close()
-		
-		for s in self.Stitches:
+		for s in stitches:
 			if len(s) == 3:
 				if s[2] == self.COLOR:
 					continue
 			
 			s[1] = -s[1]
+			
+		for s in stitches:
+			self.Stitches.append( s )
 		
 	# -------------------------------------------------------------------
 	def DecodeTajimaStitch(self, b1, b2, b3):		
@@ -431,25 +1229,100 @@ class Design(object):
 		return rec.tostring()
 		
 	# -------------------------------------------------------------------
-	def SaveTajima(self, filename):
-		f = file(filename, 'wb')
+	def EncodeTajima(self, stitches, mergejumps = True):
+		# Encodes every stitch at once. The ternary digits of each delta
+		# come from the tables built by BuildTajimaEncodeTables(), the
+		# records are packed into one buffer and the Y axis is flipped
+		# back to the DST orientation that LoadTajima() reads.
+		# Takes a StitchList.
+		#
+		# Moves longer than a record can hold are split into the fewest
+		# equal records of the same kind. With mergejumps set, each chain
+		# of consecutive jumps is rewritten as the fewest records that get
+		# to where it ends, except that a chain long enough for machines
+		# to read as a trim keeps at least TAJIMA_TRIM_JUMPS records.
+		xtable	=	TAJIMA_ENCODE_X
+		ytable	=	TAJIMA_ENCODE_Y
+		limit		=	TAJIMA_MAX_MOVE
+		JUMP		=	self.JUMP
+		COLOR		=	self.COLOR
 		
-		for i in range(0, 512):
-			f.write(' ')
+		buf = array.array('B')
 		
-		f.seek(512)
+		# Positions here are in design coordinates; Y is flipped per record
+		lastx = self.LastX
+		lasty = -self.LastY
 		
-		for s in self.Stitches:
-			f.write( self.EncodeTajimaStitch( s ) )
+		# Jumps waiting to be merged, and where the chain ends
+		chain = 0
+		chainx = lastx
+		chainy = lasty
 		
-		rec = array.array('c')
-		rec.append( chr(0) )
-		rec.append( chr(0) )
-		rec.append( chr(0xF3) )
+		for x, y, flags in itertools.chain( itertools.izip( stitches.X, stitches.Y, stitches.Flags ), 
+																				[ (0, 0, None) ] ):
+			if flags == JUMP and mergejumps:
+				chain += 1
+				chainx = x
+				chainy = y
+				continue
+			
+			if chain:
+				if chain >= TAJIMA_TRIM_JUMPS:
+					steps = TAJIMA_TRIM_JUMPS
+				else:
+					steps = 0
+				
+				for jx, jy in SplitMove( lastx, lasty, chainx, chainy, limit, steps ):
+					rec = 0x83 | xtable[jx - lastx + limit] | ytable[lasty - jy + limit]
+					buf.extend( (rec >> 16, (rec >> 8) & 0xFF, rec & 0xFF) )
+					lastx = jx
+					lasty = jy
+				
+				chain = 0
+			
+			if flags is None:
+				break
+			
+			if flags == COLOR:
+				buf.extend( (0x00, 0x00, 0xC3) )
+				continue
+			elif flags == JUMP:
+				base = 0x83
+			else:
+				base = 0x03
+			
+			dx = x - lastx
+			dy = lasty - y
+			
+			if dx > limit or dx < -limit or dy > limit or dy < -limit:
+				for sx, sy in SplitMove( lastx, lasty, x, y, limit ):
+					rec = base | xtable[sx - lastx + limit] | ytable[lasty - sy + limit]
+					buf.extend( (rec >> 16, (rec >> 8) & 0xFF, rec & 0xFF) )
+					lastx = sx
+					lasty = sy
+				continue
+			
+			rec = base | xtable[dx + limit] | ytable[dy + limit]
+			
+			buf.extend( (rec >> 16, (rec >> 8) & 0xFF, rec & 0xFF) )
+			
+			lastx = x
+			lasty = y
 		
-		f.write(rec.tostring())
-		f.close()
+		self.LastX = lastx
+		self.LastY = -lasty
 		
+		return buf.tostring()
+	
+	# -------------------------------------------------------------------
+	def SaveTajima(self, filename, mergejumps = True):
+		writer = TajimaWriter( self, filename, mergejumps )
+		writer.Write( self.Stitches )
+		writer.Close()
+	
+	# -------------------------------------------------------------------
+	def WriteColors(self, filename):
+		# Writes the .colors file kept next to formats without colors
 		f = file(filename + '.colors', 'w')
 		
 		for c in self.Colors:
@@ -458,547 +1331,3272 @@ class Design(object):
 		f.close()
 		
 	# -------------------------------------------------------------------
-	def Move(self, dx, dy):
-		for s in self.Stitches:
-			if len(s) == 3:
-				if s[2] == self.COLOR:
-					continue
-			
-			s[0] += dx
-			s[1] += dy			
+	def Center(self):
+		# Center of the untransformed extents carried along by the pending
+		# transform, so it is found without applying it and a chain of
+		# rotations all turn around the same point
+		stats = self.BaseStitches.GetStats()
+		
+		if stats.MinX is None:
+			return self.Matrix.Apply( 0, 0 )
+		
+		cx = stats.MinX + (stats.MaxX - stats.MinX) / 2
+		cy = stats.MinY + (stats.MaxY - stats.MinY) / 2
+		
+		return self.Matrix.Apply( cx, cy )
+	
+	# -------------------------------------------------------------------
+	def ApplyTransform(self, t):
+		# Composes t onto the pending transform in O(1). Call
+		# CalcStitchExtent() to bring the extents up to date.
+		if t.IsIdentity():
+			return
+		
+		self.Matrix		=	self.Matrix.Then( t )
+		self.Concrete	=	None
+	
+	# -------------------------------------------------------------------
+	def SetTransform(self, t):
+		# Replaces the pending transform outright, as UndoLog does
+		self.Matrix		=	t
+		self.Concrete	=	None
+	
+	# -------------------------------------------------------------------
+	def ReplaceStitches(self, start, end, stitches):
+		# Replaces records start to end of the untransformed stitches and
+		# returns the records that were removed
+		removed = self.BaseStitches.Replace( start, end, stitches )
+		self.Concrete = None
+		self.Recount()
+		return removed
+	
+	# -------------------------------------------------------------------
+	def Recount(self):
+		# Rebuilds the jump and color change lists after an edit
+		stitches = self.BaseStitches
+		
+		self.JumpStitches			=	[ i for i, flags in enumerate( stitches.Flags ) if flags == self.JUMP ]
+		self.JumpStitchCount	=	len(self.JumpStitches)
+		self.ColorChanges			=	list(stitches.ColorChanges)
+		self.StitchCount			=	len(stitches) - len(self.JumpStitches) - len(self.ColorChanges)
+		self.CurrentStitch		=	len(stitches)
+	
+	# -------------------------------------------------------------------
+	def Move(self, dx, dy):
+		self.ApplyTransform( Transform().Translate( dx, dy ) )
+	
+	# -------------------------------------------------------------------
+	def Rotate(self, angle):
+		# Rotates around the center of the design
+		cx, cy = self.Center()
+		self.ApplyTransform( Transform().Rotate( angle, cx, cy ) )
+	
+	# -------------------------------------------------------------------
+	def Scale(self, sx, sy = None):
+		cx, cy = self.Center()
+		self.ApplyTransform( Transform().Scale( sx, sy, cx, cy ) )
+	
+	# -------------------------------------------------------------------
+	def Mirror(self, horizontal = True):
+		cx, cy = self.Center()
+		self.ApplyTransform( Transform().Mirror( horizontal, cx, cy ) )
+	
+	# -------------------------------------------------------------------
+	def Optimize(self, profile = None):
+		# Reorders the stitch runs to cut down jumps and color changes, see
+		# OptimizeStitches(). Returns an OptimizeReport.
+		stitches, colors, report = OptimizeStitches( self.Stitches, self.Colors, profile )
+		
+		self.Stitches		=	stitches
+		self.Colors			=	colors
+		self.ColorsRead	=	len(colors)
+		self.Recount()
+		self.CalcStitchExtent()
+		
+		return report
+
+# Default location and size in bytes of the design cache
+DESIGN_CACHE_DIR		=	os.path.join( os.path.expanduser('~'), '.pyembroidery', 'cache' )
+DESIGN_CACHE_LIMIT	=	256 * 1024 * 1024
+
+# *********************************************************************
+class DesignCache(object):
+	# Keeps decoded designs and rendered thumbnails on disk, keyed by a
+	# hash of the design file and its .colors file, so an unchanged
+	# design is never parsed twice. An entry is the set of files named
+	# after its key. Using an entry touches it, and Evict() removes the
+	# least recently used entries once the cache is bigger than Limit.
+	VERSION	=	4
+	
+	# -------------------------------------------------------------------
+	def __init__(self, directory = None, limit = None):
+		if directory is None:
+			directory = DESIGN_CACHE_DIR
+		
+		if limit is None:
+			limit = DESIGN_CACHE_LIMIT
+		
+		self.Directory	=	directory
+		self.Limit			=	limit
+		self.Written		=	0
+		
+		MakeParentDirs( os.path.join(directory, '') )
+	
+	# -------------------------------------------------------------------
+	def Key(self, filename):
+		return HashDesign( filename )
+	
+	# -------------------------------------------------------------------
+	def StatKey(self, filename):
+		# Key from the path, size and modification time of a design and
+		# its .colors file, found without reading either
+		h = hashlib.sha1()
+		
+		for path in (filename, filename + '.colors'):
+			try:
+				st = os.stat(path)
+				h.update( '%s\0%s\0%r\0' % (os.path.abspath(path), st.st_size, st.st_mtime) )
+			except OSError:
+				h.update( '\0' )
+		
+		return h.hexdigest()
+	
+	# -------------------------------------------------------------------
+	def Seen(self, filename):
+		# Whether filename was stored and hasn't changed since, as far as
+		# its size and modification time tell. Hashing a big design reads
+		# all of it, so callers that can show the design while decoding
+		# only hash it up front when this says it is likely cached.
+		return os.path.exists( self.Path( self.StatKey(filename), '.seen' ) )
+	
+	# -------------------------------------------------------------------
+	def Path(self, key, suffix):
+		return os.path.join( self.Directory, key + suffix )
+	
+	# -------------------------------------------------------------------
+	def Fetch(self, key):
+		# The design stored under key, or None
+		path = self.Path(key, '.design')
+		
+		try:
+			f = file(path, 'rb')
+			try:
+				entry = cPickle.load(f)
+			finally:
+				f.close()
+		except Exception:
+			# Missing, or left half written by a crashed process
+			return None
+		
+		if entry.get('Version') != self.VERSION:
+			return None
+		
+		self.Touch( path )
+		
+		d = Design()
+		stitches = d.Stitches
+		
+		stitches.X.fromstring( entry['X'] )
+		stitches.Y.fromstring( entry['Y'] )
+		stitches.Flags.fromstring( entry['Flags'] )
+		stitches.ColorChanges.fromstring( entry['ColorChanges'] )
+		stitches.ColorIndices.fromstring( entry['ColorIndices'] )
+		stitches.Stats.__dict__.update( entry['Stats'] )
+		
+		jumps = array.array('i')
+		jumps.fromstring( entry['JumpStitches'] )
+		
+		d.Name						=	entry['Name']
+		d.Header.__dict__.update( entry['Header'] )
+		d.Colors					=	entry['Colors']
+		d.ColorsRead			=	entry['ColorsRead']
+		d.StitchCount			=	entry['StitchCount']
+		d.JumpStitchCount	=	len(jumps)
+		d.JumpStitches		=	jumps.tolist()
+		d.ColorChanges		=	stitches.ColorChanges.tolist()
+		d.CurrentStitch		=	len(stitches)
+		
+		d.CalcStitchExtent()
+		return d
+	
+	# -------------------------------------------------------------------
+	def Store(self, key, d, filename = None):
+		# Stores d under key, and notes filename as Seen() if given
+		stitches = d.Stitches
+		
+		entry = {
+			'Version'					:	self.VERSION,
+			'X'								:	stitches.X.tostring(),
+			'Y'								:	stitches.Y.tostring(),
+			'Flags'						:	stitches.Flags.tostring(),
+			'ColorChanges'		:	stitches.ColorChanges.tostring(),
+			'ColorIndices'		:	stitches.ColorIndices.tostring(),
+			'Stats'						:	dict( stitches.GetStats().__dict__ ),
+			'Name'						:	d.Name,
+			'Header'					:	dict( d.Header.__dict__ ),
+			'Colors'					:	list(d.Colors),
+			'ColorsRead'			:	d.ColorsRead,
+			'StitchCount'			:	d.StitchCount,
+			'JumpStitches'		:	array.array('i', d.JumpStitches).tostring(),
+		}
+		
+		self.Write( self.Path(key, '.design'), cPickle.dumps(entry, 2) )
+		
+		if filename is not None:
+			self.Write( self.Path(self.StatKey(filename), '.seen'), key )
+	
+	# -------------------------------------------------------------------
+	def LoadDesign(self, filename, key = None):
+		# Loads a design, parsing it only if it isn't cached yet. key saves
+		# hashing the file again when the caller already has it.
+		if key is None:
+			key = self.Key(filename)
+		
+		d = self.Fetch(key)
+		
+		if d is None:
+			d = Design()
+			d.Load( filename, True )
+			self.Store( key, d, filename )
+		
+		return d
+	
+	# -------------------------------------------------------------------
+	def Thumbnail(self, filename, size):
+		# PNG data of a size x size preview, rendered only if it isn't
+		# cached yet
+		key = self.Key(filename)
+		path = self.Path(key, '.%d.png' % size)
+		
+		try:
+			f = file(path, 'rb')
+			data = f.read()
+			f.close()
+			self.Touch( path )
+			return data
+		except EnvironmentError:
+			pass
+		
+		d = self.Fetch(key)
+		
+		if d is None:
+			d = Design()
+			d.Load( filename, True )
+			self.Store( key, d, filename )
+		
+		data = EncodePNG( size, size, RenderDesign(d, size) )
+		self.Write( path, data )
+		return data
+	
+	# -------------------------------------------------------------------
+	def Write(self, path, data):
+		# Readers in other processes and threads must never see half a
+		# file, so write a private copy and rename it into place
+		tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+		
+		f = file(tmp, 'wb')
+		f.write( data )
+		f.close()
+		
+		try:
+			os.rename( tmp, path )
+		except OSError:
+			# Windows won't replace a file that another process just wrote
+			os.remove( tmp )
+		
+		# Scanning the directory is slow, so only evict now and then
+		self.Written += len(data)
+		
+		if self.Written > self.Limit / 16:
+			self.Evict()
+	
+	# -------------------------------------------------------------------
+	def Touch(self, path):
+		try:
+			os.utime( path, None )
+		except OSError:
+			pass
+	
+	# -------------------------------------------------------------------
+	def Evict(self):
+		self.Written = 0
+		
+		entries = {}
+		total = 0
+		
+		for name in os.listdir( self.Directory ):
+			if name.endswith('.tmp'):
+				continue
+			
+			path = os.path.join( self.Directory, name )
+			
+			try:
+				st = os.stat(path)
+			except OSError:
+				continue
+			
+			key = name.split('.')[0]
+			size, used, paths = entries.get( key, (0, 0, []) )
+			entries[key] = (size + st.st_size, max(used, st.st_mtime), paths + [path])
+			total += st.st_size
+		
+		oldest = sorted( [ (used, key) for key, (size, used, paths) in entries.iteritems() ] )
+		
+		for used, key in oldest:
+			if total <= self.Limit:
+				break
+			
+			size, used, paths = entries[key]
+			
+			for path in paths:
+				try:
+					os.remove( path )
+				except OSError:
+					pass
+			
+			total -= size
+	
+	# -------------------------------------------------------------------
+	def Clear(self):
+		for name in os.listdir( self.Directory ):
+			try:
+				os.remove( os.path.join(self.Directory, name) )
+			except OSError:
+				pass
+		
+		self.Written = 0
+
+# Steps kept by an UndoLog, and stitch records its edits may hold
+# before the oldest steps are dropped
+UNDO_LIMIT	=	200
+UNDO_BUDGET	=	1 << 20
+
+# *********************************************************************
+class TransformEdit(object):
+	# The pending transform of a design before and after an edit. Whole
+	# matrices are kept, so undoing never accumulates rounding.
+	Size	=	0
+	
+	# -------------------------------------------------------------------
+	def __init__(self, before, after):
+		self.Before	=	before
+		self.After	=	after
+	
+	# -------------------------------------------------------------------
+	def Undo(self, d):
+		d.SetTransform( self.Before )
+	
+	# -------------------------------------------------------------------
+	def Redo(self, d):
+		d.SetTransform( self.After )
+	
+	# -------------------------------------------------------------------
+	def Merge(self, edit):
+		# Folds a following transform into this one
+		if not isinstance(edit, TransformEdit) or edit.Before is not self.After:
+			return False
+		
+		self.After = edit.After
+		return True
+
+# *********************************************************************
+class ColorEdit(object):
+	# One entry of the color table before and after an edit
+	Size	=	0
+	
+	# -------------------------------------------------------------------
+	def __init__(self, index, before, after):
+		self.Index	=	index
+		self.Before	=	before
+		self.After	=	after
+	
+	# -------------------------------------------------------------------
+	def Undo(self, d):
+		d.Colors[self.Index] = self.Before
+	
+	# -------------------------------------------------------------------
+	def Redo(self, d):
+		d.Colors[self.Index] = self.After
+	
+	# -------------------------------------------------------------------
+	def Merge(self, edit):
+		if not isinstance(edit, ColorEdit) or edit.Index != self.Index:
+			return False
+		
+		self.After = edit.After
+		return True
+
+# *********************************************************************
+class StitchEdit(object):
+	# Records starting at Start that were replaced, and what replaced
+	# them, in untransformed coordinates. Only the edited range is kept.
+	
+	# -------------------------------------------------------------------
+	def __init__(self, start, removed, inserted):
+		self.Start		=	start
+		self.Removed	=	removed
+		self.Inserted	=	inserted
+		self.Size			=	len(removed) + len(inserted)
+	
+	# -------------------------------------------------------------------
+	def Undo(self, d):
+		d.ReplaceStitches( self.Start, self.Start + len(self.Inserted), self.Removed )
+	
+	# -------------------------------------------------------------------
+	def Redo(self, d):
+		d.ReplaceStitches( self.Start, self.Start + len(self.Removed), self.Inserted )
+	
+	# -------------------------------------------------------------------
+	def Merge(self, edit):
+		return False
+
+# =================================================================
+def StepSize(step):
+	# Records held by the edits of one undo step
+	return sum([ edit.Size for edit in step ])
+
+# *********************************************************************
+class UndoLog(object):
+	# Undo and redo history of a design, made of small reversible edits
+	# instead of copies of the design. The edits made between two calls
+	# to Checkpoint() form one step, which Undo() and Redo() take back or
+	# replay as a whole. Within a step, consecutive edits of the same
+	# kind collapse into one, so a drag made of many moves costs no more
+	# than a single move. Only the newest Limit steps are kept, and older
+	# steps are dropped once their stitch edits hold more than Budget
+	# records, so memory stays flat however long the session runs. Size
+	# is the number of records held by the steps that can be undone.
+	#
+	# Undoing a step only reverses its own edits, each of which holds
+	# just the range or matrix it changed, so the cost of an undo is the
+	# size of that step however long the history is, and no snapshots
+	# of the design are needed to bound it.
+	#
+	# All edits to a design must go through the log while it is in use.
+	
+	# -------------------------------------------------------------------
+	def __init__(self, limit = None, budget = None):
+		if limit is None:
+			limit = UNDO_LIMIT
+		
+		if budget is None:
+			budget = UNDO_BUDGET
+		
+		self.Limit	=	limit
+		self.Budget	=	budget
+		self.Clear()
+	
+	# -------------------------------------------------------------------
+	def Clear(self):
+		self.Done		=	[]
+		self.Undone	=	[]
+		self.Step		=	None
+		self.Size		=	0
+	
+	# -------------------------------------------------------------------
+	def Add(self, edit):
+		# Records an edit that has already been made
+		self.Undone = []
+		
+		if self.Step is None:
+			self.Step = []
+			self.Done.append( self.Step )
+		
+		if not self.Step or not self.Step[-1].Merge( edit ):
+			self.Step.append( edit )
+			self.Size += edit.Size
+		
+		self.Trim()
+	
+	# -------------------------------------------------------------------
+	def Checkpoint(self):
+		# Ends the current step
+		self.Step = None
+	
+	# -------------------------------------------------------------------
+	def Trim(self):
+		while len(self.Done) > 1 and (len(self.Done) > self.Limit or self.Size > self.Budget):
+			self.Size -= StepSize( self.Done.pop(0) )
+	
+	# -------------------------------------------------------------------
+	def CanUndo(self):
+		return len(self.Done) > 0
+	
+	# -------------------------------------------------------------------
+	def CanRedo(self):
+		return len(self.Undone) > 0
+	
+	# -------------------------------------------------------------------
+	def Undo(self, d):
+		self.Step = None
+		
+		if not self.Done:
+			return False
+		
+		step = self.Done.pop()
+		
+		for edit in reversed(step):
+			edit.Undo( d )
+		
+		self.Size -= StepSize( step )
+		self.Undone.append( step )
+		return True
+	
+	# -------------------------------------------------------------------
+	def Redo(self, d):
+		self.Step = None
+		
+		if not self.Undone:
+			return False
+		
+		step = self.Undone.pop()
+		
+		for edit in step:
+			edit.Redo( d )
+		
+		self.Size += StepSize( step )
+		self.Done.append( step )
+		return True
+	
+	# -------------------------------------------------------------------
+	def Transform(self, d, action, *args):
+		# Calls one of the transform methods of d, such as d.Rotate, and
+		# records what it did
+		before = d.Matrix
+		action( *args )
+		
+		if d.Matrix is not before:
+			self.Add( TransformEdit( before, d.Matrix ) )
+	
+	# -------------------------------------------------------------------
+	def SetColor(self, d, index, color):
+		before = d.Colors[index]
+		d.Colors[index] = color
+		self.Add( ColorEdit( index, before, color ) )
+	
+	# -------------------------------------------------------------------
+	def ReplaceStitches(self, d, start, end, stitches):
+		# Replaces records start to end of the untransformed stitches
+		inserted = stitches.Slice( 0, len(stitches) )
+		removed = d.ReplaceStitches( start, end, inserted )
+		self.Add( StitchEdit( start, removed, inserted ) )
+
+# =================================================================
+def GetDesignCache(directory = None, limit = None):
+	# One DesignCache per location and process, so that eviction keeps
+	# track of what the whole process has written
+	key = (directory, limit)
+	
+	if key not in DESIGN_CACHES:
+		DESIGN_CACHES[key] = DesignCache( directory, limit )
+	
+	return DESIGN_CACHES[key]
+
+DESIGN_CACHES	=	{}
+
+# =================================================================
+def HashDesign(filename):
+	# Hash of a design's contents, its .colors file and the extension it
+	# is read by, which changes whenever the loaded design would
+	h = hashlib.sha1()
+	h.update( os.path.splitext(filename)[1].lower() )
+	
+	f = file(filename, 'rb')
+	
+	while True:
+		data = f.read(1 << 20)
+		if not data:
+			break
+		h.update( data )
+	
+	f.close()
+	
+	try:
+		f = file(filename + '.colors', 'rb')
+		h.update( '\0' + f.read() )
+		f.close()
+	except EnvironmentError:
+		pass
+	
+	return h.hexdigest()
+
+# =================================================================
+def ReadThreadColors(filename):
+	# The colors listed in a .colors file as (r, g, b) tuples, one
+	# '#RRGGBB' line per thread
+	colors = []
+	
+	f = file(filename, 'r')
+	
+	for l in f:
+		if len(l) >= 7:
+			r = int(l[1:3], 16)
+			g = int(l[3:5], 16)
+			b = int(l[5:7], 16)
+			colors.append( (r, g, b) )
+	
+	f.close()
+	
+	return colors
+
+# Default location of the design catalog
+CATALOG_PATH	=	os.path.join( os.path.expanduser('~'), '.pyembroidery', 'catalog.db' )
+
+# *********************************************************************
+class DesignCatalog(object):
+	# A SQLite index of design files for finding them by size, colors
+	# and stitch count without loading any. Update() walks the given
+	# paths and reindexes, on a process pool, only designs whose file or
+	# .colors file changed since they were indexed. A design whose
+	# contents still hash the same is only restamped.
+	#
+	# Sizes and extents are in 0.1 mm and colors counts threads. Rows
+	# are returned by Query() as dicts keyed by column.
+	VERSION	=	1
+	
+	COLUMNS = (
+		('path',					'TEXT PRIMARY KEY'),
+		('mtime',					'REAL'),
+		('size',					'INTEGER'),
+		('colors_mtime',	'REAL'),
+		('hash',					'TEXT'),
+		('name',					'TEXT'),
+		('header_stitches',	'INTEGER'),
+		('records',				'INTEGER'),
+		('stitches',			'INTEGER'),
+		('jumps',					'INTEGER'),
+		('trims',					'INTEGER'),
+		('color_changes',	'INTEGER'),
+		('colors',				'INTEGER'),
+		('width',					'INTEGER'),
+		('height',				'INTEGER'),
+		('min_x',					'INTEGER'),
+		('min_y',					'INTEGER'),
+		('max_x',					'INTEGER'),
+		('max_y',					'INTEGER'),
+		('thread_length',	'REAL'),
+		('palette',				'TEXT'),
+	)
+	
+	# -------------------------------------------------------------------
+	def __init__(self, path = None):
+		if path is None:
+			path = CATALOG_PATH
+		
+		if path != ':memory:':
+			MakeParentDirs( path )
+		
+		self.Path				=	path
+		self.Connection	=	sqlite3.connect( path )
+		
+		self.Connection.row_factory = sqlite3.Row
+		
+		if self.Connection.execute( 'PRAGMA user_version' ).fetchone()[0] != self.VERSION:
+			# Written by another version, so start over
+			self.Connection.execute( 'DROP TABLE IF EXISTS designs' )
+			self.Connection.execute( 'CREATE TABLE designs (%s)' % ', '.join( [ '%s %s' % c for c in self.COLUMNS ] ) )
+			self.Connection.execute( 'CREATE INDEX designs_size ON designs (width, height)' )
+			self.Connection.execute( 'CREATE INDEX designs_colors ON designs (colors, stitches)' )
+			self.Connection.execute( 'PRAGMA user_version = %d' % self.VERSION )
+			self.Connection.commit()
+	
+	# -------------------------------------------------------------------
+	def Close(self):
+		self.Connection.close()
+	
+	# -------------------------------------------------------------------
+	def __len__(self):
+		return self.Connection.execute( 'SELECT COUNT(*) FROM designs' ).fetchone()[0]
+	
+	# -------------------------------------------------------------------
+	def Update(self, paths, processes = None, cache = None, report = None):
+		# Brings the designs found under paths up to date and forgets
+		# indexed designs that no longer exist. cache is a (directory,
+		# limit) DesignCache to load through, and report is called with
+		# the IndexDesign() result of each design that was looked at.
+		# Returns those results.
+		db = self.Connection
+		
+		known = {}
+		
+		for row in db.execute( 'SELECT path, mtime, size, colors_mtime, hash FROM designs' ):
+			known[ row[0] ] = ( (row[1], row[2], row[3]), row[4] )
+		
+		jobs = []
+		found = set()
+		
+		for path, name in ExpandDesignPaths( paths ):
+			path = os.path.abspath( path )
+			found.add( path )
+			
+			stamp, oldhash = known.get( path, (None, None) )
+			
+			try:
+				if stamp == DesignStamp( path ):
+					continue
+			except EnvironmentError:
+				pass
+			
+			jobs.append( (path, oldhash, cache) )
+		
+		missing = [ (path,) for path in known if path not in found and not os.path.exists(path) ]
+		db.executemany( 'DELETE FROM designs WHERE path = ?', missing )
+		
+		names = [ c[0] for c in self.COLUMNS ]
+		insert = 'INSERT OR REPLACE INTO designs (%s) VALUES (%s)' % ( ', '.join(names), ', '.join( '?' * len(names) ) )
+		
+		def Store(result):
+			path, row, seconds, error = result
+			
+			if error:
+				db.execute( 'DELETE FROM designs WHERE path = ?', (path,) )
+			elif 'name' in row:
+				db.execute( insert, [ row[n] for n in names ] )
+			else:
+				# Same contents, so only the stamp is out of date
+				db.execute( 'UPDATE designs SET mtime = ?, size = ?, colors_mtime = ? WHERE path = ?',
+					(row['mtime'], row['size'], row['colors_mtime'], path) )
+			
+			if report:
+				report( result )
+		
+		try:
+			results = BatchConvert( jobs, processes, Store, IndexDesign )
+		finally:
+			db.commit()
+		
+		return results
+	
+	# -------------------------------------------------------------------
+	def Query(self, maxwidth = None, maxheight = None, maxcolors = None, maxstitches = None, name = None, limit = None):
+		# Designs within all the limits given, sorted by path. name
+		# matches part of the design name or path.
+		where	=	[]
+		args	=	[]
+		
+		for column, value in ( ('width', maxwidth), ('height', maxheight), ('colors', maxcolors), ('stitches', maxstitches) ):
+			if value is not None:
+				where.append( '%s <= ?' % column )
+				args.append( value )
+		
+		if name:
+			where.append( '(name LIKE ? OR path LIKE ?)' )
+			args.extend( [ '%' + name + '%' ] * 2 )
+		
+		sql = 'SELECT * FROM designs'
+		
+		if where:
+			sql += ' WHERE ' + ' AND '.join( where )
+		
+		sql += ' ORDER BY path'
+		
+		if limit is not None:
+			sql += ' LIMIT %d' % limit
+		
+		return [ dict(row) for row in self.Connection.execute( sql, args ) ]
+
+# Stitches per minute by stitch length in 0.1 mm units, and the other
+# costs of a typical machine, used when no MachineProfile is given
+MACHINE_SPM									=	( (0, 1000), (30, 1000), (50, 900), (70, 750), (100, 600), (121, 500) )
+MACHINE_JUMP_SPM						=	1000
+MACHINE_TRIM_SECONDS				=	5.0
+MACHINE_COLOR_CHANGE_SECONDS	=	8.0
+
+# *********************************************************************
+class MachineProfile(object):
+	# Speeds and fixed costs of an embroidery machine. SPM is a list of
+	# (stitch length, stitches per minute) points, by length in 0.1 mm
+	# units; speeds in between are interpolated and lengths beyond the
+	# ends get the speed of the nearest end.
+	
+	# -------------------------------------------------------------------
+	def __init__(self, spm = None, jumpspm = None, trimseconds = None, colorchangeseconds = None):
+		if spm is None:
+			spm = MACHINE_SPM
+		
+		if jumpspm is None:
+			jumpspm = MACHINE_JUMP_SPM
+		
+		if trimseconds is None:
+			trimseconds = MACHINE_TRIM_SECONDS
+		
+		if colorchangeseconds is None:
+			colorchangeseconds = MACHINE_COLOR_CHANGE_SECONDS
+		
+		self.SPM								=	sorted(spm)
+		self.JumpSPM						=	jumpspm
+		self.TrimSeconds				=	trimseconds
+		self.ColorChangeSeconds	=	colorchangeseconds
+	
+	# -------------------------------------------------------------------
+	def StitchesPerMinute(self, length):
+		points = self.SPM
+		k = bisect.bisect_right( points, (length, float('inf')) )
+		
+		if k == 0:
+			return points[0][1]
+		
+		if k == len(points):
+			return points[-1][1]
+		
+		l0, s0 = points[k - 1]
+		l1, s1 = points[k]
+		
+		return s0 + (s1 - s0) * (length - l0) / float(l1 - l0)
+
+# *********************************************************************
+class SewTimeEstimate(object):
+	# Time in seconds a design takes to sew, split by where it goes
+	
+	# -------------------------------------------------------------------
+	def __init__(self):
+		self.Stitches						=	0
+		self.Jumps							=	0
+		self.Trims							=	0
+		self.ColorChanges				=	0
+		self.StitchSeconds			=	0.0
+		self.JumpSeconds				=	0.0
+		self.TrimSeconds				=	0.0
+		self.ColorChangeSeconds	=	0.0
+		self.TotalSeconds				=	0.0
+	
+	# -------------------------------------------------------------------
+	def __str__(self):
+		return '%d:%02d to sew: %s stitches %.0f s, %s jumps %.0f s, %s trims %.0f s, %s color changes %.0f s' % (
+			int(self.TotalSeconds) // 60, int(self.TotalSeconds) % 60,
+			self.Stitches, self.StitchSeconds, self.Jumps, self.JumpSeconds,
+			self.Trims, self.TrimSeconds, self.ColorChanges, self.ColorChangeSeconds )
+
+# =================================================================
+def EstimateSewTime(stats, profile = None):
+	# Sewing time from the StitchStats of a design. The stitches are
+	# timed from the histogram of their lengths, so this costs the same
+	# however many stitches there are.
+	if profile is None:
+		profile = MachineProfile()
+	
+	estimate = SewTimeEstimate()
+	
+	estimate.Stitches			=	stats.StitchCount
+	estimate.Jumps				=	stats.JumpCount
+	estimate.Trims				=	stats.TrimCount
+	estimate.ColorChanges	=	stats.ColorChangeCount
+	
+	estimate.StitchSeconds = sum([ 60.0 * count / profile.StitchesPerMinute(length) 
+																	for length, count in stats.Lengths.iteritems() ])
+	estimate.JumpSeconds				=	60.0 * stats.JumpCount / profile.JumpSPM
+	estimate.TrimSeconds				=	stats.TrimCount * profile.TrimSeconds
+	estimate.ColorChangeSeconds	=	stats.ColorChangeCount * profile.ColorChangeSeconds
+	
+	estimate.TotalSeconds = (estimate.StitchSeconds + estimate.JumpSeconds 
+														+ estimate.TrimSeconds + estimate.ColorChangeSeconds)
+	
+	return estimate
+
+# Pairs of runs further apart than this in the visiting order are not
+# tried by the 2-opt pass, which keeps it near linear on big blocks
+OPTIMIZE_WINDOW	=	48
+OPTIMIZE_PASSES	=	8
+
+# *********************************************************************
+class OptimizeReport(object):
+	# What OptimizeStitches() changed. Travel is the jump distance in
+	# 0.1 mm units along the longer axis, which is what the pantograph
+	# has to cover.
+	
+	# -------------------------------------------------------------------
+	def __init__(self):
+		self.JumpsBefore						=	0
+		self.JumpsAfter							=	0
+		self.TravelBefore						=	0
+		self.TravelAfter						=	0
+		self.ColorChangesBefore			=	0
+		self.ColorChangesAfter			=	0
+		self.SecondsSaved						=	0.0
+	
+	# -------------------------------------------------------------------
+	def __str__(self):
+		return 'jumps %s -> %s, travel %s -> %s, color changes %s -> %s, about %.1f s saved' % (
+			self.JumpsBefore, self.JumpsAfter, self.TravelBefore, self.TravelAfter,
+			self.ColorChangesBefore, self.ColorChangesAfter, self.SecondsSaved )
+
+# =================================================================
+def SplitMove(x0, y0, x1, y1, limit = None, steps = 1):
+	# Points of the fewest equal steps, but no fewer than steps, of at
+	# most limit units on each axis that lead from (x0, y0) to (x1, y1).
+	# Ends at (x1, y1) unless steps is 0 and there is nowhere to go.
+	if limit is None:
+		limit = TAJIMA_MAX_MOVE
+	
+	dx = x1 - x0
+	dy = y1 - y0
+	n = max( steps, (max(abs(dx), abs(dy)) + limit - 1) // limit )
+	
+	if not n:
+		return []
+	
+	return [ (x0 + (2 * dx * k + n) // (2 * n), y0 + (2 * dy * k + n) // (2 * n)) 
+						for k in xrange(1, n + 1) ]
+
+# =================================================================
+def StitchRuns(stitches, start, end, trims = None):
+	# Splits records start to end into the runs of stitches between
+	# jumps. Each run is a list of points that begins where the needle
+	# has to be before its first stitch. If trims is given, whether the
+	# jumps into each run were a trim is appended to it.
+	X			=	stitches.X
+	Y			=	stitches.Y
+	Flags	=	stitches.Flags
+	JUMP	=	Design.JUMP
+	
+	runs	=	[]
+	run		=	None
+	jumps	=	0
+	pos		=	stitches.Position(start)
+	
+	for i in xrange(start, end):
+		flags = Flags[i]
+		
+		if flags == JUMP:
+			if run:
+				runs.append( run )
+				run = None
+			jumps += 1
+		elif flags == 0:
+			if run is None:
+				run = [ pos ]
+				if trims is not None:
+					trims.append( jumps >= TAJIMA_TRIM_JUMPS )
+			run.append( (X[i], Y[i]) )
+			jumps = 0
+		
+		pos = (X[i], Y[i])
+	
+	if run:
+		runs.append( run )
+	
+	return runs
+
+# =================================================================
+def Travel(a, b):
+	# Jump distance between two points along the longer axis
+	return max( abs(a[0] - b[0]), abs(a[1] - b[1]) )
+
+# =================================================================
+def RunsTravel(runs, order, pos, end = None):
+	# Jump distance of visiting the runs in order from pos, and on to end
+	# if given
+	total = 0
+	
+	for k in order:
+		total += Travel( pos, runs[k][0] )
+		pos = runs[k][-1]
+	
+	if end is not None:
+		total += Travel( pos, end )
+	
+	return total
+
+# =================================================================
+def HopSeconds(runs, trims, order, pos, end = None, profile = None):
+	# Machine time of the jumps visiting the runs in order from pos, and
+	# on to end if given, written as OptimizeStitches() writes them. A
+	# hop that takes TAJIMA_TRIM_JUMPS jumps or more is sewn as a trim
+	# whether or not it was one, so it costs a trim as well.
+	if profile is None:
+		profile = MachineProfile()
+	
+	hops = []
+	
+	for k in order:
+		hops.append( (pos, runs[k][0], trims[k]) )
+		pos = runs[k][-1]
+	
+	if end is not None:
+		hops.append( (pos, end, False) )
+	
+	total = 0.0
+	
+	for a, b, trim in hops:
+		if trim:
+			jumps = max( TAJIMA_TRIM_JUMPS, -(-Travel( a, b ) // TAJIMA_MAX_MOVE) )
+		else:
+			jumps = -(-Travel( a, b ) // TAJIMA_MAX_MOVE)
+		
+		total += 60.0 * jumps / profile.JumpSPM
+		
+		if jumps >= TAJIMA_TRIM_JUMPS:
+			total += profile.TrimSeconds
+	
+	return total
+
+# =================================================================
+def OrderRuns(runs, pos, end = None):
+	# Visiting order of the runs starting from pos, and heading for end
+	# afterwards if given: nearest neighbor, then 2-opt. Runs are never reversed, so stitches keep their
+	# direction and the cost of turning a stretch of the order around
+	# comes from prefix sums of the forward and backward hops.
+	m = len(runs)
+	
+	if not m:
+		return []
+	
+	# The nearest run is found by searching a grid of run starts ring by
+	# ring around the needle, with about one run per cell
+	xs = [ run[0][0] for run in runs ]
+	ys = [ run[0][1] for run in runs ]
+	cell = max( 1, int( max(max(xs) - min(xs), max(ys) - min(ys)) / math.sqrt(m) ) )
+	
+	grid = {}
+	
+	for k in xrange(m):
+		key = (xs[k] // cell, ys[k] // cell)
+		if key in grid:
+			grid[key].append( k )
+		else:
+			grid[key] = [ k ]
+	
+	left = set( xrange(m) )
+	order = []
+	here = pos
+	
+	while left:
+		cx = here[0] // cell
+		cy = here[1] // cell
+		best = None
+		bestd = None
+		r = 0
+		
+		# Runs outside the rings searched so far are more than (r - 1) *
+		# cell away
+		while best is None or bestd > (r - 1) * cell:
+			if 8 * r > len(left):
+				# Few runs left and far away, so just look at them all
+				best = min( left, key = lambda k: Travel( here, runs[k][0] ) )
+				break
+			
+			for gx in xrange(cx - r, cx + r + 1):
+				for gy in xrange(cy - r, cy + r + 1):
+					if max(abs(gx - cx), abs(gy - cy)) != r:
+						continue
+					
+					for k in grid.get( (gx, gy), () ):
+						d = Travel( here, runs[k][0] )
+						if bestd is None or d < bestd:
+							best, bestd = k, d
+			
+			r += 1
+		
+		grid[(xs[best] // cell, ys[best] // cell)].remove( best )
+		left.remove( best )
+		order.append( best )
+		here = runs[best][-1]
+	
+	def Hops():
+		# Running totals of the hops between neighbours in the order, as
+		# visited and with each pair swapped round
+		forward		=	[0]
+		backward	=	[0]
+		
+		for k in xrange(m - 1):
+			a = runs[order[k]]
+			b = runs[order[k + 1]]
+			forward.append( forward[-1] + Travel( a[-1], b[0] ) )
+			backward.append( backward[-1] + Travel( b[-1], a[0] ) )
+		
+		return forward, backward
+	
+	for npass in xrange(OPTIMIZE_PASSES):
+		improved = False
+		forward, backward = Hops()
+		
+		for i in xrange(m - 1):
+			j = i + 1
+			
+			while j < min(m, i + OPTIMIZE_WINDOW):
+				if i:
+					before = runs[order[i - 1]][-1]
+				else:
+					before = pos
+				
+				a = runs[order[i]]
+				b = runs[order[j]]
+				
+				old = Travel( before, a[0] ) + forward[j] - forward[i]
+				new = Travel( before, b[0] ) + backward[j] - backward[i]
+				
+				if j + 1 < m:
+					after = runs[order[j + 1]][0]
+				else:
+					after = end
+				
+				if after is not None:
+					old += Travel( b[-1], after )
+					new += Travel( a[-1], after )
+				
+				if new < old:
+					order[i:j + 1] = order[i:j + 1][::-1]
+					forward, backward = Hops()
+					improved = True
+				
+				j += 1
+		
+		if not improved:
+			break
+	
+	return order
+
+# =================================================================
+def OptimizeStitches(stitches, colors, profile = None):
+	# Rewrites a StitchList to spend less time jumping and changing
+	# thread. Within each color block the runs of stitches between jumps
+	# are put in a shorter visiting order, and a block is merged into an
+	# earlier block of the same thread color when nothing stitched in
+	# between overlaps it, so layering is unchanged. Every stitch keeps
+	# its place and direction; only jumps and color changes are
+	# rewritten, as the fewest records DST allows.
+	#
+	# Returns (stitches, colors, report), with colors listing the thread
+	# of every block in order as the .colors file expects.
+	report = OptimizeReport()
+	
+	for x, y, flags in itertools.izip( stitches.X, stitches.Y, stitches.Flags ):
+		if flags == Design.JUMP:
+			report.JumpsBefore += 1
+	
+	report.TravelBefore = sum([ Travel( stitches.Position(i), (stitches.X[i], stitches.Y[i]) ) 
+															for i, flags in enumerate( stitches.Flags ) if flags == Design.JUMP ])
+	report.ColorChangesBefore = len(stitches.ColorChanges)
+	
+	# [color, runs, (minx, miny, maxx, maxy), trims] for each block
+	blocks = []
+	
+	for color, start, end in stitches.ColorBlocks():
+		trims = []
+		runs = StitchRuns( stitches, start, end, trims )
+		
+		if not runs:
+			continue
+		
+		if color < len(colors):
+			thread = tuple(colors[color])
+		else:
+			thread = None
+		
+		# The first stitch of a run is sewn from where the run starts
+		xs = [ p[0] for run in runs for p in run ]
+		ys = [ p[1] for run in runs for p in run ]
+		box = (min(xs), min(ys), max(xs), max(ys))
+		
+		# Latest earlier block of the same thread that this one can join
+		# without moving above anything it overlaps
+		target = None
+		
+		for k in range(len(blocks) - 1, -1, -1):
+			if thread is not None and blocks[k][0] == thread:
+				target = k
+				break
+			
+			other = blocks[k][2]
+			
+			if not (box[2] < other[0] or box[0] > other[2] or box[3] < other[1] or box[1] > other[3]):
+				break
+		
+		if target is None:
+			blocks.append( [thread, runs, box, trims] )
+		else:
+			block = blocks[target]
+			block[1] = block[1] + runs
+			block[3] = block[3] + trims
+			old = block[2]
+			block[2] = (min(old[0], box[0]), min(old[1], box[1]), max(old[2], box[2]), max(old[3], box[3]))
+	
+	out = StitchList()
+	threads = []
+	pos = (0, 0)
+	
+	for n, (thread, runs, box, trims) in enumerate(blocks):
+		if threads:
+			out.Add( pos[0], pos[1], Design.COLOR, len(threads) )
+		
+		threads.append( thread or Design().RandomColor() )
+		
+		# Head for where the next block starts, so a better order here
+		# doesn't leave a longer jump into it
+		if n + 1 < len(blocks):
+			end = blocks[n + 1][1][0][0]
+		else:
+			end = None
+		
+		order = OrderRuns( runs, pos, end )
+		
+		# Keep the original order if the heuristics couldn't beat it. The
+		# order is found by travel alone, so it is checked against the
+		# time of its jumps too, as a hop that was never trimmed can now
+		# be long enough to take a trim.
+		original = range(len(runs))
+		
+		if ((HopSeconds( runs, trims, order, pos, end, profile ), RunsTravel( runs, order, pos, end )) 
+				>= (HopSeconds( runs, trims, original, pos, end, profile ), RunsTravel( runs, original, pos, end ))):
+			order = original
+		
+		for k in order:
+			run = runs[k]
+			
+			# A run that was reached by a trim still is, wherever it
+			# moves in the order
+			if trims[k]:
+				steps = TAJIMA_TRIM_JUMPS
+			else:
+				steps = 1
+			
+			if run[0] != pos or trims[k]:
+				for x, y in SplitMove( pos[0], pos[1], run[0][0], run[0][1], None, steps ):
+					out.Add( x, y, Design.JUMP )
+					report.JumpsAfter += 1
+				
+				report.TravelAfter += Travel( pos, run[0] )
+			
+			for x, y in run[1:]:
+				out.Add( x, y )
+			
+			pos = run[-1]
+	
+	report.ColorChangesAfter = len(out.ColorChanges)
+	report.SecondsSaved = (EstimateSewTime( stitches.GetStats(), profile ).TotalSeconds 
+												- EstimateSewTime( out.GetStats(), profile ).TotalSeconds)
+	
+	if report.SecondsSaved <= 0:
+		# Blocks are ordered one at a time, so on an already tidy design
+		# the whole can come out worse; leave such designs alone
+		unchanged = OptimizeReport()
+		unchanged.JumpsBefore = unchanged.JumpsAfter = report.JumpsBefore
+		unchanged.TravelBefore = unchanged.TravelAfter = report.TravelBefore
+		unchanged.ColorChangesBefore = unchanged.ColorChangesAfter = report.ColorChangesBefore
+		
+		return stitches.Slice( 0, len(stitches) ), list(colors), unchanged
+	
+	return out, threads, report
+
+# =================================================================
+def SegmentDistance(px, py, x0, y0, x1, y1):
+	# Distance from point (px, py) to the segment from (x0, y0) to (x1, y1)
+	dx = x1 - x0
+	dy = y1 - y0
+	length = dx * dx + dy * dy
+	
+	if length:
+		t = max(0.0, min(1.0, ((px - x0) * dx + (py - y0) * dy) / float(length)))
+	else:
+		t = 0.0
+	
+	return math.hypot( px - (x0 + t * dx), py - (y0 + t * dy) )
+
+# Weight of every bit in a DST stitch record as (byte, mask, dx, dy)
+TAJIMA_BITS = (
+	(0, 0x01, 1, 0), (0, 0x02, -1, 0), (0, 0x04, 9, 0), (0, 0x08, -9, 0),
+	(0, 0x80, 0, 1), (0, 0x40, 0, -1), (0, 0x20, 0, 9), (0, 0x10, 0, -9),
+	(1, 0x01, 3, 0), (1, 0x02, -3, 0), (1, 0x04, 27, 0), (1, 0x08, -27, 0),
+	(1, 0x80, 0, 3), (1, 0x40, 0, -3), (1, 0x20, 0, 27), (1, 0x10, 0, -27),
+	(2, 0x04, 81, 0), (2, 0x08, -81, 0), (2, 0x20, 0, 81), (2, 0x10, 0, -81),
+)
+
+# Largest move a single DST record can hold (81 + 27 + 9 + 3 + 1)
+TAJIMA_MAX_MOVE	=	121
+
+# Machines commonly cut the thread after this many jumps in a row
+TAJIMA_TRIM_JUMPS	=	3
+
+# Size in bytes of the header in front of the DST stitch records
+TAJIMA_HEADER_SIZE	=	512
+
+# *********************************************************************
+class TajimaHeader(object):
+	# The fields of a DST header. Each is written as 'XX:value' followed
+	# by a carriage return, a 0x1A byte ends the list and spaces pad it
+	# to TAJIMA_HEADER_SIZE. Extents and the end position are in 0.1 mm
+	# from where the design starts, with +Y pointing up as in the file.
+	# Colors is the number of color changes, not of threads. Fields this
+	# class doesn't know about are kept in Extra and written back.
+	
+	# Field, attribute and whether it holds a signed number, in the
+	# order they are written
+	FIELDS = (
+		('LA', 'Label', None),
+		('ST', 'Stitches', False),
+		('CO', 'Colors', False),
+		('+X', 'PlusX', False),
+		('-X', 'MinusX', False),
+		('+Y', 'PlusY', False),
+		('-Y', 'MinusY', False),
+		('AX', 'EndX', True),
+		('AY', 'EndY', True),
+		('MX', 'PreviousX', True),
+		('MY', 'PreviousY', True),
+		('PD', 'PreviousFile', None),
+	)
+	
+	# -------------------------------------------------------------------
+	def __init__(self):
+		self.Label				=	''
+		self.Stitches			=	0
+		self.Colors				=	0
+		self.PlusX				=	0
+		self.MinusX				=	0
+		self.PlusY				=	0
+		self.MinusY				=	0
+		self.EndX					=	0
+		self.EndY					=	0
+		self.PreviousX		=	0
+		self.PreviousY		=	0
+		self.PreviousFile	=	'******'
+		self.Extra				=	[]
+	
+	# -------------------------------------------------------------------
+	def Parse(self, data):
+		# Reads the fields out of the header data. Returns False if it
+		# holds no stitch count, as in files saved with a blank header.
+		fields = dict( (key, (name, signed)) for key, name, signed in self.FIELDS )
+		found = False
+		
+		end = data.find('\x1a')
+		
+		if end >= 0:
+			data = data[:end]
+		
+		# Some writers end the fields with line feeds instead
+		for l in data.replace('\n', '\r').split('\r'):
+			if len(l) < 3 or l[2] != ':':
+				continue
+			
+			key		=	l[0:2]
+			value	=	l[3:]
+			
+			if key not in fields:
+				self.Extra.append( (key, value) )
+				continue
+			
+			name, signed = fields[key]
+			
+			if signed is None:
+				setattr( self, name, value.strip() )
+				continue
+			
+			try:
+				setattr( self, name, int( value.replace(' ', '') ) )
+			except ValueError:
+				continue
+			
+			if key == 'ST':
+				found = True
+		
+		return found
+	
+	# -------------------------------------------------------------------
+	def Pack(self):
+		# The header as TAJIMA_HEADER_SIZE bytes
+		lines = []
+		
+		for key, name, signed in self.FIELDS:
+			value = getattr( self, name )
+			
+			if key == 'LA':
+				value = '%-16s' % value[:16]
+			elif signed is None:
+				value = value[:16]
+			elif signed:
+				value = max( -99999, min( 99999, value ) )
+				value = '%s%5d' % ( value < 0 and '-' or '+', abs(value) )
+			elif key == 'ST':
+				value = '%7d' % max( 0, min( 9999999, value ) )
+			elif key == 'CO':
+				value = '%3d' % max( 0, min( 999, value ) )
+			else:
+				value = '%5d' % max( 0, min( 99999, value ) )
+			
+			lines.append( '%s:%s\r' % ( key, value ) )
+		
+		data = ''.join( lines )
+		
+		# Unknown fields go after the known ones, as far as they fit
+		for key, value in self.Extra:
+			l = '%s:%s\r' % ( key, value )
+			
+			if len(data) + len(l) < TAJIMA_HEADER_SIZE:
+				data += l
+		
+		data += '\x1a'
+		
+		return data + ' ' * (TAJIMA_HEADER_SIZE - len(data))
+	
+	# -------------------------------------------------------------------
+	def SetBounds(self, minx, miny, maxx, maxy):
+		# Sets the extents from bounds in design coordinates, where Y
+		# points down. The start of the design is always inside them.
+		self.PlusX	=	max( 0, maxx )
+		self.MinusX	=	max( 0, -minx )
+		self.PlusY	=	max( 0, -miny )
+		self.MinusY	=	max( 0, maxy )
+	
+	# -------------------------------------------------------------------
+	def Bounds(self):
+		# The extents as (minx, miny, maxx, maxy) in design coordinates
+		return ( -self.MinusX, -self.PlusY, self.PlusX, self.MinusY )
+
+# =================================================================
+def BuildTajimaTables():
+	def Deltas(b, byte):
+		dx = 0
+		dy = 0
+		for i, mask, x, y in TAJIMA_BITS:
+			if i == byte and b & mask:
+				dx += x
+				dy += y
+		return dx, dy
+	
+	low = [ Deltas(b, 0) for b in range(0, 256) ]
+	mid = [ Deltas(b, 1) for b in range(0, 256) ]
+	
+	# The first two bytes are combined into one 16-bit index
+	dx12 = [ dx1 + dx2 for dx1, dy1 in low for dx2, dy2 in mid ]
+	dy12 = [ dy1 + dy2 for dx1, dy1 in low for dx2, dy2 in mid ]
+	
+	dx3 = []
+	dy3 = []
+	flags3 = []
+	
+	for b3 in range(0, 256):
+		dx, dy = Deltas(b3, 2)
+		dx3.append( dx )
+		dy3.append( dy )
+		
+		if b3 & 0x80 and b3 & 0x40:
+			flags3.append( Design.COLOR )
+		elif b3 & 0x80:
+			flags3.append( Design.JUMP )
+		else:
+			flags3.append( 0 )
+	
+	return dx12, dy12, dx3, dy3, flags3
+
+# =================================================================
+def BuildTajimaEncodeTables():
+	# Maps every delta from -121 to 121 to its balanced ternary digits,
+	# packed as the bits of a (b1 << 16 | b2 << 8 | b3) record
+	tables = []
+	
+	for axis in (0, 1):
+		table = []
+		
+		for d in range(-TAJIMA_MAX_MOVE, TAJIMA_MAX_MOVE + 1):
+			rec = 0
+			
+			for weight in (81, 27, 9, 3, 1):
+				if d > weight / 2:
+					digit = weight
+				elif d < -(weight / 2):
+					digit = -weight
+				else:
+					continue
+				
+				d -= digit
+				
+				for byte, mask, dx, dy in TAJIMA_BITS:
+					if (dx, dy)[axis] == digit and (dy, dx)[axis] == 0:
+						rec |= mask << (16 - byte * 8)
+			
+			table.append( rec )
+		
+		tables.append( table )
+	
+	return tables
+
+TAJIMA_DX, TAJIMA_DY, TAJIMA_DX3, TAJIMA_DY3, TAJIMA_FLAGS = BuildTajimaTables()
+TAJIMA_ENCODE_X, TAJIMA_ENCODE_Y = BuildTajimaEncodeTables()
+
+# Records decoded per block when streaming a DST file
+TAJIMA_CHUNK	=	4096
+
+# =================================================================
+def DecodeTajimaBlock(data, x = 0, y = 0, offset = 0, length = None):
+	# Decodes the DST records in length bytes of data from offset,
+	# starting from needle position (x, y) in file orientation. data can
+	# be a string or any buffer such as an mmap; the bytes are unpacked
+	# in place without slicing a copy out first. Each 3-byte record is
+	# mapped to its deltas and flags through the tables built by
+	# BuildTajimaTables() instead of testing every bit. Returns a
+	# StitchList with Y flipped to design orientation, the new position
+	# and whether the end of file record was reached.
+	dxtable		=	TAJIMA_DX
+	dytable		=	TAJIMA_DY
+	dx3table	=	TAJIMA_DX3
+	dy3table	=	TAJIMA_DY3
+	flagtable	=	TAJIMA_FLAGS
+	COLOR			=	Design.COLOR
+	
+	if length is None:
+		length = len(data) - offset
+	
+	length -= length % 3
+	buf = struct.unpack_from( '%dB' % length, data, offset )
+	
+	chunk		=	StitchList()
+	xappend	=	chunk.X.append
+	yappend	=	chunk.Y.append
+	fappend	=	chunk.Flags.append
+	
+	for i in xrange(0, len(buf), 3):
+		b3 = buf[i + 2]
+		
+		# End of file
+		if b3 == 0xF3:
+			return chunk, x, y, True
+		
+		flags = flagtable[b3]
+		
+		if flags == COLOR:
+			chunk.ColorChanges.append( i / 3 )
+		else:
+			k = (buf[i] << 8) | buf[i + 1]
+			x += dxtable[k] + dx3table[b3]
+			y += dytable[k] + dy3table[b3]
+		
+		xappend( x )
+		yappend( -y )
+		fappend( flags )
+	
+	return chunk, x, y, False
+
+# =================================================================
+def ReadTajimaBlocks(f, size):
+	# Reads blocks of whole records from a file object as
+	# (data, offset, length)
+	rest = ''
+	
+	while True:
+		data = f.read( size - len(rest) )
+		
+		if not data:
+			break
+		
+		data = rest + data
+		length = len(data) - (len(data) % 3)
+		rest = data[length:]
+		
+		yield data, 0, length
+
+# =================================================================
+def MapTajimaBlocks(buf, offset, size):
+	# Splits a buffer such as an mmap into blocks of whole records as
+	# (buffer, offset, length) without copying it
+	end = len(buf)
+	
+	while offset < end:
+		length = min(size, end - offset)
+		yield buf, offset, length
+		offset += length
+
+# =================================================================
+def IterTajima(f, chunksize = 0, offset = None):
+	# Streams the stitches of a DST body, holding only one block in
+	# memory at a time. Without an offset the body is read from the
+	# current position of a file object; with one, f is a buffer such as
+	# an mmap that is decoded in place from that offset.
+	#
+	# Yields (x, y, flags) tuples, or StitchList chunks of up to
+	# chunksize records when chunksize is given. The color index of a
+	# color change in a chunk is the number of the color it starts.
+	size	=	3 * (chunksize or TAJIMA_CHUNK)
+	x			=	0
+	y			=	0
+	color	=	0
+	
+	if offset is None:
+		blocks = ReadTajimaBlocks( f, size )
+	else:
+		blocks = MapTajimaBlocks( f, offset, size )
+	
+	for data, start, length in blocks:
+		chunk, x, y, done = DecodeTajimaBlock( data, x, y, start, length )
+		
+		n = len(chunk.ColorChanges)
+		chunk.ColorIndices = array.array('H', range(color + 1, color + n + 1))
+		color += n
+		
+		if chunksize:
+			if len(chunk):
+				yield chunk
+		else:
+			for rec in itertools.izip( chunk.X, chunk.Y, chunk.Flags ):
+				yield rec
+		
+		if done:
+			break
+
+# =================================================================
+def StreamTajima(filename, mapped = False, chunksize = None):
+	# Yields the stitches of a DST file as StitchList chunks without
+	# touching any Design, so it can run on another thread. With mapped
+	# set the file is memory mapped and decoded in place, so processes
+	# loading the same designs share the OS page cache.
+	chunksize = chunksize or TAJIMA_CHUNK
+	f = file(filename, 'rb')
+	data = None
+	
+	try:
+		if mapped:
+			try:
+				data = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+			except (ValueError, EnvironmentError):
+				# Empty files can't be mapped, so read those normally
+				data = None
+		
+		# The header is read separately by ReadTajimaHeader()
+		if data is not None:
+			chunks = IterTajima( data, chunksize, TAJIMA_HEADER_SIZE )
+		else:
+			f.seek(TAJIMA_HEADER_SIZE)
+			chunks = IterTajima( f, chunksize )
+		
+		for chunk in chunks:
+			yield chunk
+	finally:
+		if data is not None:
+			data.close()
+		
+		f.close()
+
+# =================================================================
+def ReadTajimaHeader(filename):
+	# Reads only the header of a DST file, which gives its name, stitch
+	# and color change counts and extents without decoding the stitches.
+	# Returns a TajimaHeader, or None if the header holds no counts and
+	# the stitches have to be loaded to find them out.
+	f = file(filename, 'rb')
+	
+	try:
+		data = f.read(TAJIMA_HEADER_SIZE)
+	finally:
+		f.close()
+	
+	header = TajimaHeader()
+	
+	if not header.Parse(data):
+		return None
+	
+	return header
+
+# Bytes at the start of a file that codecs get to recognize it by
+CODEC_SNIFF_SIZE	=	64
+
+# *********************************************************************
+class DesignCodec(object):
+	# Reads and writes one design format. Register an instance with
+	# RegisterCodec() and Design.Load() and Design.Save() pick it up.
+	#
+	# CanStream is set if Load() decodes chunk by chunk as the file is
+	# read, and CanBulk if whole buffers are decoded at once rather than
+	# record by record. Longer moves than MaxMove are split into steps
+	# when saving.
+	Name				=	''
+	Extensions	=	()
+	CanStream		=	False
+	CanBulk			=	False
+	CanSave			=	False
+	MaxMove			=	None
+	
+	# -------------------------------------------------------------------
+	def Sniff(self, data):
+		# Whether data, the first CODEC_SNIFF_SIZE bytes of a file, is in
+		# this format. Formats without a signature leave it to the file
+		# extension.
+		return False
+	
+	# -------------------------------------------------------------------
+	def Load(self, d, filename, mapped = False, chunksize = None):
+		# Reads the header and colors of filename into the cleared design
+		# d and returns an iterator over its stitch chunks
+		raise NotImplementedError
+	
+	# -------------------------------------------------------------------
+	def Writer(self, d, filename):
+		# A DesignWriter that saves the chunks given to it, with the name
+		# and colors of d, as filename
+		raise NotImplementedError
+	
+	# -------------------------------------------------------------------
+	def Save(self, d, filename):
+		writer = self.Writer( d, filename )
+		writer.Write( d.Stitches )
+		writer.Close()
+
+# *********************************************************************
+class TajimaCodec(DesignCodec):
+	Name				=	'Tajima'
+	Extensions	=	('.dst',)
+	CanStream		=	True
+	CanBulk			=	True
+	CanSave			=	True
+	MaxMove			=	TAJIMA_MAX_MOVE
+	
+	# -------------------------------------------------------------------
+	def Sniff(self, data):
+		# Designs saved with a blank header are only known by extension
+		return data[:3] == 'LA:'
+	
+	# -------------------------------------------------------------------
+	def Load(self, d, filename, mapped = False, chunksize = None):
+		d.ReadHeader( filename )
+		d.ReadColors( filename )
+		return StreamTajima( filename, mapped, chunksize )
+	
+	# -------------------------------------------------------------------
+	def Writer(self, d, filename):
+		return TajimaWriter( d, filename )
+
+# *********************************************************************
+class DesignWriter(object):
+	# Saves a design one StitchList chunk at a time, so converting a
+	# file never needs all of its stitches at once. Begin() writes a
+	# placeholder header, Encode() the records of each chunk, and
+	# Finish() seeks back to fill in the header once the counts and
+	# extents are known. Thread colors come from the design.
+	
+	# -------------------------------------------------------------------
+	def __init__(self, d, filename):
+		self.Design				=	d
+		self.Filename			=	filename
+		self.File					=	file(filename, 'wb')
+		self.MinX					=	None
+		self.MinY					=	None
+		self.MaxX					=	None
+		self.MaxY					=	None
+		self.ColorChanges	=	0
+		self.Threads			=	[ self.Thread(0) ]
+		
+		self.Begin()
+	
+	# -------------------------------------------------------------------
+	def Thread(self, index):
+		# Color of thread index, made up if the design has none for it
+		d = self.Design
+		
+		while len(d.Colors) <= index:
+			d.Colors.append( d.RandomColor() )
+		
+		return d.Colors[index]
+	
+	# -------------------------------------------------------------------
+	def Write(self, chunk):
+		stats = chunk.GetStats()
+		
+		if stats.MinX is not None:
+			if self.MinX is None:
+				self.MinX, self.MinY, self.MaxX, self.MaxY = stats.MinX, stats.MinY, stats.MaxX, stats.MaxY
+			else:
+				self.MinX	=	min( self.MinX, stats.MinX )
+				self.MinY	=	min( self.MinY, stats.MinY )
+				self.MaxX	=	max( self.MaxX, stats.MaxX )
+				self.MaxY	=	max( self.MaxY, stats.MaxY )
+		
+		self.ColorChanges += stats.ColorChangeCount
+		self.Threads.extend( [ self.Thread(i) for i in chunk.ColorIndices ] )
+		
+		self.Encode( chunk )
+	
+	# -------------------------------------------------------------------
+	def Close(self):
+		try:
+			self.Finish()
+		finally:
+			self.File.close()
+	
+	# -------------------------------------------------------------------
+	def Bounds(self):
+		# Extents of what was written as (minx, miny, maxx, maxy),
+		# always including the start of the design
+		if self.MinX is None:
+			return 0, 0, 0, 0
+		
+		return min( 0, self.MinX ), min( 0, self.MinY ), max( 0, self.MaxX ), max( 0, self.MaxY )
+	
+	# -------------------------------------------------------------------
+	def Begin(self):
+		pass
+	
+	# -------------------------------------------------------------------
+	def Encode(self, chunk):
+		raise NotImplementedError
+	
+	# -------------------------------------------------------------------
+	def Finish(self):
+		pass
+
+# *********************************************************************
+class TajimaWriter(DesignWriter):
+	# Encodes with Design.EncodeTajima(), continuing from the position
+	# it left in the design
+	
+	# -------------------------------------------------------------------
+	def __init__(self, d, filename, mergejumps = True):
+		self.MergeJumps	=	mergejumps
+		self.Held				=	None
+		self.Records		=	0
+		
+		DesignWriter.__init__( self, d, filename )
+	
+	# -------------------------------------------------------------------
+	def Begin(self):
+		self.File.write( ' ' * TAJIMA_HEADER_SIZE )
+	
+	# -------------------------------------------------------------------
+	def Encode(self, chunk):
+		if not self.MergeJumps:
+			self.Output( chunk )
+			return
+		
+		# Jumps at the end of a chunk wait for the next one, so a chain
+		# split between chunks is still merged as one
+		if self.Held is not None:
+			joined = StitchList()
+			joined.X			=	self.Held.X + chunk.X
+			joined.Y			=	self.Held.Y + chunk.Y
+			joined.Flags	=	self.Held.Flags + chunk.Flags
+			chunk = joined
+		
+		n = len(chunk.Flags)
+		end = n
+		
+		while end and chunk.Flags[end - 1] == Design.JUMP:
+			end -= 1
+		
+		if end < n:
+			self.Held = chunk.Slice( end, n )
+			chunk = chunk.Slice( 0, end )
+		else:
+			self.Held = None
+		
+		self.Output( chunk )
+	
+	# -------------------------------------------------------------------
+	def Output(self, chunk):
+		body = self.Design.EncodeTajima( chunk, self.MergeJumps )
+		self.Records += len(body) / 3
+		self.File.write( body )
+	
+	# -------------------------------------------------------------------
+	def Finish(self):
+		d = self.Design
+		
+		if self.Held is not None:
+			self.Output( self.Held )
+		
+		self.File.write( '\x00\x00\xF3' )
+		
+		# Counts come from the records written, as moves may be split
+		# and jumps merged, and the end position from where they stop
+		header = d.Header
+		header.Label		=	d.Name
+		header.Stitches	=	self.Records
+		header.Colors		=	self.ColorChanges
+		header.EndX			=	d.LastX
+		header.EndY			=	d.LastY
+		header.SetBounds( *self.Bounds() )
+		
+		self.File.seek(0)
+		self.File.write( header.Pack() )
+		
+		d.WriteColors( self.Filename )
+
+# =================================================================
+def RegisterCodec(codec):
+	# Codecs are tried in the order they were registered
+	CODECS.append( codec )
+
+CODECS	=	[]
+
+# =================================================================
+def CodecForExtension(filename):
+	# The first codec registered for the extension of filename, or None
+	ext = os.path.splitext( filename )[1].lower()
+	
+	for codec in CODECS:
+		if ext in codec.Extensions:
+			return codec
+	
+	return None
+
+# =================================================================
+def FindCodec(filename):
+	# The codec to load filename with. Files are recognized by their
+	# first bytes so misnamed ones still load, and by their extension
+	# when no codec knows the bytes.
+	f = file(filename, 'rb')
+	
+	try:
+		data = f.read(CODEC_SNIFF_SIZE)
+	finally:
+		f.close()
+	
+	for codec in CODECS:
+		if codec.Sniff( data ):
+			return codec
+	
+	codec = CodecForExtension( filename )
+	
+	if codec is None:
+		raise ValueError("""I can't figure out what type of embroidery design is in this file. Please make sure that the file has the proper extension.""")
+	
+	return codec
+
+# =================================================================
+def FindSaveCodec(filename):
+	# The codec to save filename with, by its extension
+	codec = CodecForExtension( filename )
+	
+	if codec is None or not codec.CanSave:
+		raise ValueError("""I can't figure out what type of embroidery design to save. Please make sure that the file has the proper extension.""")
+	
+	return codec
+
+# =================================================================
+def DesignWildcard():
+	# File dialog wildcard listing every registered format
+	patterns = []
+	
+	for codec in CODECS:
+		patterns.extend( [ '*' + ext for ext in codec.Extensions ] )
+	
+	return 'Design files (%s)|%s|All files (*.*)|*.*' % ( ';'.join(patterns), ';'.join(patterns) )
+
+RegisterCodec( TajimaCodec() )
+
+# Kinds of control records in the formats below besides Design.JUMP
+# and Design.COLOR
+RECORD_STITCH	=	0
+RECORD_TRIM		=	-1
+RECORD_END		=	-2
+
+# Largest move a two byte EXP or JEF record can hold
+BYTE_RECORD_MAX_MOVE	=	127
+
+# =================================================================
+def ReadFileFrom(filename, offset = 0):
+	# The bytes of filename from offset to the end
+	f = file(filename, 'rb')
+	
+	try:
+		f.seek(offset)
+		return f.read()
+	finally:
+		f.close()
+
+# =================================================================
+def DecodeByteRecords(data, offset, controls):
+	# Decodes the stitch records shared by EXP and JEF from offset to
+	# the end of data in one pass. Each is a signed byte dx and dy with
+	# Y pointing up. A 0x80 in place of dx starts a four byte control
+	# record whose second byte maps to a kind in controls and whose last
+	# two bytes are the move that goes with it. Returns a StitchList.
+	length = len(data) - offset
+	length -= length % 2
+	buf = struct.unpack_from( '%db' % length, data, offset )
+	
+	return DecodeRecords( ByteRecords( buf, controls ) )
+
+# =================================================================
+def ByteRecords(buf, controls):
+	# Yields (dx, dy, kind) for the two byte records in buf
+	n = len(buf) - 1
+	i = 0
+	
+	while i < n:
+		dx = buf[i]
+		
+		if dx != -128:
+			yield dx, -buf[i + 1], RECORD_STITCH
+			i += 2
+			continue
+		
+		if i + 3 > n:
+			return
+		
+		kind = controls.get( buf[i + 1] & 0xFF )
+		
+		if kind == RECORD_END:
+			return
+		
+		if kind is not None:
+			yield buf[i + 2], -buf[i + 3], kind
+		
+		i += 4
+
+# =================================================================
+def DecodeRecords(records):
+	# Builds a StitchList from (dx, dy, kind) moves. A trim becomes
+	# enough jumps in place to make the run of jumps it ends with one
+	# that is read back as a trim (TAJIMA_TRIM_JUMPS), which is how the
+	# stitch model knows trims.
+	JUMP	=	Design.JUMP
+	COLOR	=	Design.COLOR
+	trim	=	TAJIMA_TRIM_JUMPS
+	
+	chunk		=	StitchList()
+	xappend	=	chunk.X.append
+	yappend	=	chunk.Y.append
+	fappend	=	chunk.Flags.append
+	x				=	0
+	y				=	0
+	run			=	0
+	
+	for dx, dy, kind in records:
+		if kind == COLOR:
+			chunk.ColorChanges.append( len(chunk.Flags) )
+			xappend( x )
+			yappend( y )
+			fappend( COLOR )
+			run = 0
+			
+			if not dx and not dy:
+				continue
+			
+			kind = JUMP
+		
+		if kind == RECORD_TRIM:
+			# The bytes after a trim aren't a move
+			while run < trim:
+				xappend( x )
+				yappend( y )
+				fappend( JUMP )
+				run += 1
+			continue
+		
+		x += dx
+		y += dy
+		
+		xappend( x )
+		yappend( y )
+		
+		if kind == JUMP:
+			fappend( JUMP )
+			run += 1
+		else:
+			fappend( 0 )
+			run = 0
+	
+	chunk.ColorIndices = array.array( 'H', range(1, len(chunk.ColorChanges) + 1) )
+	
+	return chunk
+
+# *********************************************************************
+class ByteRecordWriter(DesignWriter):
+	# Encodes the two byte records of EXP and JEF. JumpCode is the
+	# control that moves with the needle up, TrimCode the control record
+	# written once a run of jumps is long enough to cut the thread, and
+	# EndCode the one that ends the design.
+	JumpCode		=	None
+	TrimCode		=	None
+	EndCode			=	None
+	
+	# -------------------------------------------------------------------
+	def Begin(self):
+		self.LastX	=	0
+		self.LastY	=	0
+		self.Run		=	0
 	
 	# -------------------------------------------------------------------
-	def Rotate(self, angle):
-		# Calculate center of image
-		cx = self.MinX + (self.Width / 2)
-		cy = self.MinY + (self.Height / 2)
+	def Encode(self, chunk):
+		JUMP	=	Design.JUMP
+		COLOR	=	Design.COLOR
+		limit	=	BYTE_RECORD_MAX_MOVE
+		trim	=	TAJIMA_TRIM_JUMPS
 		
-		angle = math.radians(angle)
+		buf		=	array.array('B')
+		lastx	=	self.LastX
+		lasty	=	self.LastY
+		run		=	self.Run
 		
-		for s in self.Stitches:
-			if len(s) == 3:
-				if s[2] == self.COLOR:
-					continue
+		for x, y, flags in itertools.izip( chunk.X, chunk.Y, chunk.Flags ):
+			if flags == COLOR:
+				buf.extend( (0x80, 0x01, 0x00, 0x00) )
+				run = 0
+				continue
 			
-			sa = math.sin(angle)
-			ca = math.cos(angle)
+			dx = x - lastx
+			dy = lasty - y
 			
-			# Transform using center
-			dx = s[0] - cx
-			dy = s[1] - cy
+			if flags == JUMP:
+				run += 1
+				
+				for sx, sy in SplitMove( lastx, lasty, x, y, limit ):
+					buf.extend( (0x80, self.JumpCode, (sx - lastx) & 0xFF, (lasty - sy) & 0xFF) )
+					lastx = sx
+					lasty = sy
+				
+				if run == trim and self.TrimCode:
+					buf.extend( self.TrimCode )
+				
+				continue
 			
-			# Calculate new coordinates
-			nx = (dx * ca - dy * sa)
-			ny = (dy * ca + dx * sa)
+			run = 0
 			
-			# Transform back
-			s[0] = nx + cx
-			s[1] = ny + cy
-
-# *********************************************************************
-class ToolCtrl(wx.Window):
+			if dx > limit or dx < -limit or dy > limit or dy < -limit:
+				for sx, sy in SplitMove( lastx, lasty, x, y, limit ):
+					buf.extend( ((sx - lastx) & 0xFF, (lasty - sy) & 0xFF) )
+					lastx = sx
+					lasty = sy
+				continue
+			
+			buf.extend( (dx & 0xFF, dy & 0xFF) )
+			lastx = x
+			lasty = y
+		
+		self.LastX	=	lastx
+		self.LastY	=	lasty
+		self.Run		=	run
+		
+		self.Output( buf.tostring() )
 	
 	# -------------------------------------------------------------------
-	def __init__(self, parent, wid, pstyle):
-		wx.Window.__init__(self, parent, wid, style = pstyle)
+	def Output(self, data):
+		self.File.write( data )
 
 # *********************************************************************
-class SketchCtrl(wx.Window):
+class MelcoCodec(DesignCodec):
+	# Melco EXP files are only stitch records, with the colors kept in a
+	# .colors file as for DST
+	Name				=	'Melco'
+	Extensions	=	('.exp',)
+	CanBulk			=	True
+	CanSave			=	True
+	MaxMove			=	BYTE_RECORD_MAX_MOVE
+	
+	CONTROLS = {
+		0x01	:	Design.COLOR,
+		0x02	:	RECORD_STITCH,
+		0x04	:	Design.JUMP,
+		0x80	:	RECORD_TRIM,
+	}
 	
 	# -------------------------------------------------------------------
-	def __init__(self, parent, wid, pstyle):
-		wx.Window.__init__(self, parent, wid, style = pstyle)
-		
-		self.Clear()
-		
-		self.Bind( wx.EVT_PAINT, self.OnPaint )
-		self.Bind( wx.EVT_KEY_DOWN, self.OnKeyDown )		
+	def Load(self, d, filename, mapped = False, chunksize = None):
+		d.Name = os.path.splitext( os.path.basename( filename ) )[0]
+		d.ReadColors( filename )
 		
+		return self.Stream( filename, 0 )
+	
 	# -------------------------------------------------------------------
-	def Clear(self):
-		self.CurrentFile		=	None
-		self.cx							=	0
-		self.cy							=	0
-		self.Magnification	=	1.0
-		self.Modified				=	False
-		
-		self.Sketch 				= Sketch()
-		
-		self.Refresh()
-		
+	def Stream(self, filename, offset):
+		# Reads and decodes the stitches from offset on only once asked
+		# for them, so it happens on the thread running the iterator
+		yield DecodeByteRecords( ReadFileFrom( filename, offset ), 0, self.CONTROLS )
+	
 	# -------------------------------------------------------------------
-	def OnPaint(self, e):
-		dc = wx.PaintDC(self)
-		
-		w, h = dc.GetSizeTuple()
+	def Writer(self, d, filename):
+		return MelcoWriter( d, filename )
+
+# *********************************************************************
+class MelcoWriter(ByteRecordWriter):
+	JumpCode	=	0x04
+	TrimCode	=	(0x80, 0x80, 0x07, 0x00)
+	
+	# -------------------------------------------------------------------
+	def Finish(self):
+		self.Design.WriteColors( self.Filename )
+
+RegisterCodec( MelcoCodec() )
+
+# Janome thread colors by their index in a JEF file
+JANOME_THREADS = (
+	(0x00, 0x00, 0x00),	(0x00, 0x00, 0x00),	(0xFF, 0xFF, 0xFF),	(0xFF, 0xFF, 0x17),
+	(0xFF, 0x66, 0x00),	(0x2F, 0x59, 0x33),	(0x23, 0x73, 0x36),	(0x65, 0xC2, 0xC8),
+	(0xAB, 0x5A, 0x96),	(0xF6, 0x69, 0xA0),	(0xFF, 0x00, 0x00),	(0xB1, 0x70, 0x4E),
+	(0x0B, 0x2F, 0x84),	(0xE4, 0xC3, 0x5D),	(0x48, 0x1A, 0x05),	(0xAC, 0x9C, 0xC7),
+	(0xFC, 0xF2, 0x94),	(0xF9, 0x99, 0xB7),	(0xFA, 0xB3, 0x81),	(0xC9, 0xA4, 0x80),
+	(0x97, 0x05, 0x33),	(0xA0, 0xB8, 0xCC),	(0x7F, 0xC2, 0x1C),	(0xE5, 0xE5, 0xE5),
+	(0x88, 0x9B, 0x9B),	(0x98, 0xD6, 0xBD),	(0xB2, 0xE1, 0xE3),	(0x36, 0x8B, 0xA0),
+	(0x4F, 0x83, 0xAB),	(0x38, 0x6A, 0x91),	(0x07, 0x16, 0x50),	(0xF9, 0x99, 0xA2),
+	(0xF9, 0x67, 0x6B),	(0xE3, 0x31, 0x1F),	(0xE2, 0xA1, 0x88),	(0xB5, 0x94, 0x74),
+	(0xE4, 0xCF, 0x99),	(0xFF, 0xCB, 0x00),	(0xE1, 0xAD, 0xD4),	(0xC3, 0x00, 0x7E),
+	(0x80, 0x00, 0x4B),	(0x54, 0x05, 0x71),	(0xB1, 0x05, 0x25),	(0xCA, 0xE0, 0xC0),
+	(0x89, 0x98, 0x56),	(0x5C, 0x94, 0x1A),	(0x00, 0x31, 0x14),	(0x5D, 0xAE, 0x94),
+	(0x4C, 0xBF, 0x8F),	(0x00, 0x77, 0x72),	(0x59, 0x5B, 0x61),	(0xFF, 0xFF, 0xF2),
+	(0xB1, 0x58, 0x18),	(0xCB, 0x8A, 0x07),	(0xF7, 0x92, 0x7B),	(0x98, 0x69, 0x2D),
+	(0xA2, 0x71, 0x48),	(0x7B, 0x55, 0x4A),	(0x4F, 0x39, 0x46),	(0x52, 0x3A, 0x97),
+	(0x00, 0x00, 0x6E),
+)
+
+# Janome hoop codes and sizes in 0.1 mm, smallest first
+JANOME_HOOPS = (
+	(2, 500, 500),
+	(1, 1100, 1100),
+	(0, 1260, 1100),
+	(3, 1400, 2000),
+	(4, 2300, 2000),
+)
+
+# =================================================================
+def NearestThread(color, threads):
+	# Index of the thread closest to color, skipping the unused index 0
+	r, g, b = color
+	best = 1
+	bestd = None
+	
+	for i in xrange(1, len(threads)):
+		tr, tg, tb = threads[i]
+		d = (r - tr) ** 2 + (g - tg) ** 2 + (b - tb) ** 2
 		
-		dc.SetBrush( wx.WHITE_BRUSH )
-		dc.DrawRectangle( 0, 0, w, h )
-		dc.SetBrush( wx.NullBrush )
+		if bestd is None or d < bestd:
+			best = i
+			bestd = d
+	
+	return best
+
+# *********************************************************************
+class JanomeCodec(DesignCodec):
+	# Janome JEF files start with a little endian header giving where the
+	# stitches start, the Janome thread of every color block and the
+	# extents of the design against the standard hoops
+	Name				=	'Janome'
+	Extensions	=	('.jef',)
+	CanBulk			=	True
+	CanSave			=	True
+	MaxMove			=	BYTE_RECORD_MAX_MOVE
+	
+	CONTROLS = {
+		0x01	:	Design.COLOR,
+		0x02	:	Design.JUMP,
+		0x10	:	RECORD_END,
+	}
+	
+	# -------------------------------------------------------------------
+	def Sniff(self, data):
+		# The stitches start right after the thread list, the header flags
+		# are always 0x14 and the save time is written out in digits
+		if len(data) < 28:
+			return False
 		
-		m = self.Magnification
-		dc.SetUserScale(m, m)
+		offset, flags = struct.unpack_from( '<ii', data, 0 )
+		count, = struct.unpack_from( '<i', data, 24 )
 		
-		self.DrawImage(dc, self.cx, self.cy)
-		self.DrawDesign(dc, self.cx, self.cy)
+		return offset == 116 + 8 * count and flags == 0x14 and data[8:22].isdigit()
 	
 	# -------------------------------------------------------------------
-	def DrawImage(self, dc, cx, cy):
-		if not self.Sketch.Image:
-			return
+	def Load(self, d, filename, mapped = False, chunksize = None):
+		# Only the header is read here; the stitches are left to Stream()
+		f = file(filename, 'rb')
 		
-		dc.DrawBitmap( wx.BitmapFromImage( self.Sketch.Image ), 
-			cx - (self.Sketch.Image.GetWidth() / 2), 
-			cy - (self.Sketch.Image.GetHeight() / 2))
+		try:
+			data = f.read(116)
+			offset, = struct.unpack_from( '<i', data, 0 )
+			count, = struct.unpack_from( '<i', data, 24 )
+			threads = struct.unpack( '<%di' % count, f.read(4 * count) )
+		finally:
+			f.close()
 		
-	# -------------------------------------------------------------------
-	def DrawDesign(self, dc, cx, cy):
-		if not self.Sketch.Design.Valid():
-			return
-			
-		c = wx.Colour( self.Sketch.Design.Colors[0][0], 
-									self.Sketch.Design.Colors[0][1],
-									self.Sketch.Design.Colors[0][2],
-			)
+		d.Name = os.path.splitext( os.path.basename( filename ) )[0]
+		d.Colors = []
 		
-		p = wx.Pen( c )
-		dc.SetPen( p )
+		for i in threads:
+			if 0 < i < len(JANOME_THREADS):
+				d.Colors.append( JANOME_THREADS[i] )
+			else:
+				d.Colors.append( d.RandomColor() )
 		
-		x = 0
-		y = 0
+		if not d.Colors:
+			d.Colors.append( d.RandomColor() )
 		
-		for s in self.Sketch.Design.Stitches:
-			if len(s) == 3:
-				if s[2] == Design.COLOR:
-					i = s[0]
-					c = wx.Colour( self.Sketch.Design.Colors[i][0], 
-												self.Sketch.Design.Colors[i][1],
-												self.Sketch.Design.Colors[i][2],
-					)
-					
-					p = wx.Pen(c)
-					dc.SetPen( wx.NullPen )
-					dc.SetPen( p )
-					continue
-					
-			dc.DrawLine(x + cx, y + cy, s[0] + cx, s[1] + cy)
-			print 'Drawing from (%d, %d) to (%d, %d)' % (x + cx, y + cy, s[0] + cx, s[1] + cy) 
-			x = s[0]
-			y = s[1]
+		d.ColorsRead = 1
 		
-		dc.SetPen( wx.NullPen )		
-		print 'cx, cy = (%d, %d)' % (self.cx, self.cy)
+		return self.Stream( filename, offset )
 	
 	# -------------------------------------------------------------------
-	def OnRotateClockwise(self, e):
-		if self.Sketch.Design.Valid():
-			self.Sketch.Design.Rotate(90)
-			self.Modified = True
-			self.Refresh()
+	def Stream(self, filename, offset):
+		yield DecodeByteRecords( ReadFileFrom( filename, offset ), 0, self.CONTROLS )
 	
 	# -------------------------------------------------------------------
-	def OnRotateCounterClockwise(self, e):
-		if self.Sketch.Design.Valid():
-			self.Sketch.Design.Rotate(270)
-			self.Modified = True
-			self.Refresh()
-			
+	def Writer(self, d, filename):
+		return JanomeWriter( d, filename )
+
+# *********************************************************************
+class JanomeWriter(ByteRecordWriter):
+	# The header holds a table that grows with the number of colors,
+	# which isn't known until the end, so the records are spooled to a
+	# temporary file and copied in after it
+	JumpCode	=	0x02
+	
 	# -------------------------------------------------------------------
-	def OnOpen(self, e):
-		dlg = wx.FileDialog(self, 
-						'Which embroidery design would you like to open?',
-						wildcard = 'Design files (*.dst)|*.dst|All files (*.*)|*.*',
-						style = wx.OPEN | wx.FILE_MUST_EXIST)
-		
-		if dlg.ShowModal() == wx.ID_OK:
-			try:
-				p = dlg.GetPath()
-				d = self.Sketch.Design
-				d.Load( p )
-				self.cx = -d.MinX + 12
-				self.cy = -d.MinY + 12
-				self.CurrentFile = p
-				self.Modified = False
-			except Exception, e:
-				wx.MessageBox('Could not read the file that you wanted to load: %s' % e,
-					"Hmm... there's a problem here",
-					wx.ICON_ERROR | wx.OK)
-	
-	# -------------------------------------------------------------------
-	def OnOpenImage(self, e):
-		dlg = wx.FileDialog(self, 
-						'Which image would you like to open?',
-						wildcard = 'All images (*.bmp;*.png;*.jpg;*.gif;*.pcx;*.tif;*.xpm)|*.bmp;*.png;*.jpg;*.gif;*.pcx;*.tif;*.xpm|All files (*.*)|*.*',
-						style = wx.OPEN | wx.FILE_MUST_EXIST)
-		
-		if dlg.ShowModal() == wx.ID_OK:
-			try:
-				p = dlg.GetPath()
-				self.Sketch.Image = wx.Image(p)				
-				self.Modified = False
-				self.Refresh()
-			except Exception, e:
-				wx.MessageBox('Could not read the file that you wanted to load: %s' % e,
-					"Hmm... there's a problem here",
-					wx.ICON_ERROR | wx.OK)
+	def Begin(self):
+		ByteRecordWriter.Begin( self )
+		self.Spool	=	tempfile.TemporaryFile()
+		self.Length	=	0
 	
 	# -------------------------------------------------------------------
-	def OnCloseImage(self, e):
-		self.Sketch.Image = None
-		self.Refresh()
+	def Output(self, data):
+		self.Spool.write( data )
+		self.Length += len(data)
 	
 	# -------------------------------------------------------------------
-	def OnSave(self, e):
-		if not self.Modified:
-			return
+	def Finish(self):
+		self.Output( '\x80\x10' )
+		
+		threads = [ NearestThread( c, JANOME_THREADS ) for c in self.Threads ]
+		minx, miny, maxx, maxy = self.Bounds()
+		
+		# Distances from the center of the hoop to each edge
+		edges = ( -minx, -miny, maxx, maxy )
+		
+		hoop = JANOME_HOOPS[-1][0]
+		
+		for code, width, height in JANOME_HOOPS:
+			if max( edges[0], edges[2] ) * 2 <= width and max( edges[1], edges[3] ) * 2 <= height:
+				hoop = code
+				break
+		
+		header = [
+			struct.pack( '<ii', 116 + 8 * len(threads), 0x14 ),
+			time.strftime( '%Y%m%d%H%M%S' ) + '\x00\x00',
+			struct.pack( '<iii', len(threads), self.Length / 2, hoop ),
+			struct.pack( '<4i', *edges ),
+		]
+		
+		# Then the margins left in the 110 x 110, 50 x 50, 140 x 200 and
+		# 230 x 200 mm hoops, or -1 where the design doesn't fit
+		for width, height in ( (1100, 1100), (500, 500), (1400, 2000), (2300, 2000) ):
+			margins = ( width / 2 - edges[0], height / 2 - edges[1], width / 2 - edges[2], height / 2 - edges[3] )
+			
+			if min(margins) < 0:
+				margins = (-1, -1, -1, -1)
 			
-		if not self.CurrentFile:
-			return self.OnSaveAs(e)
+			header.append( struct.pack( '<4i', *margins ) )
 		
-		try:
-			self.Sketch.Design.Save( self.CurrentFile )
-			self.Modified = False
-		except Exception, e:
-			wx.MessageBox('Could not save the current design: %s' % e,
-				"Hmm... there's a problem here",
-				wx.ICON_ERROR | wx.OK)
+		header.append( struct.pack( '<%di' % len(threads), *threads ) )
+		header.append( struct.pack( '<%di' % len(threads), *([0x0D] * len(threads)) ) )
+		
+		self.File.write( ''.join(header) )
+		
+		self.Spool.seek(0)
+		
+		while True:
+			data = self.Spool.read(1 << 20)
+			if not data:
+				break
+			self.File.write( data )
+		
+		self.Spool.close()
+
+RegisterCodec( JanomeCodec() )
+
+# Brother thread colors by their index in the PEC section of a PES
+# file
+PEC_THREADS = (
+	(0x00, 0x00, 0x00),	(0x0E, 0x1F, 0x7C),	(0x0A, 0x55, 0xA3),	(0x00, 0x87, 0x77),
+	(0x4B, 0x6B, 0xAF),	(0xED, 0x17, 0x1F),	(0xD1, 0x5C, 0x00),	(0x91, 0x36, 0x97),
+	(0xE4, 0x9A, 0xCB),	(0x91, 0x5F, 0xAC),	(0x9E, 0xD6, 0x7D),	(0xE8, 0xA9, 0x00),
+	(0xFE, 0xBA, 0x35),	(0xFF, 0xFF, 0x00),	(0x70, 0xBC, 0x1F),	(0xBA, 0x98, 0x00),
+	(0xA8, 0xA8, 0xA8),	(0x7D, 0x6F, 0x00),	(0xFF, 0xFF, 0xB3),	(0x4F, 0x55, 0x56),
+	(0x00, 0x00, 0x00),	(0x0B, 0x3D, 0x91),	(0x77, 0x01, 0x76),	(0x29, 0x31, 0x33),
+	(0x2A, 0x13, 0x01),	(0xF6, 0x4A, 0x8A),	(0xB2, 0x76, 0x24),	(0xFC, 0xBB, 0xC5),
+	(0xFE, 0x37, 0x0F),	(0xF0, 0xF0, 0xF0),	(0x6A, 0x1C, 0x8A),	(0xA8, 0xDD, 0xC4),
+	(0x25, 0x84, 0xBB),	(0xFE, 0xB3, 0x43),	(0xFF, 0xF3, 0x6B),	(0xD0, 0xA6, 0x60),
+	(0xD1, 0x54, 0x00),	(0x66, 0xBA, 0x49),	(0x13, 0x4A, 0x46),	(0x87, 0x87, 0x87),
+	(0xD8, 0xCC, 0xC6),	(0x43, 0x56, 0x07),	(0xFD, 0xD9, 0xDE),	(0xF9, 0x93, 0xBC),
+	(0x00, 0x38, 0x22),	(0xB2, 0xAF, 0xD4),	(0x68, 0x6A, 0xB0),	(0xEF, 0xE3, 0xB9),
+	(0xF7, 0x38, 0x66),	(0xB5, 0x4B, 0x64),	(0x13, 0x2B, 0x1A),	(0xC7, 0x01, 0x56),
+	(0xFE, 0x9E, 0x32),	(0xA8, 0xDE, 0xEB),	(0x00, 0x67, 0x3E),	(0x4E, 0x29, 0x90),
+	(0x2F, 0x7E, 0x20),	(0xFF, 0xCC, 0xCC),	(0xFF, 0xD9, 0x11),	(0x09, 0x5B, 0xA6),
+	(0xF0, 0xF9, 0x70),	(0xE3, 0xF3, 0x5B),	(0xFF, 0xC8, 0x64),	(0xFF, 0xC8, 0x96),
+	(0xFF, 0xC8, 0xC8),
+)
+
+# PEC moves are 7 bits, or 12 bits in the long form that also flags
+# jumps and trims
+PEC_SHORT_MOVE	=	63
+PEC_MAX_MOVE		=	2047
+PEC_JUMP				=	0x10
+PEC_TRIM				=	0x20
+
+# Size of the fixed PEC header and of the header of its stitch block
+PEC_HEADER_SIZE	=	512
+PEC_BLOCK_SIZE	=	20
+
+# Size in pixels of the previews after the stitches, stored one bit per
+# pixel, and the size of a cell drawn as one pixel in 0.1 mm
+PEC_ICON_WIDTH	=	48
+PEC_ICON_HEIGHT	=	38
+PEC_ICON_CELL		=	10
+
+# =================================================================
+def PecRecords(buf):
+	# Yields (dx, dy, kind) for the PEC records in buf, a sequence of
+	# byte values. Y points down as in the design.
+	n = len(buf)
+	i = 0
 	
-	# -------------------------------------------------------------------
-	def OnSaveAs(self, e):
-		dlg = wx.FileDialog(self, 
-						'Which embroidery design would you like to open?',
-						wildcard = 'Design files (*.dst)|*.dst|All files (*.*)|*.*',
-						style = wx.SAVE)
+	while i < n:
+		b = buf[i]
 		
-		if dlg.ShowModal() == wx.ID_OK:
-			try:
-				p = dlg.GetPath()
-				self.Sketch.Design.Save( p )
-				self.CurrentFile = p
-				self.Modified = False
-			except Exception, e:
-				wx.MessageBox('Could not save the current design: %s' % e,
-					"Hmm... there's a problem here",
-					wx.ICON_ERROR | wx.OK)	
-					
-	# -------------------------------------------------------------------
-	def OnKeyDown(self, e):
-		c = e.GetKeyCode()
-		
-		if c == wx.WXK_LEFT:
-			self.ProcessCommand( MOVE_LEFT ) 
-		elif c == wx.WXK_RIGHT:
-			self.ProcessCommand( MOVE_RIGHT ) 
-		elif c == wx.WXK_UP:
-			self.ProcessCommand( MOVE_UP ) 
-		elif c == wx.WXK_DOWN:
-			self.ProcessCommand( MOVE_DOWN ) 
-		elif c == wx.WXK_NUMPAD_ADD:
-			self.ProcessCommand( wx.ID_ZOOM_IN ) 
-		elif c == wx.WXK_NUMPAD_SUBTRACT:		
-			self.ProcessCommand( wx.ID_ZOOM_OUT ) 
-	
-	# -------------------------------------------------------------------
-	def ProcessCommand(self, c):
-		self.Freeze()
-		
-		if c == MOVE_LEFT:
-			self.cx -= 4
-		elif c == MOVE_RIGHT:
-			self.cx += 4
-		elif c == MOVE_UP:
-			self.cy -= 4
-		elif c == MOVE_DOWN:
-			self.cy += 4
-		elif c == wx.ID_ZOOM_IN:
-			self.OnZoomIn( c )
-		elif c == wx.ID_ZOOM_OUT:
-			self.OnZoomOut( c )
-		elif c == OPEN_IMAGE:
-			self.OnOpenImage( c )
-		elif c == CLOSE_IMAGE:
-			self.OnCloseImage( c )
-			
-		self.Refresh()
-		
-		self.Thaw()
-	
-	# -------------------------------------------------------------------
-	def OnZoomIn(self, e):
-		self.Magnification += 0.1		
-		self.Refresh()
-	
-	# -------------------------------------------------------------------
-	def OnZoomOut(self, e):
-		self.Magnification -= 0.1		
-		self.Refresh()
+		if b == 0xFF:
+			return
+		
+		if b == 0xFE:
+			# 0xFE 0xB0 and a byte that alternates between 2 and 1
+			yield 0, 0, Design.COLOR
+			i += 3
+			continue
+		
+		flags = 0
+		move = []
+		
+		for axis in (0, 1):
+			if i >= n:
+				return
+			
+			b = buf[i]
+			
+			if b & 0x80:
+				if i + 1 >= n:
+					return
+				
+				flags |= b
+				d = ((b & 0x0F) << 8) | buf[i + 1]
+				
+				if d & 0x800:
+					d -= 0x1000
+				
+				i += 2
+			else:
+				d = b
+				
+				if d & 0x40:
+					d -= 0x80
+				
+				i += 1
+			
+			move.append( d )
+		
+		if flags & (PEC_JUMP | PEC_TRIM):
+			yield move[0], move[1], Design.JUMP
+			
+			if flags & PEC_TRIM:
+				yield 0, 0, RECORD_TRIM
+		else:
+			yield move[0], move[1], RECORD_STITCH
 
 # *********************************************************************
-class ColorsCtrl(wx.ScrolledWindow):
+class BrotherCodec(DesignCodec):
+	# Brother PES files. Machines read the PEC section the PES header
+	# points to, which holds the label, the Brother thread of every
+	# color block, the stitches and small previews. Only the PEC section
+	# is read, and the PES section is written as the short version 1
+	# header that machines accept.
+	Name				=	'Brother'
+	Extensions	=	('.pes',)
+	CanBulk			=	True
+	CanSave			=	True
+	MaxMove			=	PEC_MAX_MOVE
+	
+	# -------------------------------------------------------------------
+	def Sniff(self, data):
+		return data[:4] == '#PES'
 	
 	# -------------------------------------------------------------------
-	def __init__(self, parent, wid, sketchctrl, pstyle):
-		wx.ScrolledWindow.__init__(self, parent, wid, style = pstyle)
+	def Load(self, d, filename, mapped = False, chunksize = None):
+		# Only the PEC header is read here; the stitches are left to
+		# Stream()
+		f = file(filename, 'rb')
 		
-		self.SketchCtrl = sketchctrl
-
-		dc = wx.WindowDC(self)
-		tw, th = dc.GetTextExtent( 'Jj' )
+		try:
+			pec, = struct.unpack( '<I', f.read(12)[8:] )
+			f.seek(pec)
+			data = f.read(49)
+			count = ord( data[48] ) + 1
+			threads = f.read(count)
+		finally:
+			f.close()
 		
-		self.TextWidth = th
-		self.TextHeight = th
+		d.Name = data[3:19].strip() or os.path.splitext( os.path.basename( filename ) )[0]
+		d.Colors = []
 		
-		self.Bind( wx.EVT_PAINT, self.OnPaint )
-		self.Bind( wx.EVT_LEFT_DOWN, self.OnLeftDown )
+		for c in threads:
+			i = ord(c)
+			
+			if 0 < i < len(PEC_THREADS):
+				d.Colors.append( PEC_THREADS[i] )
+			else:
+				d.Colors.append( d.RandomColor() )
 		
-		self.SetScrollRate(10, 10)
+		d.ColorsRead = 1
 		
+		return self.Stream( filename, pec + PEC_HEADER_SIZE + PEC_BLOCK_SIZE )
+	
 	# -------------------------------------------------------------------
-	def OnLeftDown(self, e):
-		i = e.GetY() / self.TextHeight
-		Colors = self.SketchCtrl.Sketch.Design.Colors
-		
-		if i < len( Colors ):
-			dlg = wx.ColourDialog(self)
-			
-			if dlg.ShowModal() == wx.ID_OK:
-				c = dlg.GetColourData().GetColour()
-				Colors[i] = (c.Red(), c.Green(), c.Blue())
-				self.SketchCtrl.Modified = True
-				self.SketchCtrl.Refresh()
-				self.GetParent().GetParent().GetParent().UpdateTitle()
-				
+	def Stream(self, filename, offset):
+		data = ReadFileFrom( filename, offset )
+		yield DecodeRecords( PecRecords( struct.unpack( '%dB' % len(data), data ) ) )
+	
 	# -------------------------------------------------------------------
-	def OnPaint(self, e):
-		dc = wx.PaintDC(self)
-		
-		w, h = dc.GetSizeTuple()
+	def Writer(self, d, filename):
+		return BrotherWriter( d, filename )
+
+# *********************************************************************
+class BrotherWriter(DesignWriter):
+	# The PEC header and stitch block header have a fixed size, so they
+	# are written as placeholders and filled in at the end. The previews
+	# are drawn from the stitches as they go by, a pixel per cell of
+	# PEC_ICON_CELL, and scaled down once the extents are known.
+	
+	# -------------------------------------------------------------------
+	def Begin(self):
+		self.LastX	=	0
+		self.LastY	=	0
+		self.Run		=	0
+		self.Second	=	False
+		self.Cells	=	[ set() ]
 		
-		dc.SetBrush( wx.WHITE_BRUSH )
-		dc.DrawRectangle( 0, 0, w, h )
-		dc.SetBrush( wx.NullBrush )
+		self.File.write( '#PES0001' + struct.pack( '<I', 22 ) + '\x00' * 10 )
+		self.Pec = self.File.tell()
+		self.File.write( '\x00' * (PEC_HEADER_SIZE + PEC_BLOCK_SIZE) )
+	
+	# -------------------------------------------------------------------
+	def Encode(self, chunk):
+		JUMP		=	Design.JUMP
+		COLOR		=	Design.COLOR
+		short		=	PEC_SHORT_MOVE
+		limit		=	PEC_MAX_MOVE
+		trim		=	TAJIMA_TRIM_JUMPS
+		cellsize	=	PEC_ICON_CELL
 		
-		x, y = 0, 0
+		buf		=	array.array('B')
+		lastx	=	self.LastX
+		lasty	=	self.LastY
+		run		=	self.Run
+		cells	=	self.Cells[-1]
 		
-		for c in self.SketchCtrl.Sketch.Design.Colors:
-			color = wx.Colour( c[0], c[1], c[2] )			
-			brush = wx.Brush( color )
-			dc.SetBrush( brush )
-			
-			dc.DrawRectangle( x, y, w, self.TextHeight )
+		for x, y, flags in itertools.izip( chunk.X, chunk.Y, chunk.Flags ):
+			if flags == COLOR:
+				self.Second = not self.Second
+				buf.extend( (0xFE, 0xB0, self.Second and 2 or 1) )
+				run = 0
+				cells = set()
+				self.Cells.append( cells )
+				continue
 			
-			text = '#%02X%02X%02X' % ( c[0], c[1], c[2] )
+			dx = x - lastx
+			dy = y - lasty
 			
-			ca = (c[0] + c[1] + c[2]) / 3
-			
-			if ca > 0xa0:
-				dc.SetTextForeground( wx.Colour( 0x00, 0x00, 0x00 ) )
+			if flags == JUMP:
+				run += 1
+				code = PEC_JUMP
+				
+				if run == trim:
+					code |= PEC_TRIM
 			else:
-				dc.SetTextForeground( wx.Colour( 0xff, 0xff, 0xff ) )
+				run = 0
+				code = 0
+				cells.add( (x // cellsize, y // cellsize) )
+				
+				if -short <= dx <= short and -short <= dy <= short:
+					buf.extend( (dx & 0x7F, dy & 0x7F) )
+					lastx = x
+					lasty = y
+					continue
 			
-			tw, th = dc.GetTextExtent( text )
-			dc.DrawText( text, (w / 2) - (tw / 2), y )
+			code = 0x80 | code
 			
-			y += self.TextHeight
+			if -limit <= dx <= limit and -limit <= dy <= limit:
+				buf.extend( (code | ((dx >> 8) & 0x0F), dx & 0xFF, code | ((dy >> 8) & 0x0F), dy & 0xFF) )
+				lastx = x
+				lasty = y
+				continue
 			
-			dc.SetBrush( wx.NullBrush )
+			for sx, sy in SplitMove( lastx, lasty, x, y, limit ):
+				dx = sx - lastx
+				dy = sy - lasty
+				buf.extend( (code | ((dx >> 8) & 0x0F), dx & 0xFF, code | ((dy >> 8) & 0x0F), dy & 0xFF) )
+				lastx = sx
+				lasty = sy
 		
+		self.LastX	=	lastx
+		self.LastY	=	lasty
+		self.Run		=	run
+		
+		self.File.write( buf.tostring() )
+	
 	# -------------------------------------------------------------------
-	def Update(self):
-		self.SetVirtualSizeHints(self.TextWidth * 4, 
-			len( self.SketchCtrl.Sketch.Design.Colors ) * self.TextHeight)
+	def Icon(self, cells, bounds):
+		# A 1 bit preview of cells, framed, fitted into bounds given in
+		# cells
+		width		=	PEC_ICON_WIDTH
+		height	=	PEC_ICON_HEIGHT
+		pixels	=	bytearray( width * height / 8 )
 		
-		self.Refresh()
+		def Set(px, py):
+			pixels[ py * width / 8 + px / 8 ] |= 1 << (px % 8)
 		
-# *********************************************************************
-class MainWnd(wx.Frame):	
-	# -------------------------------------------------------------------
-	def __init__(self, parent, wid, title):
-		wx.Frame.__init__(self,
-										parent,
-										wx.ID_ANY,
-										title)
+		for px in xrange(2, width - 2):
+			Set( px, 1 )
+			Set( px, height - 2 )
 		
-		self.Splitter = wx.SplitterWindow(self, wx.ID_ANY, style = wx.SP_3D)
+		for py in xrange(2, height - 2):
+			Set( 1, py )
+			Set( width - 2, py )
 		
-		self.Tabs	=	wx.Notebook(self.Splitter, wx.ID_ANY, style = wx.NB_TOP)		
-		self.SideBar	=	wx.Notebook(self.Splitter, wx.ID_ANY, style = wx.NB_TOP)		
+		minx, miny, maxx, maxy = bounds
 		
-		self.CreateToolBar()
+		# Fit inside the frame with a pixel to spare
+		scale = max( float(maxx - minx + 1) / (width - 8), float(maxy - miny + 1) / (height - 8), 1.0 )
+		ox = (width - (maxx - minx + 1) / scale) / 2
+		oy = (height - (maxy - miny + 1) / scale) / 2
 		
-		self.Splitter.SplitVertically( self.SideBar, self.Tabs )
+		for px, py in set( [ ( int( ox + (cx - minx) / scale ), int( oy + (cy - miny) / scale ) ) for cx, cy in cells ] ):
+			Set( px, py )
 		
-		self.MainSizer = wx.BoxSizer( wx.HORIZONTAL )
-		self.MainSizer.Add( self.Splitter, 1, wx.EXPAND )
-		self.SetSizer( self.MainSizer )
+		return str(pixels)
+	
+	# -------------------------------------------------------------------
+	def Finish(self):
+		f = self.File
+		d = self.Design
 		
-		self.Tabs.AddPage( SketchCtrl(self.Tabs, wx.ID_ANY, 0), 'Untitled' )
-		self.Tabs.GetCurrentPage().SetFocus()
+		f.write( '\xFF' )
 		
-		self.SideBar.AddPage( ColorsCtrl(self.SideBar, wx.ID_ANY, self.Tabs.GetCurrentPage(), 0), 'Color Editor' )
+		# The PEC header lists up to 256 color blocks, and there is a
+		# preview of the design and of each of them
+		threads	=	[ NearestThread( c, PEC_THREADS ) for c in self.Threads[:256] ]
+		blocks	=	self.Cells[:len(threads)]
+		cells		=	set()
 		
-		self.MainMenu	=	wx.MenuBar()
+		for block in blocks:
+			cells.update( block )
 		
-		self.FileMenu	=	wx.Menu()
+		bounds = [ v // PEC_ICON_CELL for v in self.Bounds() ]
 		
-		self.FileMenu.Append(	wx.ID_NEW, 'New Design\tCtrl+N' )
-		self.FileMenu.Append(	NEW_TAB, 'New Tab\tCtrl+T' )
-		self.FileMenu.AppendSeparator()
-		self.FileMenu.Append(	wx.ID_OPEN, 'Open Design\tCtrl+O' )
-		self.FileMenu.Append(	OPEN_IMAGE, 'Open Image\tShift+Ctrl+O' )
-		self.FileMenu.Append(	wx.ID_SAVE, 'Save Design\tCtrl+S' )
-		self.FileMenu.Append(	wx.ID_SAVEAS, 'Save Design As\tShift+Ctrl+S' )
-		self.FileMenu.AppendSeparator()
-		self.FileMenu.Append(	CLOSE_TAB, 'Close Tab\tCtrl+W' )
-		self.FileMenu.Append(	CLOSE_IMAGE, 'Close Image\tShift+Ctrl+W' )
-		self.FileMenu.Append(	wx.ID_EXIT, 'Exit This Program\tAlt+F4' )
+		icons = f.tell()
+		f.write( self.Icon( cells, bounds ) )
 		
-		self.ViewMenu	=	wx.Menu()
+		for block in blocks:
+			f.write( self.Icon( block, bounds ) )
 		
-		self.ViewMenu.Append(	wx.ID_ZOOM_IN, 'Zoom In\t+' )
-		self.ViewMenu.Append(	wx.ID_ZOOM_OUT, 'Zoom Out\t-' )
-		self.ViewMenu.AppendSeparator()
-		self.ViewMenu.Append(	ROTATE_CLOCKWISE, 'Rotate Clockwise\tR' )
-		self.ViewMenu.Append(	ROTATE_COUNTERCLOCKWISE, 'Rotate Counterclockwise\tL' )
+		header = ''.join( [
+			'LA:%-16s\r' % d.Name[:16],
+			' ' * 12,
+			'\xFF\x00',
+			chr(PEC_ICON_WIDTH / 8) + chr(PEC_ICON_HEIGHT),
+			' ' * 12,
+			chr( len(threads) - 1 ),
+			''.join( [ chr(t) for t in threads ] ),
+		] )
 		
-		self.HelpMenu	=	wx.Menu()
+		header += ' ' * (PEC_HEADER_SIZE - len(header))
 		
-		self.HelpMenu.Append( wx.ID_HELP_CONTENTS, 'Read the Manual' )
-		self.HelpMenu.AppendSeparator()
-		self.HelpMenu.Append( wx.ID_ABOUT, 'About This Program' )
+		minx, miny, maxx, maxy = self.Bounds()
+		block = icons - self.Pec - PEC_HEADER_SIZE
 		
-		self.MainMenu.Append( self.FileMenu, 'File' )
-		self.MainMenu.Append( self.ViewMenu, 'View' )
-		self.MainMenu.Append( self.HelpMenu, 'Help' )
+		header += ''.join( [
+			'\x00\x00',
+			struct.pack( '<I', block )[:3],
+			'\x31\xFF\xF0',
+			struct.pack( '<HHHH', min( maxx - minx, 0xFFFF ), min( maxy - miny, 0xFFFF ), 0x1E0, 0x1B0 ),
+			struct.pack( '>HH', 0x9000 | (-minx & 0x0FFF), 0x9000 | (-miny & 0x0FFF) ),
+		] )
+		
+		f.seek( self.Pec )
+		f.write( header )
+
+RegisterCodec( BrotherCodec() )
+
+# =================================================================
+def StreamConvert(src, dst, chunksize = None):
+	# Converts src to the format of dst in one pass. Each chunk is
+	# encoded as soon as it is decoded and the header is filled in at
+	# the end, so the whole design is never held. Returns the number of
+	# records read.
+	d = Design()
+	chunks = d.LoadChunks( src, True, chunksize )
+	writer = FindSaveCodec( dst ).Writer( d, dst )
+	records = 0
+	
+	try:
+		for chunk in chunks:
+			writer.Write( chunk )
+			records += len(chunk)
+	finally:
+		writer.Close()
+	
+	return records
+
+# =================================================================
+def BenchmarkTajima(filename, repeat = 3):
+	f = file(filename, 'rb')
+	f.seek(TAJIMA_HEADER_SIZE)
+	data = f.read()
+	f.close()
+	
+	results = []
+	
+	for method in ('DecodeTajimaRecords', 'DecodeTajima'):
+		best = None
 		
-		self.SetMenuBar( self.MainMenu )
+		for i in range(0, repeat):
+			d = Design()
+			d.Colors.append( d.RandomColor() )
+			
+			start = time.time()
+			getattr(d, method)( data )
+			elapsed = time.time() - start
+			
+			if best is None or elapsed < best:
+				best = elapsed
 		
-		self.Bind( wx.EVT_MENU, self.OnNew, id = wx.ID_NEW )
-		self.Bind( wx.EVT_MENU, self.OnNewTab, id = NEW_TAB )
-		self.Bind( wx.EVT_MENU, self.OnCloseTab, id = CLOSE_TAB )
-		self.Bind( wx.EVT_MENU, self.OnOpen, id = wx.ID_OPEN )
-		self.Bind( wx.EVT_MENU, self.OnSave, id = wx.ID_SAVE )
-		self.Bind( wx.EVT_MENU, self.OnSaveAs, id = wx.ID_SAVEAS )
-		self.Bind( wx.EVT_MENU, self.ProcessCommand, id = wx.ID_ZOOM_IN )
-		self.Bind( wx.EVT_MENU, self.ProcessCommand, id = wx.ID_ZOOM_OUT )
-		self.Bind( wx.EVT_MENU, self.OnRotateClockwise, id = ROTATE_CLOCKWISE )
-		self.Bind( wx.EVT_MENU, self.OnRotateCounterClockwise, id = ROTATE_COUNTERCLOCKWISE )
-		self.Bind( wx.EVT_MENU, self.ProcessCommand, id = OPEN_IMAGE )
-		self.Bind( wx.EVT_MENU, self.ProcessCommand, id = CLOSE_IMAGE )
+		results.append( (method, best, d) )
+	
+	old = results[0][2]
+	new = results[1][2]
+	
+	if (old.Stitches != new.Stitches
+			or old.JumpStitches != new.JumpStitches
+			or old.ColorChanges != new.ColorChanges):
+		raise ValueError('The bulk decoder does not match the record decoder for %s' % filename)
+	
+	print '%s: %s records' % ( filename, len(new.Stitches) )
+	
+	for method, best, d in results:
+		print '  %-20s %8.3f s  %10.0f records/s' % ( method, best, len(d.Stitches) / max(best, 1e-9) )
+	
+	print '  speedup %.1fx' % ( results[0][1] / max(results[1][1], 1e-9) )
+
+# =================================================================
+def RenderDesign(d, width, height = None, margin = 2, background = (0xFF, 0xFF, 0xFF)):
+	# Draws the stitches of a design into an RGB image the way the canvas
+	# does, scaled to fit a width x height box and centered in it. No
+	# display is needed. Returns a bytearray of rows of 3 byte pixels.
+	if height is None:
+		height = width
+	
+	pixels = bytearray( str(bytearray(background)) * (width * height) )
+	
+	stitches = d.Stitches
+	stats = stitches.GetStats()
+	
+	if stats.MinX is None:
+		return pixels
+	
+	dw = stats.MaxX - stats.MinX
+	dh = stats.MaxY - stats.MinY
+	
+	scale = min( (width - 2 * margin - 1) / float(max(dw, 1)), 
+							(height - 2 * margin - 1) / float(max(dh, 1)) )
+	scale = max(scale, 1e-9)
+	
+	ox = (width - 1 - dw * scale) / 2.0 - stats.MinX * scale
+	oy = (height - 1 - dh * scale) / 2.0 - stats.MinY * scale
+	
+	for color, points in stitches.GetPyramid().Blocks(scale):
+		if color < len(d.Colors):
+			rgb = bytearray(d.Colors[color])
+		else:
+			rgb = bytearray(3)
 		
-		self.Bind( wx.EVT_NOTEBOOK_PAGE_CHANGED, self.OnTabChange)
+		last = None
 		
-		self.Accelerators = wx.AcceleratorTable(
-			[
-				(wx.ACCEL_CTRL,	ord('O'),	wx.ID_OPEN),
-				(wx.ACCEL_CTRL,	ord('N'),	NEW_TAB),
-				(wx.ACCEL_CTRL,	ord('W'),	CLOSE_TAB),
-				(wx.ACCEL_CTRL,	ord('S'),	wx.ID_SAVE),
-				(wx.ACCEL_CTRL,	ord('R'),	ROTATE_CLOCKWISE),
-				(wx.ACCEL_CTRL,	ord('S'),	ROTATE_COUNTERCLOCKWISE),
-				(wx.ACCEL_CTRL | wx.ACCEL_SHIFT, ord('S'),	wx.ID_SAVEAS),
-				(wx.ACCEL_CTRL | wx.ACCEL_SHIFT, ord('O'),	OPEN_IMAGE),
-				(wx.ACCEL_CTRL | wx.ACCEL_SHIFT, ord('W'),	CLOSE_IMAGE),
-			]
-		)
+		for x, y in points:
+			px = int(x * scale + ox + 0.5)
+			py = int(y * scale + oy + 0.5)
+			
+			if last is None:
+				x0, y0 = px, py
+			elif (px, py) == last:
+				continue
+			else:
+				x0, y0 = last
 			
-		self.SetAcceleratorTable( self.Accelerators )		
+			last = (px, py)
+			RasterLine( pixels, width, height, x0, y0, px, py, rgb )
+	
+	return pixels
+
+# =================================================================
+def RasterLine(pixels, width, height, x0, y0, x1, y1, rgb):
+	# Bresenham line from (x0, y0) to (x1, y1) inclusive; pixels outside
+	# the image are skipped
+	dx = abs(x1 - x0)
+	dy = -abs(y1 - y0)
+	sx = x0 < x1 and 1 or -1
+	sy = y0 < y1 and 1 or -1
+	err = dx + dy
+	
+	while True:
+		if 0 <= x0 < width and 0 <= y0 < height:
+			o = (y0 * width + x0) * 3
+			pixels[o:o + 3] = rgb
 		
-	# -------------------------------------------------------------------
-	def OnNew(self, e):
-		self.Tabs.GetCurrentPage().Clear()
-		self.UpdateTitle()
-		self.UpdateSideBar()
+		if x0 == x1 and y0 == y1:
+			break
+		
+		e2 = 2 * err
+		
+		if e2 >= dy:
+			err += dy
+			x0 += sx
+		
+		if e2 <= dx:
+			err += dx
+			y0 += sy
+
+# =================================================================
+def EncodePNG(width, height, pixels, level = 6):
+	# Minimal 8 bit RGB PNG of a RenderDesign() image
+	def Chunk(kind, data):
+		return (struct.pack('>I', len(data)) + kind + data 
+						+ struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF))
 	
-	# -------------------------------------------------------------------
-	def OnNewTab(self, e):
-		self.Tabs.AddPage( SketchCtrl(self.Tabs, wx.ID_ANY, 0), 'Untitled', True)
-		self.UpdateSideBar()
+	stride = width * 3
+	raw = bytearray()
+	
+	for y in xrange(height):
+		# Filter type 0 (none) for every row
+		raw.append(0)
+		raw.extend( pixels[y * stride:(y + 1) * stride] )
+	
+	return ('\x89PNG\r\n\x1a\n' 
+					+ Chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+					+ Chunk('IDAT', zlib.compress(str(raw), level))
+					+ Chunk('IEND', ''))
+
+# =================================================================
+def WritePNG(filename, width, height, pixels):
+	f = file(filename, 'wb')
+	f.write( EncodePNG(width, height, pixels) )
+	f.close()
+
+# =================================================================
+def ExpandDesignPaths(paths):
+	# Turns files, directories and glob patterns into a list of
+	# (path, name) pairs, where name is the path relative to the
+	# directory it was found under
+	found = []
+	
+	for p in paths:
+		if os.path.isdir(p):
+			for root, dirs, files in os.walk(p):
+				dirs.sort()
+				for filename in sorted(files):
+					if CodecForExtension(filename):
+						path = os.path.join(root, filename)
+						found.append( (path, os.path.relpath(path, p)) )
+		elif os.path.isfile(p):
+			found.append( (p, os.path.basename(p)) )
+		else:
+			for path in sorted( glob.glob(p) ):
+				if os.path.isfile(path):
+					found.append( (path, os.path.basename(path)) )
+	
+	return found
+
+# =================================================================
+def TransformDesign(d, transforms):
+	# The steps only compose the design's pending transform, so the
+	# stitches are visited once, when the design is saved. Returns notes
+	# on what the steps did, for the batch report.
+	notes = []
+	
+	for op in transforms:
+		if op[0] == 'move':
+			d.Move( op[1], op[2] )
+		elif op[0] == 'rotate':
+			d.Rotate( op[1] )
+		elif op[0] == 'scale':
+			d.Scale( op[1], op[2] )
+		elif op[0] == 'mirror':
+			d.Mirror( op[1] )
+		elif op[0] == 'normalize':
+			# Center the design on the origin
+			cx, cy = d.Center()
+			d.Move( -cx, -cy )
+		elif op[0] == 'optimize':
+			notes.append( 'optimized: %s' % d.Optimize() )
+		elif op[0] == 'estimate':
+			notes.append( str( d.EstimateSewTime() ) )
+	
+	return notes
+
+# =================================================================
+def ConvertDesign(job):
+	# Worker for BatchConvert(). Returns (source, destination, records,
+	# seconds, error, notes) so that one bad file doesn't stop the batch.
+	src, dst, transforms, cache = job
+	start = time.time()
+	
+	try:
+		if not transforms and not cache:
+			MakeParentDirs( dst )
+			return src, dst, StreamConvert( src, dst ), time.time() - start, None, []
 		
-	# -------------------------------------------------------------------
-	def OnCloseTab(self, e):
-		if self.Tabs.GetPageCount() > 1:
-			self.Tabs.DeletePage( self.Tabs.GetSelection() )
+		d = OpenDesign( src, cache )
+		notes = TransformDesign( d, transforms )
+		MakeParentDirs( dst )
+		d.Save( dst )
+		return src, dst, len(d.Stitches), time.time() - start, None, notes
+	except Exception, e:
+		return src, dst, 0, time.time() - start, str(e), []
+
+# =================================================================
+def ThumbnailDesign(job):
+	# Worker for BatchConvert() that writes a size x size PNG of the
+	# design instead of converting it. Returns the same tuple as
+	# ConvertDesign().
+	src, dst, transforms, size, cache = job
+	start = time.time()
+	
+	try:
+		MakeParentDirs( dst )
+		
+		if cache and not transforms:
+			f = file(dst, 'wb')
+			f.write( GetDesignCache(*cache).Thumbnail(src, size) )
+			f.close()
+			return src, dst, 0, time.time() - start, None, []
+		
+		d = OpenDesign( src, cache )
+		notes = TransformDesign( d, transforms )
+		WritePNG( dst, size, size, RenderDesign(d, size) )
+		return src, dst, len(d.Stitches), time.time() - start, None, notes
+	except Exception, e:
+		return src, dst, 0, time.time() - start, str(e), []
+
+# =================================================================
+def DesignStamp(path):
+	# What DesignCatalog compares to tell whether a design may have
+	# changed: (mtime, size, .colors mtime or None)
+	st = os.stat( path )
+	
+	try:
+		colors = os.stat( path + '.colors' ).st_mtime
+	except EnvironmentError:
+		colors = None
+	
+	return st.st_mtime, st.st_size, colors
+
+# =================================================================
+def IndexDesign(job):
+	# Worker for DesignCatalog.Update(). Returns (path, row, seconds,
+	# error), where row holds the catalog columns, or only the stamp
+	# when the contents hash the same as oldhash.
+	path, oldhash, cache = job
+	start = time.time()
+	
+	try:
+		# Stamped first, so a change made while indexing is seen next time
+		mtime, size, colorsmtime = DesignStamp( path )
+		
+		row = {
+			'path'					:	path,
+			'mtime'					:	mtime,
+			'size'					:	size,
+			'colors_mtime'	:	colorsmtime,
+			'hash'					:	HashDesign( path ),
+		}
+		
+		if row['hash'] == oldhash:
+			return path, row, time.time() - start, None
+		
+		if cache:
+			d = GetDesignCache(*cache).LoadDesign( path, row['hash'] )
 		else:
-			self.Tabs.GetCurrentPage().Clear()
-			self.Tabs.GetCurrentPage().Refresh()
-			
-		self.UpdateSideBar()
+			d = Design()
+			d.Load( path, True )
 		
-	# -------------------------------------------------------------------
-	def OnRotateClockwise(self, e):
-		self.Tabs.GetCurrentPage().OnRotateClockwise( e )
-		self.UpdateTitle()
+		stats = d.CalcStitchExtent()
+		
+		# Only the threads the .colors file names, not the random ones
+		# made up for color changes past its end
+		if colorsmtime is None:
+			palette = ''
+		else:
+			palette = ','.join( [ '#%02X%02X%02X' % c for c in ReadThreadColors( path + '.colors' ) ] )
+		
+		if len(d.Stitches):
+			colors = stats.ColorChangeCount + 1
+		else:
+			colors = 0
+		
+		row.update( {
+			'name'						:	d.Name,
+			'header_stitches'	:	d.Header.Stitches,
+			'records'					:	len(d.Stitches),
+			'stitches'				:	stats.StitchCount,
+			'jumps'						:	stats.JumpCount,
+			'trims'						:	stats.TrimCount,
+			'color_changes'		:	stats.ColorChangeCount,
+			'colors'					:	colors,
+			'width'						:	d.Width,
+			'height'					:	d.Height,
+			'min_x'						:	d.MinX,
+			'min_y'						:	d.MinY,
+			'max_x'						:	d.MaxX,
+			'max_y'						:	d.MaxY,
+			'thread_length'		:	stats.ThreadLength,
+			'palette'					:	palette,
+		} )
+		
+		return path, row, time.time() - start, None
+	except Exception, e:
+		return path, None, time.time() - start, str(e)
+
+# =================================================================
+def OpenDesign(src, cache = None):
+	# Loads a design, through the DesignCache at cache = (directory,
+	# limit) when one is given
+	if cache:
+		return GetDesignCache(*cache).LoadDesign(src)
 	
-	# -------------------------------------------------------------------
-	def OnRotateCounterClockwise(self, e):
-		self.Tabs.GetCurrentPage().OnRotateCounterClockwise( e )
-		self.UpdateTitle()
-			
-	# -------------------------------------------------------------------
-	def OnOpen(self, e):
-		self.Tabs.GetCurrentPage().OnOpen( e )
-		self.UpdateSideBar()
-		self.UpdateTitle()
+	d = Design()
+	d.Load( src, True )
+	return d
+
+# =================================================================
+def MakeParentDirs(path):
+	dirname = os.path.dirname(path)
+	if dirname and not os.path.isdir(dirname):
+		try:
+			os.makedirs(dirname)
+		except OSError:
+			# Another worker may have just created it
+			if not os.path.isdir(dirname):
+				raise
+
+# =================================================================
+def BatchConvert(jobs, processes = None, report = None, worker = ConvertDesign):
+	# Runs worker, ConvertDesign() by default, over jobs on a process pool
+	# and returns its results in completion order. report, if given, is
+	# called with each result as it arrives.
+	results = []
 	
-	# -------------------------------------------------------------------
-	def OnSave(self, e):
-		self.Tabs.GetCurrentPage().OnSave( e )
-		self.Tabs.SetPageText( self.Tabs.GetSelection(), 
-													os.path.basename( self.Tabs.GetCurrentPage().CurrentFile ) )
-		self.UpdateTitle()
+	if processes == 1 or len(jobs) < 2:
+		outputs = itertools.imap( worker, jobs )
+		pool = None
+	else:
+		pool = multiprocessing.Pool( processes )
+		outputs = pool.imap_unordered( worker, jobs, 4 )
 	
-	# -------------------------------------------------------------------
-	def OnSaveAs(self, e):
-		self.Tabs.GetCurrentPage().OnSaveAs( e )
-		self.UpdateTitle()
-					
-	# -------------------------------------------------------------------
-	def ProcessCommand(self, e):
-		self.Tabs.GetCurrentPage().ProcessCommand( e.GetId() )
+	try:
+		for result in outputs:
+			results.append( result )
+			if report:
+				report( result )
+	finally:
+		if pool:
+			pool.close()
+			pool.join()
 	
-	# -------------------------------------------------------------------
-	def OnTabChange(self, e):
-		if e.GetId() == self.Tabs.GetId():
-			self.UpdateSideBar()
+	return results
+
+# =================================================================
+def BatchMain(args):
+	def Move(value):
+		dx, dy = value.split(',')
+		return ('move', int(dx), int(dy))
 	
-	# -------------------------------------------------------------------
-	def UpdateSideBar(self):
-		colorctrl = self.SideBar.GetPage(0)
-		colorctrl.SketchCtrl = self.Tabs.GetCurrentPage()
-		colorctrl.Refresh()
+	def Rotate(value):
+		return ('rotate', float(value))
 	
-	# -------------------------------------------------------------------
-	def UpdateTitle(self):
-		modified = ''
+	def Scale(value):
+		if ',' in value:
+			sx, sy = value.split(',')
+			return ('scale', float(sx), float(sy))
+		return ('scale', float(value), float(value))
+	
+	def Mirror(value):
+		if value not in ('h', 'v'):
+			raise argparse.ArgumentTypeError('mirror must be h or v')
+		return ('mirror', value == 'h')
+	
+	def Format(value):
+		ext = '.' + value.lower().lstrip('.')
+		codec = CodecForExtension( 'design' + ext )
+		if codec is None or not codec.CanSave:
+			raise argparse.ArgumentTypeError('no format saves %s files' % ext)
+		return ext
+	
+	parser = argparse.ArgumentParser( prog = 'pyembroidery.py --batch',
+		description = 'Load, transform and save many designs at once. Transforms are applied in the order given.' )
+	parser.add_argument( 'paths', nargs = '+', metavar = 'PATH',
+		help = '.dst file, directory or glob pattern' )
+	parser.add_argument( '-o', '--output', required = True,
+		help = 'directory to write the converted designs to' )
+	parser.add_argument( '-j', '--jobs', type = int, default = None,
+		help = 'number of worker processes (default: one per CPU)' )
+	parser.add_argument( '-f', '--format', type = Format, default = None, metavar = 'EXT',
+		help = 'save the designs as EXT (%s) instead of their own format' % ', '.join( [ 
+			ext[1:] for codec in CODECS if codec.CanSave for ext in codec.Extensions ] ) )
+	parser.add_argument( '--move', dest = 'transforms', action = 'append', type = Move,
+		metavar = 'DX,DY', help = 'move by DX,DY in 0.1 mm units' )
+	parser.add_argument( '--rotate', dest = 'transforms', action = 'append', type = Rotate,
+		metavar = 'DEGREES', help = 'rotate around the design center' )
+	parser.add_argument( '--scale', dest = 'transforms', action = 'append', type = Scale,
+		metavar = 'S[,SY]', help = 'scale around the design center' )
+	parser.add_argument( '--mirror', dest = 'transforms', action = 'append', type = Mirror,
+		metavar = 'h|v', help = 'mirror left to right (h) or top to bottom (v)' )
+	parser.add_argument( '--normalize', dest = 'transforms', action = 'append_const',
+		const = ('normalize',), help = 'center the design on the origin' )
+	parser.add_argument( '--optimize', dest = 'transforms', action = 'append_const',
+		const = ('optimize',), help = 'reorder stitch runs and merge color blocks to save jumps and color changes' )
+	parser.add_argument( '--estimate', dest = 'transforms', action = 'append_const',
+		const = ('estimate',), help = 'report how long the design takes to sew at this point' )
+	parser.add_argument( '--thumbnails', type = int, default = None, metavar = 'SIZE',
+		help = 'write SIZE x SIZE PNG previews instead of designs' )
+	parser.add_argument( '--cache', nargs = '?', const = DESIGN_CACHE_DIR, default = None,
+		metavar = 'DIR', help = 'reuse decoded designs and previews from a cache (default: %s)' % DESIGN_CACHE_DIR )
+	parser.add_argument( '--cache-limit', type = int, default = DESIGN_CACHE_LIMIT >> 20,
+		metavar = 'MB', help = 'size of the cache in megabytes (default: %(default)s)' )
+	
+	options = parser.parse_args(args)
+	transforms = options.transforms or []
+	
+	if options.cache:
+		cache = (options.cache, options.cache_limit << 20)
+	else:
+		cache = None
+	
+	if options.thumbnails:
+		worker = ThumbnailDesign
+		jobs = [ (path, os.path.join(options.output, name) + '.png', transforms, options.thumbnails, cache) 
+							for path, name in ExpandDesignPaths( options.paths ) ]
+	else:
+		def Output(name):
+			if options.format:
+				name = os.path.splitext(name)[0] + options.format
+			return os.path.join(options.output, name)
+		
+		worker = ConvertDesign
+		jobs = [ (path, Output(name), transforms, cache) 
+							for path, name in ExpandDesignPaths( options.paths ) ]
+	
+	if not jobs:
+		print 'No designs found'
+		return 1
+	
+	def Report(result):
+		src, dst, records, seconds, error, notes = result
+		if error:
+			print 'FAILED %s: %s' % (src, error)
+		else:
+			print '%8.3f s  %8d records  %s -> %s' % (seconds, records, src, dst)
+			for note in notes:
+				print '                            %s' % note
+	
+	start = time.time()
+	results = BatchConvert( jobs, options.jobs, Report, worker )
+	elapsed = max(time.time() - start, 1e-9)
+	
+	failed = len([ r for r in results if r[4] ])
+	records = sum([ r[2] for r in results ])
+	
+	print '%s designs (%s failed), %s records in %.2f s: %.1f designs/s, %.0f records/s' % (
+		len(results), failed, records, elapsed, len(results) / elapsed, records / elapsed )
+	
+	if failed:
+		return 1
+	
+	return 0
+
+# =================================================================
+def CatalogMain(args):
+	parser = argparse.ArgumentParser( prog = 'pyembroidery.py --catalog',
+		description = 'Index a design library and find designs in it by size, colors and stitch count.' )
+	parser.add_argument( 'paths', nargs = '*', metavar = 'PATH',
+		help = '.dst file, directory or glob pattern to index before searching' )
+	parser.add_argument( '--db', default = CATALOG_PATH,
+		help = 'catalog database (default: %(default)s)' )
+	parser.add_argument( '-j', '--jobs', type = int, default = None,
+		help = 'number of worker processes (default: one per CPU)' )
+	parser.add_argument( '--cache', nargs = '?', const = DESIGN_CACHE_DIR, default = None,
+		metavar = 'DIR', help = 'load designs through a cache (default: %s)' % DESIGN_CACHE_DIR )
+	parser.add_argument( '--cache-limit', type = int, default = DESIGN_CACHE_LIMIT >> 20,
+		metavar = 'MB', help = 'size of the cache in megabytes (default: %(default)s)' )
+	parser.add_argument( '--max-width', type = float, default = None, metavar = 'MM',
+		help = 'only designs at most MM wide' )
+	parser.add_argument( '--max-height', type = float, default = None, metavar = 'MM',
+		help = 'only designs at most MM high' )
+	parser.add_argument( '--max-colors', type = int, default = None, metavar = 'N',
+		help = 'only designs with at most N thread colors' )
+	parser.add_argument( '--max-stitches', type = int, default = None, metavar = 'N',
+		help = 'only designs with at most N stitches' )
+	parser.add_argument( '--name', default = None,
+		help = 'only designs whose name or path contains NAME' )
+	parser.add_argument( '--limit', type = int, default = None, metavar = 'N',
+		help = 'list at most N designs' )
+	
+	options = parser.parse_args(args)
+	
+	catalog = DesignCatalog( options.db )
+	failed = 0
+	
+	try:
+		if options.paths:
+			if options.cache:
+				cache = (options.cache, options.cache_limit << 20)
+			else:
+				cache = None
+			
+			def Report(result):
+				path, row, seconds, error = result
+				if error:
+					print 'FAILED %s: %s' % (path, error)
+			
+			start = time.time()
+			results = catalog.Update( options.paths, options.jobs, cache, Report )
+			failed = len([ r for r in results if r[3] ])
+			
+			print '%s designs in catalog, %s reindexed (%s failed) in %.2f s' % (
+				len(catalog), len(results), failed, time.time() - start )
 		
-		if self.Tabs.GetCurrentPage().Modified:
-			modified = '*'
+		def Units(mm):
+			if mm is None:
+				return None
+			return int(mm * 10)
 		
-		currentfile = self.Tabs.GetCurrentPage().CurrentFile
+		start = time.time()
+		rows = catalog.Query( Units(options.max_width), Units(options.max_height), 
+			options.max_colors, options.max_stitches, options.name, options.limit )
+		elapsed = time.time() - start
 		
-		if not currentfile:
-			self.Tabs.SetPageText( self.Tabs.GetSelection(), 'Untitled' )
-			self.SetTitle( APP_NAME )
-			return
+		for row in rows:
+			print '%7.1f x %7.1f mm  %3d colors  %8d stitches  %s' % (
+				row['width'] / 10.0, row['height'] / 10.0, row['colors'], row['stitches'], row['path'] )
 		
-		self.Tabs.SetPageText( self.Tabs.GetSelection(), 
-												'%s %s' % ( os.path.basename( currentfile ) ,
-																		modified )
-												)
-		self.SetTitle( '%s - %s %s' % (APP_NAME, currentfile, modified) )
+		print '%s designs found in %.1f ms' % ( len(rows), elapsed * 1000 )
+	finally:
+		catalog.Close()
+	
+	if failed:
+		return 1
+	
+	return 0
 
 # =================================================================			
 def Run():
-	wx.InitAllImageHandlers()
-	app = wx.PySimpleApp()
-	frame = MainWnd(None, -1, APP_NAME)
-	frame.Show(1)
-	app.MainLoop()
+	# The GUI and wxPython are only loaded here, so importing this module
+	# for headless use stays fast and needs no display
+	import pyembroiderygui
+	pyembroiderygui.Run()
 
 # =================================================================			
 if __name__ == '__main__':
-	Run()
+	if len(sys.argv) > 2 and sys.argv[1] == '--benchmark':
+		for filename in sys.argv[2:]:
+			BenchmarkTajima(filename)
+	elif len(sys.argv) > 1 and sys.argv[1] == '--batch':
+		sys.exit( BatchMain(sys.argv[2:]) )
+	elif len(sys.argv) > 1 and sys.argv[1] == '--catalog':
+		sys.exit( CatalogMain(sys.argv[2:]) )
+	elif len(sys.argv) > 1 and sys.argv[1] == '--fuzz':
+		# The fuzz harness is only loaded here, as the GUI is by Run()
+		import pyembroideryfuzz
+		sys.exit( pyembroideryfuzz.FuzzMain(sys.argv[2:]) )
+	else:
+		Run()
 	#d = Design()
 	#d.Load('the.end.2.dst')
 	
@@ -0,0 +1,436 @@
+# PyEmbroidery
+#
+# Round trip fuzzing of the design formats in pyembroidery.py, run with
+# pyembroidery.py --fuzz. Random designs and edge cases are saved and
+# loaded again through every codec and the DST codec is checked against
+# the original record by record one.
+#
+# Created by Jackson Yee (jackson.yee@gmail.com)
+# Project located at http://pyembroidery.googlecode.com/
+#
+# All code here is released under the GPL version 2 at
+# http://www.gnu.org/copyleft/gpl.html
+#
+# Enjoy what's here so far, and send any bug fixes back to me!
+
+import os
+import argparse
+import random
+import time
+import itertools
+import tempfile
+import shutil
+
+from pyembroidery import (CODECS, CodecForExtension, Design, EstimateSewTime, FindSaveCodec, 
+	OptimizeStitches, SplitMove, StitchList, StitchStats, TAJIMA_MAX_MOVE, TAJIMA_TRIM_JUMPS)
+
+# =================================================================
+def RandomStitches(rng, count, longmoves = True):
+	# A random StitchList of about count records for FuzzTajima(). Most
+	# moves are short but some are as long as a DST record allows, or
+	# longer when longmoves is set, and it has runs of jumps and of
+	# color changes.
+	JUMP		=	Design.JUMP
+	COLOR		=	Design.COLOR
+	limit		=	TAJIMA_MAX_MOVE
+	
+	stitches	=	StitchList()
+	x					=	0
+	y					=	0
+	color			=	0
+	
+	def Move(longest):
+		r = rng.random()
+		if r < 0.1:
+			return rng.choice( (-longest, longest) )
+		if r < 0.3:
+			return rng.randint( -longest, longest )
+		return rng.randint( -20, 20 )
+	
+	while len(stitches) < count:
+		r = rng.random()
+		
+		if r < 0.03:
+			for i in xrange( rng.randint(1, 3) ):
+				color += 1
+				stitches.append( [color, 0, COLOR] )
+		elif r < 0.15:
+			for i in xrange( rng.randint(1, 2 * TAJIMA_TRIM_JUMPS) ):
+				if longmoves:
+					x += Move( 4 * limit )
+					y += Move( 4 * limit )
+				else:
+					x += Move( limit )
+					y += Move( limit )
+				stitches.append( [x, y, JUMP] )
+		else:
+			if longmoves and rng.random() < 0.05:
+				x += Move( 3 * limit )
+				y += Move( 3 * limit )
+			else:
+				x += Move( limit )
+				y += Move( limit )
+			stitches.append( [x, y] )
+	
+	return stitches
+
+# =================================================================
+def FuzzCorpus():
+	# Edge cases every FuzzTajima() run checks, as (name, StitchList)
+	JUMP		=	Design.JUMP
+	COLOR		=	Design.COLOR
+	limit		=	TAJIMA_MAX_MOVE
+	corpus	=	[]
+	
+	def Walk(moves):
+		# Records from (dx, dy, flags) moves
+		x = 0
+		y = 0
+		records = []
+		
+		for dx, dy, flags in moves:
+			if flags == COLOR:
+				records.append( [len([ r for r in records if len(r) == 3 and r[2] == COLOR ]) + 1, 0, COLOR] )
+				continue
+			
+			x += dx
+			y += dy
+			
+			if flags:
+				records.append( [x, y, flags] )
+			else:
+				records.append( [x, y] )
+		
+		return StitchList( records )
+	
+	corpus.append( ('empty', StitchList()) )
+	corpus.append( ('one stitch', Walk( [ (5, -5, 0) ] )) )
+	
+	corpus.append( ('largest moves', Walk( [ (dx, dy, flags) 
+		for dx in (-limit, 0, limit) for dy in (-limit, 0, limit) for flags in (0, JUMP) ] )) )
+	
+	corpus.append( ('every delta', Walk( [ (d, (d * 7) % (2 * limit + 1) - limit, 0) 
+		for d in xrange(-limit, limit + 1) ] )) )
+	
+	corpus.append( ('consecutive color changes', Walk( 
+		[ (0, 0, COLOR), (0, 0, COLOR), (10, 10, 0), (0, 0, COLOR), (0, 0, COLOR), (0, 0, COLOR), 
+			(-10, 5, 0), (0, 0, COLOR), (0, 0, COLOR) ] )) )
+	
+	corpus.append( ('only color changes', Walk( [ (0, 0, COLOR) ] * 5 )) )
+	
+	chains = []
+	for n in xrange(1, 2 * TAJIMA_TRIM_JUMPS + 1):
+		chains.append( (3, 3, 0) )
+		chains.extend( [ (40, -30, JUMP) ] * n )
+	corpus.append( ('jump chains', Walk( chains + [ (1, 1, 0) ] )) )
+	
+	corpus.append( ('trailing jumps', Walk( [ (3, 3, 0), (100, 0, JUMP), (100, 0, JUMP) ] )) )
+	
+	corpus.append( ('long moves', Walk( [ (d, -d, flags) 
+		for d in (limit + 1, 2 * limit, 2 * limit + 1, 1000, -3000) for flags in (0, JUMP) ] )) )
+	
+	corpus.append( ('zero moves', Walk( [ (0, 0, 0), (0, 0, JUMP), (0, 0, JUMP), (0, 0, JUMP), (0, 0, 0) ] )) )
+	
+	return corpus
+
+# =================================================================
+def InRecordRange(stitches, limit = None):
+	# Whether every move fits in a single record of at most limit units,
+	# TAJIMA_MAX_MOVE by default
+	if limit is None:
+		limit = TAJIMA_MAX_MOVE
+	
+	x = 0
+	y = 0
+	
+	for sx, sy, flags in itertools.izip( stitches.X, stitches.Y, stitches.Flags ):
+		if flags == Design.COLOR:
+			continue
+		
+		if abs(sx - x) > limit or abs(sy - y) > limit:
+			return False
+		
+		x = sx
+		y = sy
+	
+	return True
+
+# =================================================================
+def SewingPath(stitches, limit = None):
+	# What a machine sews from stitches, which every codec has to keep:
+	# the points of each color block and where the needle ends up. Jumps
+	# may be merged or split on the way. Stitches longer than limit are
+	# split into steps by SplitMove() as the codecs save them.
+	blocks	=	[ [] ]
+	x				=	0
+	y				=	0
+	
+	for sx, sy, flags in itertools.izip( stitches.X, stitches.Y, stitches.Flags ):
+		if flags == Design.COLOR:
+			blocks.append( [] )
+			continue
+		
+		if not flags:
+			if limit and (abs(sx - x) > limit or abs(sy - y) > limit):
+				blocks[-1].extend( SplitMove( x, y, sx, sy, limit ) )
+			else:
+				blocks[-1].append( (sx, sy) )
+		
+		x = sx
+		y = sy
+	
+	return blocks, (x, y)
+
+# =================================================================
+def FuzzDesign(stitches):
+	# A design to save stitches from, with a color for every block
+	d = Design()
+	d.Name			=	'fuzz'
+	d.Colors		=	[ (i * 37 % 256, i * 91 % 256, i * 53 % 256) for i in xrange(len(stitches.ColorChanges) + 1) ]
+	d.ColorsRead	=	1
+	d.AddStitches( stitches )
+	return d
+
+# =================================================================
+def CheckRecordCodec(stitches):
+	# Differential check of the table encoder against the original
+	# record at a time EncodeTajimaStitch(), and of the block decoder
+	# against DecodeTajimaRecords(), byte for byte. Only for stitches
+	# whose moves all fit in a record, as the original can't split.
+	old = Design()
+	parts = []
+	
+	for s in stitches:
+		if len(s) == 2:
+			parts.append( old.EncodeTajimaStitch( [s[0], -s[1]] ) )
+		elif s[2] == Design.COLOR:
+			parts.append( old.EncodeTajimaStitch( s ) )
+		else:
+			parts.append( old.EncodeTajimaStitch( [s[0], -s[1], s[2]] ) )
+	
+	body = ''.join(parts)
+	
+	new = Design()
+	
+	if new.EncodeTajima( stitches, False ) != body:
+		raise ValueError('EncodeTajima() does not match EncodeTajimaStitch()')
+	
+	old = Design()
+	old.Colors.append( old.RandomColor() )
+	old.ColorsRead = 1
+	old.DecodeTajimaRecords( body )
+	
+	new = Design()
+	new.Colors.append( new.RandomColor() )
+	new.ColorsRead = 1
+	new.DecodeTajima( body )
+	
+	if (old.Stitches != new.Stitches
+			or old.JumpStitches != new.JumpStitches
+			or old.ColorChanges != new.ColorChanges):
+		raise ValueError('DecodeTajima() does not match DecodeTajimaRecords()')
+	
+	if new.Stitches != stitches:
+		raise ValueError('decoding the records does not give back the stitches')
+
+# =================================================================
+def CheckRoundTrip(stitches, filename, exact = False):
+	# Saves stitches as filename and loads them back. With exact set
+	# the records must come back as they were, which holds for DST saved
+	# without merging jumps when every move fits in a record; otherwise
+	# the sewing path must.
+	d = FuzzDesign( stitches )
+	
+	if exact:
+		d.SaveTajima( filename, False )
+	else:
+		d.Save( filename )
+	
+	loaded = Design()
+	loaded.Load( filename )
+	
+	name = os.path.basename(filename)
+	
+	if exact:
+		if loaded.Stitches != stitches:
+			raise ValueError('%s does not load back the records it saved' % name)
+		return
+	
+	limit = CodecForExtension( filename ).MaxMove
+	
+	if SewingPath( loaded.Stitches ) != SewingPath( stitches, limit ):
+		raise ValueError('%s does not load back the path it saved' % name)
+	
+	# A jump split into enough steps is read as a trim, but no trim may
+	# be lost, and none added when no move had to be split
+	trims = StitchStats().Update( stitches ).TrimCount
+	stats = loaded.CalcStitchExtent()
+	
+	if stats.TrimCount < trims or (stats.TrimCount != trims and InRecordRange( stitches, limit )):
+		raise ValueError('%s loads %s trims instead of %s' % ( name, stats.TrimCount, trims ))
+	
+	if len(loaded.Stitches) and stats.ColorChangeCount != len(stitches.ColorChanges):
+		raise ValueError('%s loads %s color changes instead of %s' % ( 
+			name, stats.ColorChangeCount, len(stitches.ColorChanges) ))
+
+# =================================================================
+def CheckChunkedWrite(stitches, filename, rng):
+	# Differential check of a design written in random chunks, as
+	# StreamConvert() does, against one written whole. DST must match
+	# byte for byte; other formats may stamp the time, so they must load
+	# the same records.
+	d = FuzzDesign( stitches )
+	d.Save( filename )
+	
+	whole = file(filename, 'rb').read()
+	
+	d = FuzzDesign( stitches )
+	writer = FindSaveCodec( filename ).Writer( d, filename )
+	start = 0
+	
+	while start < len(stitches):
+		end = min( len(stitches), start + rng.randint(1, 64) )
+		writer.Write( stitches.Slice( start, end ) )
+		start = end
+	
+	writer.Close()
+	
+	if filename.lower().endswith('.dst'):
+		if file(filename, 'rb').read() != whole:
+			raise ValueError('%s written in chunks differs from the whole design' % os.path.basename(filename))
+		return
+	
+	chunked = Design()
+	chunked.Load( filename )
+	
+	f = file(filename, 'wb')
+	f.write( whole )
+	f.close()
+	
+	loaded = Design()
+	loaded.Load( filename )
+	
+	if chunked.Stitches != loaded.Stitches:
+		raise ValueError('%s written in chunks differs from the whole design' % os.path.basename(filename))
+
+# =================================================================
+def CheckOptimizeLayering():
+	# A red run whose first stitch is sewn across a green column must
+	# not be merged into the red block before the green one
+	JUMP	=	Design.JUMP
+	COLOR	=	Design.COLOR
+	
+	stitches = StitchList( [ [0, 0], [10, 0], 
+		[1, 0, COLOR], [15, -10, JUMP], [15, -10], [15, 10], 
+		[2, 0, COLOR], [14, 0, JUMP], [30, 0] ] )
+	
+	out, colors, report = OptimizeStitches( stitches, [ (255, 0, 0), (0, 255, 0), (255, 0, 0) ] )
+	
+	if len(out.ColorChanges) != len(stitches.ColorChanges):
+		raise ValueError('A red run crossing the green one was moved under it')
+
+# =================================================================
+def CheckOptimize(stitches, rng):
+	# The optimizer keeps every stitch, never makes a design slower to
+	# sew and reports the time it saves
+	colors = [ rng.choice( ((255, 0, 0), (0, 255, 0), (0, 0, 255)) ) 
+							for i in xrange(len(stitches.ColorChanges) + 1) ]
+	
+	out, colors, report = OptimizeStitches( stitches, colors )
+	
+	before	=	stitches.GetStats()
+	after		=	out.GetStats()
+	
+	if after.StitchCount != before.StitchCount:
+		raise ValueError('The optimizer made %s stitches of %s' % ( after.StitchCount, before.StitchCount ))
+	
+	saved = EstimateSewTime( before ).TotalSeconds - EstimateSewTime( after ).TotalSeconds
+	
+	if saved < 0 or abs(saved - report.SecondsSaved) > 1e-6:
+		raise ValueError('The optimizer saved %.1f s but reported %.1f s' % ( saved, report.SecondsSaved ))
+
+# =================================================================
+def FuzzTajima(iterations = 100, seed = None, directory = None, report = None):
+	# Round trips FuzzCorpus() and iterations random designs through
+	# every format that can be saved, checks the DST record codec
+	# against the original one and that the optimizer keeps layering
+	# and never makes a design slower.
+	# Returns the failures as (case, error); report, if given, is called
+	# with each one as it happens. Files are written to directory, or to
+	# a temporary one that is removed.
+	if seed is None:
+		seed = random.randrange( 1 << 30 )
+	
+	rng				=	random.Random( seed )
+	failures	=	[]
+	cases			=	FuzzCorpus()
+	keep			=	directory is not None
+	
+	for i in xrange(iterations):
+		count = rng.choice( (1, 10, 100, 1000) )
+		cases.append( ('seed %s case %s' % (seed, i), RandomStitches( rng, count, rng.random() < 0.5 )) )
+	
+	if directory is None:
+		directory = tempfile.mkdtemp( prefix = 'pyembroidery-fuzz-' )
+	
+	extensions = [ ext for codec in CODECS if codec.CanSave for ext in codec.Extensions[:1] ]
+	
+	def Check(name, test, *args):
+		try:
+			test( *args )
+		except Exception, e:
+			failure = ( name, '%s: %s' % (e.__class__.__name__, e) )
+			failures.append( failure )
+			if report:
+				report( failure )
+	
+	Check( 'optimizer layering', CheckOptimizeLayering )
+	
+	try:
+		for name, stitches in cases:
+			base = os.path.join( directory, 'fuzz' )
+			
+			if InRecordRange( stitches ):
+				Check( name, CheckRecordCodec, stitches )
+				Check( name, CheckRoundTrip, stitches, base + '-exact.dst', True )
+			
+			for ext in extensions:
+				Check( name, CheckRoundTrip, stitches, base + ext )
+				Check( name, CheckChunkedWrite, stitches, base + '-chunked' + ext, rng )
+			
+			Check( name, CheckOptimize, stitches, rng )
+	finally:
+		if not keep:
+			shutil.rmtree( directory, True )
+	
+	return failures
+
+# =================================================================
+def FuzzMain(args):
+	parser = argparse.ArgumentParser( prog = 'pyembroidery.py --fuzz',
+		description = 'Round trip edge cases and random designs through every format and check the DST codec against the original one.' )
+	parser.add_argument( 'iterations', nargs = '?', type = int, default = 100,
+		help = 'number of random designs (default: %(default)s)' )
+	parser.add_argument( '--seed', type = int, default = None,
+		help = 'seed to repeat a run with' )
+	parser.add_argument( '--keep', default = None, metavar = 'DIR',
+		help = 'write the files to DIR and leave them there' )
+	
+	options = parser.parse_args(args)
+	
+	if options.seed is None:
+		options.seed = random.randrange( 1 << 30 )
+	
+	def Report(failure):
+		print 'FAILED %s: %s' % failure
+	
+	start = time.time()
+	failures = FuzzTajima( options.iterations, options.seed, options.keep, Report )
+	
+	print '%s random designs with seed %s, %s failures in %.2f s' % ( 
+		options.iterations, options.seed, len(failures), time.time() - start )
+	
+	if failures:
+		return 1
+	
+	return 0
@@ -0,0 +1,860 @@
+# PyEmbroidery
+#
+# wxPython user interface for viewing (and eventually editing and
+# digitizing) embroidery designs. The design model and file formats live
+# in pyembroidery.py, which can be used without wxPython; this module is
+# only imported when the GUI is started with pyembroidery.Run().
+#
+# Created by Jackson Yee (jackson.yee@gmail.com)
+# Project located at http://pyembroidery.googlecode.com/
+#
+# All code here is released under the GPL version 2 at
+# http://www.gnu.org/copyleft/gpl.html
+#
+# Enjoy what's here so far, and send any bug fixes back to me!
+
+import os
+import time
+import threading
+import wx
+
+from pyembroidery import APP_NAME, Design, DesignWildcard, GetDesignCache, UndoLog
+
+# Background of cached design bitmaps, masked out when they are drawn
+MASK_COLOUR	=	(0xFE, 0x01, 0xFE)
+
+# Largest cached design bitmap in pixels; bigger views are drawn directly
+DESIGN_BITMAP_LIMIT	=	4096 * 4096
+
+# Records decoded by the loading thread before they are handed to the
+# GUI, the range of the progress dialog and the shortest time in seconds
+# between repaints of a design that is still loading
+LOAD_CHUNK					=	16384
+LOAD_PROGRESS_RANGE	=	1000
+LOAD_REFRESH				=	0.25
+
+# IDs
+(	NEW_TAB,
+	CLOSE_TAB,
+	ROTATE_CLOCKWISE,
+	ROTATE_COUNTERCLOCKWISE,
+	OPEN_IMAGE,
+	CLOSE_IMAGE,
+	MOVE_LEFT,
+	MOVE_RIGHT,
+	MOVE_UP,
+	MOVE_DOWN,
+)	=	range( wx.ID_HIGHEST, wx.ID_HIGHEST + 10)
+
+# *********************************************************************
+class Sketch(object):
+	
+	# -------------------------------------------------------------------
+	def __init__(self):
+		self.Clear()
+	
+	# -------------------------------------------------------------------
+	def Clear(self):
+		if hasattr(self, 'Image'):
+			if self.Image:
+				self.Image.Destroy()
+			
+		self.Image	=	None
+		self.Design	=	Design()
+		self.UndoList	=	UndoLog()
+	
+	# -------------------------------------------------------------------
+	def LoadImage(self, filename):
+		self.Image.LoadFile(filename, wx.BITMAP_TYPE_ANY)
+
+# *********************************************************************
+class ToolCtrl(wx.Window):
+	
+	# -------------------------------------------------------------------
+	def __init__(self, parent, wid, pstyle):
+		wx.Window.__init__(self, parent, wid, style = pstyle)
+
+# *********************************************************************
+class SketchCtrl(wx.Window):
+	
+	# -------------------------------------------------------------------
+	def __init__(self, parent, wid, pstyle):
+		wx.Window.__init__(self, parent, wid, style = pstyle)
+		
+		self.Clear()
+		
+		self.Bind( wx.EVT_PAINT, self.OnPaint )
+		self.Bind( wx.EVT_KEY_DOWN, self.OnKeyDown )		
+		self.Bind( wx.EVT_WINDOW_DESTROY, self.OnDestroy )
+		
+	# -------------------------------------------------------------------
+	def Clear(self):
+		if hasattr(self, 'LoadCancel'):
+			self.CancelLoad()
+		
+		self.LoadCancel			=	None
+		self.LoadProgress		=	None
+		self.LoadRefreshed	=	0
+		self.CurrentFile		=	None
+		self.cx							=	0
+		self.cy							=	0
+		self.Magnification	=	1.0
+		self.Modified				=	False
+		self.DesignCacheKey	=	None
+		self.DesignBitmap		=	None
+		
+		self.Sketch 				= Sketch()
+		
+		self.Refresh()
+		
+	# -------------------------------------------------------------------
+	def OnPaint(self, e):
+		dc = wx.PaintDC(self)
+		
+		w, h = dc.GetSizeTuple()
+		
+		dc.SetBrush( wx.WHITE_BRUSH )
+		dc.DrawRectangle( 0, 0, w, h )
+		dc.SetBrush( wx.NullBrush )
+		
+		m = self.Magnification
+		dc.SetUserScale(m, m)
+		
+		self.DrawImage(dc, self.cx, self.cy)
+		self.DrawDesign(dc, self.cx, self.cy)
+	
+	# -------------------------------------------------------------------
+	def DrawImage(self, dc, cx, cy):
+		if not self.Sketch.Image:
+			return
+		
+		dc.DrawBitmap( wx.BitmapFromImage( self.Sketch.Image ), 
+			cx - (self.Sketch.Image.GetWidth() / 2), 
+			cy - (self.Sketch.Image.GetHeight() / 2))
+		
+	# -------------------------------------------------------------------
+	def DrawDesign(self, dc, cx, cy):
+		# The design is drawn into an off-screen bitmap that is reused
+		# until the design, its colors or the magnification change
+		if not self.Sketch.Design.Valid():
+			return
+		
+		m = self.Magnification
+		cached = self.GetDesignBitmap()
+		
+		if not cached:
+			self.DrawVisibleLines(dc, cx, cy)
+			return
+		
+		bitmap, x, y = cached
+		
+		dc.SetUserScale(1, 1)
+		dc.DrawBitmap( bitmap, int(round((x + cx) * m)), int(round((y + cy) * m)), True )
+		dc.SetUserScale(m, m)
+	
+	# -------------------------------------------------------------------
+	def GetDesignBitmap(self):
+		# Returns (bitmap, x, y) with the design drawn at the current
+		# magnification and (x, y) the design point at its top left
+		d = self.Sketch.Design
+		stitches = d.Stitches
+		m = self.Magnification
+		key = (len(stitches), stitches.Version, tuple(d.Colors), m)
+		
+		if self.DesignCacheKey and self.DesignCacheKey[0] is stitches and self.DesignCacheKey[1] == key:
+			return self.DesignBitmap
+		
+		self.DesignCacheKey = (stitches, key)
+		self.DesignBitmap = None
+		
+		# Include the origin, where the first stitch starts from, and a
+		# one unit margin for the pen width
+		d.CalcStitchExtent()
+		minx = min(d.MinX, 0) - 1
+		miny = min(d.MinY, 0) - 1
+		maxx = max(d.MaxX, 0) + 1
+		maxy = max(d.MaxY, 0) + 1
+		
+		w = int((maxx - minx) * m) + 1
+		h = int((maxy - miny) * m) + 1
+		
+		if w < 1 or h < 1 or w * h > DESIGN_BITMAP_LIMIT:
+			return None
+		
+		bitmap = wx.EmptyBitmap(w, h)
+		
+		mdc = wx.MemoryDC( bitmap )
+		mdc.SetBackground( wx.Brush( wx.Colour( *MASK_COLOUR ) ) )
+		mdc.Clear()
+		mdc.SetUserScale(m, m)
+		self.DrawDesignLines(mdc, -minx, -miny)
+		mdc.SelectObject( wx.NullBitmap )
+		
+		bitmap.SetMask( wx.Mask( bitmap, wx.Colour( *MASK_COLOUR ) ) )
+		
+		self.DesignBitmap = (bitmap, minx, miny)
+		return self.DesignBitmap
+	
+	# -------------------------------------------------------------------
+	def DrawVisibleLines(self, dc, cx, cy):
+		# Zoomed in too far to cache the whole design, so only the
+		# segments the spatial index finds inside the window are drawn
+		d = self.Sketch.Design
+		stitches = d.Stitches
+		m = self.Magnification
+		w, h = self.GetClientSizeTuple()
+		
+		visible = stitches.GetIndex().Query( -cx, -cy, w / m - cx, h / m - cy )
+		
+		lines = []
+		pens = []
+		pen = {}
+		
+		for i in visible:
+			color = stitches.Color(i)
+			
+			if color not in pen:
+				c = d.Colors[color]
+				pen[color] = wx.Pen( wx.Colour( c[0], c[1], c[2] ) )
+			
+			x0, y0 = stitches.Position(i)
+			lines.append( (x0 + cx, y0 + cy, stitches.X[i] + cx, stitches.Y[i] + cy) )
+			pens.append( pen[color] )
+		
+		if lines:
+			dc.DrawLineList( lines, pens )
+	
+	# -------------------------------------------------------------------
+	def DrawDesignLines(self, dc, cx, cy):
+		# One DrawLines call per color block, with one pen per color. When
+		# zoomed out the blocks come from a simplified level of the
+		# design's detail pyramid.
+		d = self.Sketch.Design
+		pyramid = d.Stitches.GetPyramid()
+		pens = {}
+		
+		for color, points in pyramid.Blocks( self.Magnification ):
+			if len(points) < 2:
+				continue
+			
+			if color not in pens:
+				c = d.Colors[color]
+				pens[color] = wx.Pen( wx.Colour( c[0], c[1], c[2] ) )
+			
+			dc.SetPen( pens[color] )
+			dc.DrawLines( points, cx, cy )
+		
+		dc.SetPen( wx.NullPen )
+	
+	# -------------------------------------------------------------------
+	def OnRotateClockwise(self, e):
+		d = self.Sketch.Design
+		
+		if d.Valid():
+			self.Sketch.UndoList.Transform( d, d.Rotate, 90 )
+			self.Sketch.UndoList.Checkpoint()
+			self.Modified = True
+			self.Refresh()
+	
+	# -------------------------------------------------------------------
+	def OnRotateCounterClockwise(self, e):
+		d = self.Sketch.Design
+		
+		if d.Valid():
+			self.Sketch.UndoList.Transform( d, d.Rotate, 270 )
+			self.Sketch.UndoList.Checkpoint()
+			self.Modified = True
+			self.Refresh()
+	
+	# -------------------------------------------------------------------
+	def OnUndo(self, e):
+		if self.Sketch.UndoList.Undo( self.Sketch.Design ):
+			self.Modified = True
+			self.Refresh()
+	
+	# -------------------------------------------------------------------
+	def OnRedo(self, e):
+		if self.Sketch.UndoList.Redo( self.Sketch.Design ):
+			self.Modified = True
+			self.Refresh()
+			
+	# -------------------------------------------------------------------
+	def OnOpen(self, e):
+		dlg = wx.FileDialog(self, 
+						'Which embroidery design would you like to open?',
+						wildcard = DesignWildcard(),
+						style = wx.OPEN | wx.FILE_MUST_EXIST)
+		
+		if dlg.ShowModal() == wx.ID_OK:
+			try:
+				self.StartLoad( dlg.GetPath() )
+			except Exception, e:
+				wx.MessageBox('Could not read the file that you wanted to load: %s' % e,
+					"Hmm... there's a problem here",
+					wx.ICON_ERROR | wx.OK)
+	
+	# -------------------------------------------------------------------
+	def StartLoad(self, p):
+		# Decodes the design on a worker thread, which hands each chunk of
+		# stitches back with wx.CallAfter so the design is drawn as it
+		# arrives, or the whole design at once if it was cached. Each load
+		# gets its own cancel event, which also tells stale calls from an
+		# earlier load to ignore themselves.
+		self.CancelLoad()
+		
+		d = self.Sketch.Design
+		chunks = d.LoadChunks( p, chunksize = LOAD_CHUNK )
+		self.Sketch.UndoList.Clear()
+		
+		self.CurrentFile		=	p
+		self.Modified				=	False
+		self.LoadCancel			=	threading.Event()
+		self.LoadRefreshed	=	0
+		self.LoadProgress		=	wx.ProgressDialog( APP_NAME,
+															'Loading %s' % os.path.basename(p),
+															LOAD_PROGRESS_RANGE,
+															self.GetTopLevelParent(),
+															wx.PD_CAN_ABORT | wx.PD_AUTO_HIDE | wx.PD_ELAPSED_TIME | wx.PD_REMAINING_TIME )
+		
+		worker = threading.Thread( target = self.LoadWorker, 
+															args = (p, chunks, os.path.getsize(p), self.LoadCancel) )
+		worker.setDaemon( True )
+		worker.start()
+		
+		self.Refresh()
+	
+	# -------------------------------------------------------------------
+	def LoadWorker(self, p, chunks, size, cancel):
+		# Runs on the loading thread and never touches the design itself
+		done = 512
+		key = None
+		cache = None
+		cached = None
+		
+		try:
+			try:
+				# Hashing reads the whole file before anything can be drawn,
+				# so a design that wasn't cached is only hashed once it is
+				cache = GetDesignCache()
+				
+				if cache.Seen(p):
+					key = cache.Key(p)
+					cached = cache.Fetch(key)
+			except EnvironmentError:
+				# Without a usable cache the file is simply parsed
+				cache = None
+			
+			if cached is not None:
+				wx.CallAfter( self.OnLoadDone, cancel, None, None, cached )
+				return
+			
+			try:
+				for chunk in chunks:
+					if cancel.isSet():
+						return
+					
+					done += 3 * len(chunk)
+					wx.CallAfter( self.OnLoadChunk, cancel, chunk, done, size )
+			except Exception, e:
+				wx.CallAfter( self.OnLoadDone, cancel, e )
+				return
+			
+			if key is None and cache is not None:
+				try:
+					key = cache.Key(p)
+				except EnvironmentError:
+					pass
+		finally:
+			chunks.close()
+		
+		wx.CallAfter( self.OnLoadDone, cancel, None, key )
+	
+	# -------------------------------------------------------------------
+	def OnLoadChunk(self, cancel, chunk, done, size):
+		if not self or cancel is not self.LoadCancel:
+			return
+		
+		d = self.Sketch.Design
+		d.AddStitches( chunk )
+		d.CalcStitchExtent()
+		
+		keepgoing = self.LoadProgress.Update( min( LOAD_PROGRESS_RANGE - 1, 
+																						done * LOAD_PROGRESS_RANGE / max(size, 1) ) )
+		
+		# Newer wxPython versions return (continue, skip)
+		if isinstance(keepgoing, tuple):
+			keepgoing = keepgoing[0]
+		
+		if not keepgoing:
+			# Half a design must never be saved over the original file
+			self.CancelLoad()
+			d.Clear()
+			self.CurrentFile = None
+			self.Refresh()
+			self.UpdateFrame()
+			return
+		
+		now = time.time()
+		
+		if now - self.LoadRefreshed >= LOAD_REFRESH:
+			self.LoadRefreshed = now
+			self.cx = -d.MinX + 12
+			self.cy = -d.MinY + 12
+			self.Refresh()
+	
+	# -------------------------------------------------------------------
+	def OnLoadDone(self, cancel, error, key = None, cached = None):
+		if not self or cancel is not self.LoadCancel:
+			return
+		
+		self.LoadCancel = None
+		self.LoadProgress.Destroy()
+		self.LoadProgress = None
+		
+		if cached is not None:
+			self.Sketch.Design = cached
+		
+		d = self.Sketch.Design
+		
+		if error:
+			self.CurrentFile = None
+			wx.MessageBox('Could not read the file that you wanted to load: %s' % error,
+				"Hmm... there's a problem here",
+				wx.ICON_ERROR | wx.OK)
+		elif key:
+			try:
+				GetDesignCache().Store( key, d, self.CurrentFile )
+			except EnvironmentError, e:
+				print 'Could not cache design: %s' % e
+		
+		d.CalcStitchExtent()
+		d.Stitches.GetPyramid()
+		d.Stitches.GetIndex()
+		
+		self.cx = -d.MinX + 12
+		self.cy = -d.MinY + 12
+		
+		self.Refresh()
+		self.UpdateFrame()
+	
+	# -------------------------------------------------------------------
+	def CancelLoad(self):
+		if self.LoadCancel:
+			self.LoadCancel.set()
+			self.LoadCancel = None
+		
+		if self.LoadProgress:
+			self.LoadProgress.Destroy()
+			self.LoadProgress = None
+	
+	# -------------------------------------------------------------------
+	def OnDestroy(self, e):
+		if e.GetEventObject() is self:
+			self.CancelLoad()
+		
+		e.Skip()
+	
+	# -------------------------------------------------------------------
+	def UpdateFrame(self):
+		# Lets the main window refresh its color list and title once the
+		# design has finished loading
+		top = self.GetTopLevelParent()
+		
+		if hasattr(top, 'UpdateSideBar'):
+			top.UpdateSideBar()
+			top.UpdateTitle()
+	
+	# -------------------------------------------------------------------
+	def OnOpenImage(self, e):
+		dlg = wx.FileDialog(self, 
+						'Which image would you like to open?',
+						wildcard = 'All images (*.bmp;*.png;*.jpg;*.gif;*.pcx;*.tif;*.xpm)|*.bmp;*.png;*.jpg;*.gif;*.pcx;*.tif;*.xpm|All files (*.*)|*.*',
+						style = wx.OPEN | wx.FILE_MUST_EXIST)
+		
+		if dlg.ShowModal() == wx.ID_OK:
+			try:
+				p = dlg.GetPath()
+				self.Sketch.Image = wx.Image(p)				
+				self.Modified = False
+				self.Refresh()
+			except Exception, e:
+				wx.MessageBox('Could not read the file that you wanted to load: %s' % e,
+					"Hmm... there's a problem here",
+					wx.ICON_ERROR | wx.OK)
+	
+	# -------------------------------------------------------------------
+	def OnCloseImage(self, e):
+		self.Sketch.Image = None
+		self.Refresh()
+	
+	# -------------------------------------------------------------------
+	def OnSave(self, e):
+		if not self.Modified:
+			return
+			
+		if not self.CurrentFile:
+			return self.OnSaveAs(e)
+		
+		try:
+			self.Sketch.Design.Save( self.CurrentFile )
+			self.Modified = False
+		except Exception, e:
+			wx.MessageBox('Could not save the current design: %s' % e,
+				"Hmm... there's a problem here",
+				wx.ICON_ERROR | wx.OK)
+	
+	# -------------------------------------------------------------------
+	def OnSaveAs(self, e):
+		dlg = wx.FileDialog(self, 
+						'Which embroidery design would you like to open?',
+						wildcard = DesignWildcard(),
+						style = wx.SAVE)
+		
+		if dlg.ShowModal() == wx.ID_OK:
+			try:
+				p = dlg.GetPath()
+				self.Sketch.Design.Save( p )
+				self.CurrentFile = p
+				self.Modified = False
+			except Exception, e:
+				wx.MessageBox('Could not save the current design: %s' % e,
+					"Hmm... there's a problem here",
+					wx.ICON_ERROR | wx.OK)	
+					
+	# -------------------------------------------------------------------
+	def OnKeyDown(self, e):
+		c = e.GetKeyCode()
+		
+		if c == wx.WXK_LEFT:
+			self.ProcessCommand( MOVE_LEFT ) 
+		elif c == wx.WXK_RIGHT:
+			self.ProcessCommand( MOVE_RIGHT ) 
+		elif c == wx.WXK_UP:
+			self.ProcessCommand( MOVE_UP ) 
+		elif c == wx.WXK_DOWN:
+			self.ProcessCommand( MOVE_DOWN ) 
+		elif c == wx.WXK_NUMPAD_ADD:
+			self.ProcessCommand( wx.ID_ZOOM_IN ) 
+		elif c == wx.WXK_NUMPAD_SUBTRACT:		
+			self.ProcessCommand( wx.ID_ZOOM_OUT ) 
+	
+	# -------------------------------------------------------------------
+	def ProcessCommand(self, c):
+		self.Freeze()
+		
+		if c == MOVE_LEFT:
+			self.cx -= 4
+		elif c == MOVE_RIGHT:
+			self.cx += 4
+		elif c == MOVE_UP:
+			self.cy -= 4
+		elif c == MOVE_DOWN:
+			self.cy += 4
+		elif c == wx.ID_ZOOM_IN:
+			self.OnZoomIn( c )
+		elif c == wx.ID_ZOOM_OUT:
+			self.OnZoomOut( c )
+		elif c == OPEN_IMAGE:
+			self.OnOpenImage( c )
+		elif c == CLOSE_IMAGE:
+			self.OnCloseImage( c )
+			
+		self.Refresh()
+		
+		self.Thaw()
+	
+	# -------------------------------------------------------------------
+	def OnZoomIn(self, e):
+		self.Magnification += 0.1		
+		self.Refresh()
+	
+	# -------------------------------------------------------------------
+	def OnZoomOut(self, e):
+		self.Magnification -= 0.1		
+		self.Refresh()
+
+# *********************************************************************
+class ColorsCtrl(wx.ScrolledWindow):
+	
+	# -------------------------------------------------------------------
+	def __init__(self, parent, wid, sketchctrl, pstyle):
+		wx.ScrolledWindow.__init__(self, parent, wid, style = pstyle)
+		
+		self.SketchCtrl = sketchctrl
+
+		dc = wx.WindowDC(self)
+		tw, th = dc.GetTextExtent( 'Jj' )
+		
+		self.TextWidth = th
+		self.TextHeight = th
+		
+		self.Bind( wx.EVT_PAINT, self.OnPaint )
+		self.Bind( wx.EVT_LEFT_DOWN, self.OnLeftDown )
+		
+		self.SetScrollRate(10, 10)
+		
+	# -------------------------------------------------------------------
+	def OnLeftDown(self, e):
+		i = e.GetY() / self.TextHeight
+		sketch = self.SketchCtrl.Sketch
+		
+		if i < len( sketch.Design.Colors ):
+			dlg = wx.ColourDialog(self)
+			
+			if dlg.ShowModal() == wx.ID_OK:
+				c = dlg.GetColourData().GetColour()
+				sketch.UndoList.SetColor( sketch.Design, i, (c.Red(), c.Green(), c.Blue()) )
+				sketch.UndoList.Checkpoint()
+				self.SketchCtrl.Modified = True
+				self.SketchCtrl.Refresh()
+				self.GetParent().GetParent().GetParent().UpdateTitle()
+				
+	# -------------------------------------------------------------------
+	def OnPaint(self, e):
+		dc = wx.PaintDC(self)
+		
+		w, h = dc.GetSizeTuple()
+		
+		dc.SetBrush( wx.WHITE_BRUSH )
+		dc.DrawRectangle( 0, 0, w, h )
+		dc.SetBrush( wx.NullBrush )
+		
+		x, y = 0, 0
+		
+		for c in self.SketchCtrl.Sketch.Design.Colors:
+			color = wx.Colour( c[0], c[1], c[2] )			
+			brush = wx.Brush( color )
+			dc.SetBrush( brush )
+			
+			dc.DrawRectangle( x, y, w, self.TextHeight )
+			
+			text = '#%02X%02X%02X' % ( c[0], c[1], c[2] )
+			
+			ca = (c[0] + c[1] + c[2]) / 3
+			
+			if ca > 0xa0:
+				dc.SetTextForeground( wx.Colour( 0x00, 0x00, 0x00 ) )
+			else:
+				dc.SetTextForeground( wx.Colour( 0xff, 0xff, 0xff ) )
+			
+			tw, th = dc.GetTextExtent( text )
+			dc.DrawText( text, (w / 2) - (tw / 2), y )
+			
+			y += self.TextHeight
+			
+			dc.SetBrush( wx.NullBrush )
+		
+	# -------------------------------------------------------------------
+	def Update(self):
+		self.SetVirtualSizeHints(self.TextWidth * 4, 
+			len( self.SketchCtrl.Sketch.Design.Colors ) * self.TextHeight)
+		
+		self.Refresh()
+		
+# *********************************************************************
+class MainWnd(wx.Frame):	
+	# -------------------------------------------------------------------
+	def __init__(self, parent, wid, title):
+		wx.Frame.__init__(self,
+										parent,
+										wx.ID_ANY,
+										title)
+		
+		self.Splitter = wx.SplitterWindow(self, wx.ID_ANY, style = wx.SP_3D)
+		
+		self.Tabs	=	wx.Notebook(self.Splitter, wx.ID_ANY, style = wx.NB_TOP)		
+		self.SideBar	=	wx.Notebook(self.Splitter, wx.ID_ANY, style = wx.NB_TOP)		
+		
+		self.CreateToolBar()
+		
+		self.Splitter.SplitVertically( self.SideBar, self.Tabs )
+		
+		self.MainSizer = wx.BoxSizer( wx.HORIZONTAL )
+		self.MainSizer.Add( self.Splitter, 1, wx.EXPAND )
+		self.SetSizer( self.MainSizer )
+		
+		self.Tabs.AddPage( SketchCtrl(self.Tabs, wx.ID_ANY, 0), 'Untitled' )
+		self.Tabs.GetCurrentPage().SetFocus()
+		
+		self.SideBar.AddPage( ColorsCtrl(self.SideBar, wx.ID_ANY, self.Tabs.GetCurrentPage(), 0), 'Color Editor' )
+		
+		self.MainMenu	=	wx.MenuBar()
+		
+		self.FileMenu	=	wx.Menu()
+		
+		self.FileMenu.Append(	wx.ID_NEW, 'New Design\tCtrl+N' )
+		self.FileMenu.Append(	NEW_TAB, 'New Tab\tCtrl+T' )
+		self.FileMenu.AppendSeparator()
+		self.FileMenu.Append(	wx.ID_OPEN, 'Open Design\tCtrl+O' )
+		self.FileMenu.Append(	OPEN_IMAGE, 'Open Image\tShift+Ctrl+O' )
+		self.FileMenu.Append(	wx.ID_SAVE, 'Save Design\tCtrl+S' )
+		self.FileMenu.Append(	wx.ID_SAVEAS, 'Save Design As\tShift+Ctrl+S' )
+		self.FileMenu.AppendSeparator()
+		self.FileMenu.Append(	CLOSE_TAB, 'Close Tab\tCtrl+W' )
+		self.FileMenu.Append(	CLOSE_IMAGE, 'Close Image\tShift+Ctrl+W' )
+		self.FileMenu.Append(	wx.ID_EXIT, 'Exit This Program\tAlt+F4' )
+		
+		self.EditMenu	=	wx.Menu()
+		
+		self.EditMenu.Append(	wx.ID_UNDO, 'Undo\tCtrl+Z' )
+		self.EditMenu.Append(	wx.ID_REDO, 'Redo\tCtrl+Y' )
+		
+		self.ViewMenu	=	wx.Menu()
+		
+		self.ViewMenu.Append(	wx.ID_ZOOM_IN, 'Zoom In\t+' )
+		self.ViewMenu.Append(	wx.ID_ZOOM_OUT, 'Zoom Out\t-' )
+		self.ViewMenu.AppendSeparator()
+		self.ViewMenu.Append(	ROTATE_CLOCKWISE, 'Rotate Clockwise\tR' )
+		self.ViewMenu.Append(	ROTATE_COUNTERCLOCKWISE, 'Rotate Counterclockwise\tL' )
+		
+		self.HelpMenu	=	wx.Menu()
+		
+		self.HelpMenu.Append( wx.ID_HELP_CONTENTS, 'Read the Manual' )
+		self.HelpMenu.AppendSeparator()
+		self.HelpMenu.Append( wx.ID_ABOUT, 'About This Program' )
+		
+		self.MainMenu.Append( self.FileMenu, 'File' )
+		self.MainMenu.Append( self.EditMenu, 'Edit' )
+		self.MainMenu.Append( self.ViewMenu, 'View' )
+		self.MainMenu.Append( self.HelpMenu, 'Help' )
+		
+		self.SetMenuBar( self.MainMenu )
+		
+		self.Bind( wx.EVT_MENU, self.OnNew, id = wx.ID_NEW )
+		self.Bind( wx.EVT_MENU, self.OnNewTab, id = NEW_TAB )
+		self.Bind( wx.EVT_MENU, self.OnCloseTab, id = CLOSE_TAB )
+		self.Bind( wx.EVT_MENU, self.OnOpen, id = wx.ID_OPEN )
+		self.Bind( wx.EVT_MENU, self.OnSave, id = wx.ID_SAVE )
+		self.Bind( wx.EVT_MENU, self.OnSaveAs, id = wx.ID_SAVEAS )
+		self.Bind( wx.EVT_MENU, self.OnUndo, id = wx.ID_UNDO )
+		self.Bind( wx.EVT_MENU, self.OnRedo, id = wx.ID_REDO )
+		self.Bind( wx.EVT_MENU, self.ProcessCommand, id = wx.ID_ZOOM_IN )
+		self.Bind( wx.EVT_MENU, self.ProcessCommand, id = wx.ID_ZOOM_OUT )
+		self.Bind( wx.EVT_MENU, self.OnRotateClockwise, id = ROTATE_CLOCKWISE )
+		self.Bind( wx.EVT_MENU, self.OnRotateCounterClockwise, id = ROTATE_COUNTERCLOCKWISE )
+		self.Bind( wx.EVT_MENU, self.ProcessCommand, id = OPEN_IMAGE )
+		self.Bind( wx.EVT_MENU, self.ProcessCommand, id = CLOSE_IMAGE )
+		
+		self.Bind( wx.EVT_NOTEBOOK_PAGE_CHANGED, self.OnTabChange)
+		
+		self.Accelerators = wx.AcceleratorTable(
+			[
+				(wx.ACCEL_CTRL,	ord('O'),	wx.ID_OPEN),
+				(wx.ACCEL_CTRL,	ord('N'),	NEW_TAB),
+				(wx.ACCEL_CTRL,	ord('W'),	CLOSE_TAB),
+				(wx.ACCEL_CTRL,	ord('S'),	wx.ID_SAVE),
+				(wx.ACCEL_CTRL,	ord('Z'),	wx.ID_UNDO),
+				(wx.ACCEL_CTRL,	ord('Y'),	wx.ID_REDO),
+				(wx.ACCEL_CTRL,	ord('R'),	ROTATE_CLOCKWISE),
+				(wx.ACCEL_CTRL,	ord('S'),	ROTATE_COUNTERCLOCKWISE),
+				(wx.ACCEL_CTRL | wx.ACCEL_SHIFT, ord('S'),	wx.ID_SAVEAS),
+				(wx.ACCEL_CTRL | wx.ACCEL_SHIFT, ord('O'),	OPEN_IMAGE),
+				(wx.ACCEL_CTRL | wx.ACCEL_SHIFT, ord('W'),	CLOSE_IMAGE),
+			]
+		)
+			
+		self.SetAcceleratorTable( self.Accelerators )		
+		
+	# -------------------------------------------------------------------
+	def OnNew(self, e):
+		self.Tabs.GetCurrentPage().Clear()
+		self.UpdateTitle()
+		self.UpdateSideBar()
+	
+	# -------------------------------------------------------------------
+	def OnNewTab(self, e):
+		self.Tabs.AddPage( SketchCtrl(self.Tabs, wx.ID_ANY, 0), 'Untitled', True)
+		self.UpdateSideBar()
+		
+	# -------------------------------------------------------------------
+	def OnCloseTab(self, e):
+		if self.Tabs.GetPageCount() > 1:
+			self.Tabs.DeletePage( self.Tabs.GetSelection() )
+		else:
+			self.Tabs.GetCurrentPage().Clear()
+			self.Tabs.GetCurrentPage().Refresh()
+			
+		self.UpdateSideBar()
+		
+	# -------------------------------------------------------------------
+	def OnUndo(self, e):
+		self.Tabs.GetCurrentPage().OnUndo( e )
+		self.UpdateSideBar()
+		self.UpdateTitle()
+	
+	# -------------------------------------------------------------------
+	def OnRedo(self, e):
+		self.Tabs.GetCurrentPage().OnRedo( e )
+		self.UpdateSideBar()
+		self.UpdateTitle()
+	
+	# -------------------------------------------------------------------
+	def OnRotateClockwise(self, e):
+		self.Tabs.GetCurrentPage().OnRotateClockwise( e )
+		self.UpdateTitle()
+	
+	# -------------------------------------------------------------------
+	def OnRotateCounterClockwise(self, e):
+		self.Tabs.GetCurrentPage().OnRotateCounterClockwise( e )
+		self.UpdateTitle()
+			
+	# -------------------------------------------------------------------
+	def OnOpen(self, e):
+		self.Tabs.GetCurrentPage().OnOpen( e )
+		self.UpdateSideBar()
+		self.UpdateTitle()
+	
+	# -------------------------------------------------------------------
+	def OnSave(self, e):
+		self.Tabs.GetCurrentPage().OnSave( e )
+		self.Tabs.SetPageText( self.Tabs.GetSelection(), 
+													os.path.basename( self.Tabs.GetCurrentPage().CurrentFile ) )
+		self.UpdateTitle()
+	
+	# -------------------------------------------------------------------
+	def OnSaveAs(self, e):
+		self.Tabs.GetCurrentPage().OnSaveAs( e )
+		self.UpdateTitle()
+					
+	# -------------------------------------------------------------------
+	def ProcessCommand(self, e):
+		self.Tabs.GetCurrentPage().ProcessCommand( e.GetId() )
+	
+	# -------------------------------------------------------------------
+	def OnTabChange(self, e):
+		if e.GetId() == self.Tabs.GetId():
+			self.UpdateSideBar()
+	
+	# -------------------------------------------------------------------
+	def UpdateSideBar(self):
+		colorctrl = self.SideBar.GetPage(0)
+		colorctrl.SketchCtrl = self.Tabs.GetCurrentPage()
+		colorctrl.Refresh()
+	
+	# -------------------------------------------------------------------
+	def UpdateTitle(self):
+		modified = ''
+		
+		if self.Tabs.GetCurrentPage().Modified:
+			modified = '*'
+		
+		currentfile = self.Tabs.GetCurrentPage().CurrentFile
+		
+		if not currentfile:
+			self.Tabs.SetPageText( self.Tabs.GetSelection(), 'Untitled' )
+			self.SetTitle( APP_NAME )
+			return
+		
+		self.Tabs.SetPageText( self.Tabs.GetSelection(), 
+												'%s %s' % ( os.path.basename( currentfile ) ,
+																		modified )
+												)
+		self.SetTitle( '%s - %s %s' % (APP_NAME, currentfile, modified) )
+
+# =================================================================			
+def Run():
+	wx.InitAllImageHandlers()
+	app = wx.PySimpleApp()
+	frame = MainWnd(None, -1, APP_NAME)
+	frame.Show(1)
+	app.MainLoop()